@@ -0,0 +1,103 @@
+import logging
+import os
+import unittest
+from unittest.mock import patch, MagicMock
+
+from stopcovid.dialog.command_stream.backpressure import (
+    TokenBucket,
+    BulkPublishGovernor,
+    DEFAULT_MIN_COMMANDS_PER_SECOND,
+)
+from stopcovid.dialog.command_stream.publish import PublishMetrics
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.bucket = TokenBucket(10, 10, clock=lambda: self.now)
+
+    def test_bursts_up_to_capacity(self):
+        self.bucket.acquire(10)
+        self.assertAlmostEqual(0.1, self.bucket.seconds_until_available())
+
+    def test_refills_at_rate(self):
+        self.bucket.acquire(10)
+        self.now = 0.5
+        self.assertEqual(0, self.bucket.seconds_until_available(5))
+        self.now = 10
+        # never more than capacity
+        self.assertAlmostEqual(0.5, self.bucket.seconds_until_available(15))
+
+    @patch("stopcovid.dialog.command_stream.backpressure.time.sleep")
+    def test_acquire_waits_for_tokens(self, sleep_mock):
+        self.bucket.acquire(10)
+
+        def sleep(seconds):
+            self.now += seconds
+
+        sleep_mock.side_effect = sleep
+        self.bucket.acquire(2)
+        sleep_mock.assert_called_once()
+        self.assertAlmostEqual(0.2, sleep_mock.call_args[0][0])
+
+
+@patch.dict(os.environ, {"STAGE": "test"})
+@patch("stopcovid.dialog.command_stream.backpressure.boto3")
+class TestBulkPublishGovernor(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.metrics = PublishMetrics()
+
+    def _governor(self, boto3_mock, backlog: int = 0, **kwargs) -> BulkPublishGovernor:
+        sqs = MagicMock()
+        sqs.get_queue_url.return_value = {"QueueUrl": "https://queue"}
+        sqs.get_queue_attributes.return_value = {
+            "Attributes": {"ApproximateNumberOfMessages": str(backlog)}
+        }
+        boto3_mock.client.return_value = sqs
+        return BulkPublishGovernor(**kwargs)
+
+    def test_admits_commands(self, boto3_mock):
+        governor = self._governor(boto3_mock)
+        self.assertTrue(governor.admit(self.metrics))
+        boto3_mock.client.return_value.get_queue_url.assert_called_once_with(
+            QueueName="outbound-sms-test.fifo"
+        )
+
+    def test_defers_when_outbound_messages_back_up(self, boto3_mock):
+        governor = self._governor(boto3_mock, backlog=2000, max_outbound_backlog=1000)
+        self.assertFalse(governor.admit(self.metrics))
+
+    def test_checks_the_backlog_periodically(self, boto3_mock):
+        governor = self._governor(boto3_mock)
+        for _ in range(5):
+            governor.admit(self.metrics)
+        boto3_mock.client.return_value.get_queue_attributes.assert_called_once()
+
+    def test_backlog_errors_do_not_stop_publishing(self, boto3_mock):
+        governor = self._governor(boto3_mock)
+        boto3_mock.client.return_value.get_queue_attributes.side_effect = Exception("oops")
+        self.assertTrue(governor.admit(self.metrics))
+
+    def test_defers_before_the_deadline(self, boto3_mock):
+        governor = self._governor(
+            boto3_mock, time_remaining_ms=lambda: 3000, deadline_margin_ms=5000
+        )
+        self.assertFalse(governor.admit(self.metrics))
+
+    def test_slows_down_when_throttled(self, boto3_mock):
+        governor = self._governor(boto3_mock, commands_per_second=50)
+        governor.admit(self.metrics)
+        self.metrics.throttled_records = 3
+        governor.admit(self.metrics)
+        self.assertLess(governor.commands_per_second, 26)
+
+        # only new throttling counts
+        rate = governor.commands_per_second
+        governor.admit(self.metrics)
+        self.assertGreaterEqual(governor.commands_per_second, rate)
+
+        for i in range(10):
+            self.metrics.throttled_records += 1
+            governor.admit(self.metrics)
+        self.assertEqual(DEFAULT_MIN_COMMANDS_PER_SECOND, governor.commands_per_second)
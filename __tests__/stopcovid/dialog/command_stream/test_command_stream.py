@@ -0,0 +1,275 @@
+import logging
+import unittest
+import uuid
+from unittest.mock import MagicMock, patch
+
+from stopcovid.dialog.command_stream.command_stream import handle_inbound_commands
+from stopcovid.dialog.command_stream.types import InboundCommand, InboundCommandType
+from stopcovid.dialog.engine import ProcessSMSMessage, StartDrill, TriggerReminder
+from stopcovid.dialog.persistence import DialogStateConflict
+
+
+@patch("stopcovid.dialog.command_stream.command_stream.apply_commands_for_phone_number")
+class TestHandleInboundCommands(unittest.TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        self.drill_instance_id = str(uuid.uuid4())
+        self.repo = MagicMock()
+        self.repo.persist_dialog_states.return_value = {}
+        self.failures = MagicMock()
+        self.failures.should_retry.return_value = True
+
+    def _sms(self, phone_number: str, body: str, seq: int) -> InboundCommand:
+        return InboundCommand(
+            command_type=InboundCommandType.INBOUND_SMS,
+            sequence_number=str(seq),
+            payload={"From": phone_number, "Body": body},
+        )
+
+    def _start_drill(self, phone_number: str, seq: int) -> InboundCommand:
+        return InboundCommand(
+            command_type=InboundCommandType.START_DRILL,
+            sequence_number=str(seq),
+            payload={"phone_number": phone_number, "drill_slug": "test-drill"},
+        )
+
+    def _trigger_reminder(self, phone_number: str, seq: int) -> InboundCommand:
+        return InboundCommand(
+            command_type=InboundCommandType.TRIGGER_REMINDER,
+            sequence_number=str(seq),
+            payload={
+                "phone_number": phone_number,
+                "drill_instance_id": self.drill_instance_id,
+                "prompt_slug": "test-prompt",
+            },
+        )
+
+    def _commands_by_phone_number(self, process_mock):
+        return {call[0][0]: call[0][1] for call in process_mock.call_args_list}
+
+    def test_groups_commands_by_phone_number(self, process_mock):
+        handle_inbound_commands(
+            [
+                self._sms("123", "hi", 1),
+                self._sms("456", "yo", 2),
+                self._start_drill("123", 3),
+                self._trigger_reminder("456", 4),
+            ],
+            repo=self.repo,
+        )
+        self.assertEqual(2, process_mock.call_count)
+        by_phone_number = self._commands_by_phone_number(process_mock)
+
+        self.assertEqual(["1", "3"], [seq for _, seq in by_phone_number["123"]])
+        self.assertIsInstance(by_phone_number["123"][0][0], ProcessSMSMessage)
+        self.assertIsInstance(by_phone_number["123"][1][0], StartDrill)
+
+        self.assertEqual(["2", "4"], [seq for _, seq in by_phone_number["456"]])
+        self.assertIsInstance(by_phone_number["456"][1][0], TriggerReminder)
+
+    def test_orders_commands_by_sequence_number(self, process_mock):
+        handle_inbound_commands(
+            [self._sms("123", "two", 20), self._sms("123", "one", 3)], repo=self.repo
+        )
+        commands = self._commands_by_phone_number(process_mock)["123"]
+        self.assertEqual(["3", "20"], [seq for _, seq in commands])
+        self.assertEqual("one", commands[0][0].content)
+
+    def test_drops_duplicate_scheduled_commands(self, process_mock):
+        handle_inbound_commands(
+            [
+                self._start_drill("123", 1),
+                self._trigger_reminder("123", 2),
+                self._start_drill("123", 3),
+                self._trigger_reminder("123", 4),
+                self._start_drill("456", 5),
+            ],
+            repo=self.repo,
+        )
+        by_phone_number = self._commands_by_phone_number(process_mock)
+        self.assertEqual(["1", "2"], [seq for _, seq in by_phone_number["123"]])
+        self.assertEqual(["5"], [seq for _, seq in by_phone_number["456"]])
+
+    def test_keeps_repeated_sms(self, process_mock):
+        handle_inbound_commands(
+            [self._sms("123", "a", 1), self._sms("123", "a", 2)], repo=self.repo
+        )
+        commands = self._commands_by_phone_number(process_mock)["123"]
+        self.assertEqual(["1", "2"], [seq for _, seq in commands])
+
+    def test_passes_repo_through(self, process_mock):
+        handle_inbound_commands([self._sms("123", "a", 1)], repo=self.repo)
+        self.assertEqual(self.repo, process_mock.call_args[1]["repo"])
+
+    def test_concurrent_processing(self, process_mock):
+        commands = [self._sms(str(i % 5), str(i), i) for i in range(20)]
+        handle_inbound_commands(commands, repo=self.repo, max_workers=4)
+        self.assertEqual(5, process_mock.call_count)
+        for phone_number, phone_commands in self._commands_by_phone_number(process_mock).items():
+            seqs = [int(seq) for _, seq in phone_commands]
+            self.assertEqual(4, len(seqs))
+            self.assertEqual(sorted(seqs), seqs)
+            self.assertTrue(all(seq % 5 == int(phone_number) for seq in seqs))
+
+    def test_failure_for_one_phone_number_does_not_block_others(self, process_mock):
+        def process(phone_number, *args, **kwargs):
+            if phone_number == "456":
+                raise ValueError("boom")
+
+        process_mock.side_effect = process
+        for max_workers in [1, 4]:
+            process_mock.reset_mock()
+            result = handle_inbound_commands(
+                [
+                    self._sms("123", "a", 1),
+                    self._sms("456", "b", 2),
+                    self._sms("789", "c", 3),
+                    self._sms("456", "d", 4),
+                ],
+                repo=self.repo,
+                max_workers=max_workers,
+                failures=self.failures,
+            )
+            self.assertEqual(
+                {"123", "456", "789"}, set(self._commands_by_phone_number(process_mock).keys())
+            )
+            self.assertEqual([{"itemIdentifier": "2"}], result["batchItemFailures"])
+
+    def test_failures_that_exhaust_retries_are_not_reported(self, process_mock):
+        process_mock.side_effect = ValueError("boom")
+        self.failures.should_retry.return_value = False
+        result = handle_inbound_commands(
+            [self._sms("456", "b", 2), self._sms("456", "d", 4)],
+            repo=self.repo,
+            failures=self.failures,
+        )
+        self.assertEqual([], result["batchItemFailures"])
+        phone_number, commands, error = self.failures.should_retry.call_args[0]
+        self.assertEqual("456", phone_number)
+        self.assertEqual(["2", "4"], [command.sequence_number for command in commands])
+        self.assertEqual("b", commands[0].payload["Body"])
+        self.assertIsInstance(error, ValueError)
+
+    @patch("stopcovid.dialog.command_stream.command_stream._DEFAULT_FAILURES", None)
+    @patch("stopcovid.dialog.command_stream.command_stream.CommandFailureRecorder")
+    def test_default_failure_recorder_is_shared(self, recorder_mock, process_mock):
+        process_mock.side_effect = ValueError("boom")
+        for _ in range(2):
+            handle_inbound_commands([self._sms("456", "b", 2)], repo=self.repo)
+        recorder_mock.assert_called_once()
+        self.assertEqual(2, recorder_mock.return_value.should_retry.call_count)
+
+    def test_prefetches_dialog_states(self, process_mock):
+        self.repo.fetch_dialog_states.return_value = {"123": "state-123"}
+        handle_inbound_commands(
+            [self._sms("123", "hi", 1), self._sms("456", "yo", 2)], repo=self.repo
+        )
+        self.repo.fetch_dialog_states.assert_called_once()
+        self.assertEqual({"123", "456"}, set(self.repo.fetch_dialog_states.call_args[0][0]))
+        states = {call[0][0]: call[1]["dialog_state"] for call in process_mock.call_args_list}
+        # phone numbers that weren't prefetched are fetched by the engine
+        self.assertEqual({"123": "state-123", "456": None}, states)
+
+    def test_persists_all_phone_numbers_together(self, process_mock):
+        process_mock.side_effect = lambda phone_number, *args, **kwargs: f"write-{phone_number}"
+        handle_inbound_commands(
+            [self._sms("123", "hi", 1), self._sms("456", "yo", 2)], repo=self.repo
+        )
+        self.repo.persist_dialog_states.assert_called_once()
+        self.assertEqual(
+            ["write-123", "write-456"], sorted(self.repo.persist_dialog_states.call_args[0][0])
+        )
+
+    @patch("stopcovid.dialog.command_stream.command_stream.process_commands_for_phone_number")
+    def test_conflicts_are_reprocessed(self, reprocess_mock, process_mock):
+        self.repo.persist_dialog_states.return_value = {"456": DialogStateConflict("456")}
+        handle_inbound_commands(
+            [self._sms("123", "hi", 1), self._sms("456", "yo", 2)], repo=self.repo
+        )
+        reprocess_mock.assert_called_once()
+        self.assertEqual("456", reprocess_mock.call_args[0][0])
+        self.assertTrue(reprocess_mock.call_args[1]["consistent_read"])
+
+    @patch("stopcovid.dialog.command_stream.command_stream.process_commands_for_phone_number")
+    def test_conflicts_that_persist_are_reported(self, reprocess_mock, process_mock):
+        self.repo.persist_dialog_states.return_value = {"456": DialogStateConflict("456")}
+        reprocess_mock.side_effect = DialogStateConflict("456")
+        result = handle_inbound_commands(
+            [self._sms("456", "yo", 2)], repo=self.repo, failures=self.failures
+        )
+        self.assertEqual([{"itemIdentifier": "2"}], result["batchItemFailures"])
+
+    @patch("stopcovid.dialog.command_stream.command_stream.process_commands_for_phone_number")
+    def test_other_persist_failures_are_reported(self, reprocess_mock, process_mock):
+        self.repo.persist_dialog_states.return_value = {"456": ValueError("too big")}
+        result = handle_inbound_commands(
+            [self._sms("123", "hi", 1), self._sms("456", "yo", 2)],
+            repo=self.repo,
+            failures=self.failures,
+        )
+        reprocess_mock.assert_not_called()
+        self.assertEqual([{"itemIdentifier": "2"}], result["batchItemFailures"])
+        phone_number, _, error = self.failures.should_retry.call_args[0]
+        self.assertEqual("456", phone_number)
+        self.assertIsInstance(error, ValueError)
+
+    def test_reports_no_failures_when_everything_is_processed(self, process_mock):
+        result = handle_inbound_commands(
+            [self._sms("123", "hi", 1)], repo=self.repo, time_remaining_ms=lambda: 5000
+        )
+        self.assertEqual([], result["batchItemFailures"])
+
+    def test_stops_before_the_deadline(self, process_mock):
+        time_remaining = iter([5000, 5000, 500, 500])
+        result = handle_inbound_commands(
+            [
+                self._sms("123", "hi", 1),
+                self._sms("456", "yo", 2),
+                self._sms("789", "sup", 3),
+                self._sms("456", "again", 4),
+                self._sms("000", "hey", 5),
+            ],
+            repo=self.repo,
+            time_remaining_ms=lambda: next(time_remaining),
+        )
+        self.assertEqual({"123", "456"}, set(self._commands_by_phone_number(process_mock).keys()))
+        self.assertEqual(
+            [{"itemIdentifier": "3"}, {"itemIdentifier": "5"}], result["batchItemFailures"]
+        )
+
+    @patch("stopcovid.dialog.command_stream.command_stream.process_commands_for_phone_number")
+    def test_conflicts_are_not_reprocessed_after_the_deadline(self, reprocess_mock, process_mock):
+        time_remaining = iter([5000, 5000, 500])
+        self.repo.persist_dialog_states.return_value = {"456": DialogStateConflict("456")}
+        result = handle_inbound_commands(
+            [self._sms("123", "hi", 1), self._sms("456", "yo", 2)],
+            repo=self.repo,
+            time_remaining_ms=lambda: next(time_remaining),
+        )
+        reprocess_mock.assert_not_called()
+        self.assertEqual([{"itemIdentifier": "2"}], result["batchItemFailures"])
+
+    def test_interactive_commands_go_first(self, process_mock):
+        handle_inbound_commands(
+            [
+                self._start_drill("123", 1),
+                self._trigger_reminder("456", 2),
+                self._sms("789", "hi", 3),
+                self._start_drill("000", 4),
+                self._sms("000", "yo", 5),
+            ],
+            repo=self.repo,
+        )
+        self.assertEqual(
+            ["789", "000", "123", "456"], [call[0][0] for call in process_mock.call_args_list]
+        )
+
+    def test_bulk_commands_are_deferred_before_the_deadline(self, process_mock):
+        time_remaining = iter([5000, 500])
+        result = handle_inbound_commands(
+            [self._start_drill("123", 1), self._sms("789", "hi", 2)],
+            repo=self.repo,
+            time_remaining_ms=lambda: next(time_remaining),
+        )
+        self.assertEqual(["789"], [call[0][0] for call in process_mock.call_args_list])
+        self.assertEqual([{"itemIdentifier": "1"}], result["batchItemFailures"])
@@ -0,0 +1,76 @@
+import json
+import logging
+import unittest
+from unittest.mock import MagicMock, patch
+
+from stopcovid.dialog.command_stream.failures import CommandFailureRecorder
+from stopcovid.dialog.command_stream.types import InboundCommand, InboundCommandType
+
+
+class TestCommandFailureRecorder(unittest.TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        with patch("stopcovid.dialog.command_stream.failures.boto3"):
+            self.recorder = CommandFailureRecorder(max_attempts=3)
+        self.recorder.stage = "test"
+        self.recorder.sqs = MagicMock()
+        self.recorder.sqs.get_queue_url.return_value = {"QueueUrl": "command-failures-url"}
+        self.commands = [
+            InboundCommand(
+                command_type=InboundCommandType.INBOUND_SMS,
+                sequence_number=str(seq),
+                payload={"From": "123", "Body": body},
+            )
+            for seq, body in [(1, "hi"), (2, "there")]
+        ]
+
+    def _error(self) -> Exception:
+        try:
+            raise ValueError("boom")
+        except ValueError as e:
+            return e
+
+    def test_retries_until_attempts_are_exhausted(self):
+        error = self._error()
+        self.assertTrue(self.recorder.should_retry("123", self.commands, error))
+        self.assertTrue(self.recorder.should_retry("123", self.commands, error))
+        self.recorder.sqs.send_message.assert_not_called()
+        self.assertFalse(self.recorder.should_retry("123", self.commands, error))
+
+        self.recorder.sqs.get_queue_url.assert_called_once_with(QueueName="command-failures-test")
+        kwargs = self.recorder.sqs.send_message.call_args[1]
+        self.assertEqual("command-failures-url", kwargs["QueueUrl"])
+        body = json.loads(kwargs["MessageBody"])
+        self.assertEqual("123", body["phone_number"])
+        self.assertEqual(3, body["attempts"])
+        self.assertIn("boom", body["error"])
+        self.assertIn("ValueError", body["traceback"])
+        self.assertEqual(
+            [
+                {
+                    "command_type": "INBOUND_SMS",
+                    "sequence_number": "1",
+                    "payload": {"From": "123", "Body": "hi"},
+                },
+                {
+                    "command_type": "INBOUND_SMS",
+                    "sequence_number": "2",
+                    "payload": {"From": "123", "Body": "there"},
+                },
+            ],
+            body["commands"],
+        )
+
+    def test_attempts_are_counted_per_phone_number_and_first_command(self):
+        error = self._error()
+        self.recorder.should_retry("123", self.commands, error)
+        self.recorder.should_retry("123", self.commands, error)
+        self.assertTrue(self.recorder.should_retry("456", self.commands, error))
+        self.assertTrue(self.recorder.should_retry("123", self.commands[1:], error))
+        self.recorder.sqs.send_message.assert_not_called()
+
+    def test_keeps_retrying_when_the_failure_queue_is_unavailable(self):
+        self.recorder.sqs.send_message.side_effect = RuntimeError("unavailable")
+        error = self._error()
+        for _ in range(4):
+            self.assertTrue(self.recorder.should_retry("123", self.commands, error))
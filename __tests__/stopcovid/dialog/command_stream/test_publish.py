@@ -1,41 +1,94 @@
+import json
 import logging
+import os
 import unittest
 import uuid
 from unittest.mock import patch, MagicMock
 
-from stopcovid.dialog.command_stream.publish import CommandPublisher
+from botocore.exceptions import ClientError
+
+from stopcovid.dialog.command_stream.publish import (
+    CommandPublisher,
+    CommandPublishError,
+    BufferedCommandPublisher,
+    MAX_PUT_ATTEMPTS,
+    THROTTLED_ERROR_CODE,
+)
+from stopcovid.dialog.command_stream.sequence_numbers import SequenceNumberStore
+from stopcovid.dialog.command_stream.types import get_twilio_webhook, make_inbound_sms_payload
 from stopcovid.drill_progress.drill_progress import DrillInstance
 
 
-class TestCommandPublisher(unittest.TestCase):
+class FakeKinesisTestCase(unittest.TestCase):
     def setUp(self) -> None:
         logging.disable(logging.CRITICAL)
         kinesis_client = MagicMock()
-        self.put_records_mock = MagicMock()
+        self.put_records_mock = MagicMock(side_effect=self._put_records)
+        self.errors = {}
         kinesis_client.put_records = self.put_records_mock
+        self.put_record_mock = MagicMock(side_effect=self._put_record)
+        kinesis_client.put_record = self.put_record_mock
         get_kinesis_client_patch = patch(
             "stopcovid.dialog.command_stream.publish.CommandPublisher._get_kinesis_client",
             return_value=kinesis_client,
         )
         get_kinesis_client_patch.start()
         self.addCleanup(get_kinesis_client_patch.stop)
+        sleep_patch = patch("stopcovid.dialog.command_stream.publish.time.sleep")
+        self.sleep_mock = sleep_patch.start()
+        self.addCleanup(sleep_patch.stop)
+        self.sequence_numbers = SequenceNumberStore()
+        store_patch = patch(
+            "stopcovid.dialog.command_stream.publish.get_sequence_number_store",
+            return_value=self.sequence_numbers,
+        )
+        store_patch.start()
+        self.addCleanup(store_patch.stop)
         self.command_publisher = CommandPublisher()
+        self.next_seq = 1
+
+    def _put_records(self, StreamName, Records):
+        # fails records for the phone numbers in self.errors with the given error codes
+        results = []
+        for record in Records:
+            errors = self.errors.get(record["PartitionKey"])
+            if errors:
+                results.append({"ErrorCode": errors.pop(0), "ErrorMessage": "oops"})
+            else:
+                results.append({"SequenceNumber": str(self.next_seq), "ShardId": "shard-1"})
+                self.next_seq += 1
+        return {
+            "FailedRecordCount": len([r for r in results if "ErrorCode" in r]),
+            "Records": results,
+        }
+
+    def _put_record(self, StreamName, Data, PartitionKey, **kwargs):
+        result = self._put_records(StreamName, [{"Data": Data, "PartitionKey": PartitionKey}])[
+            "Records"
+        ][0]
+        if "ErrorCode" in result:
+            raise ClientError(
+                {"Error": {"Code": result["ErrorCode"], "Message": "oops"}}, "PutRecord"
+            )
+        return result
 
+    def _commands(self, count: int, phone_numbers: int):
+        return [
+            (str(i % phone_numbers), {"type": "START_DRILL", "payload": {"i": i}})
+            for i in range(count)
+        ]
+
+
+class TestCommandPublisher(FakeKinesisTestCase):
     def test_publish_start_drill(self):
         self.command_publisher.publish_start_drill_command("123456789", "slug")
-        self.put_records_mock.assert_called_once()
-        self.assertEqual(1, len(self.put_records_mock.call_args[1]["Records"]))
-        self.assertEqual(
-            "123456789", self.put_records_mock.call_args[1]["Records"][0]["PartitionKey"]
-        )
+        self.put_record_mock.assert_called_once()
+        self.assertEqual("123456789", self.put_record_mock.call_args[1]["PartitionKey"])
 
     def publish_process_sms(self):
         self.command_publisher.publish_process_sms_command("123456789", "lol", {"foo": "bar"})
-        self.put_records_mock.assert_called_once()
-        self.assertEqual(1, len(self.put_records_mock.call_args[1]["Records"]))
-        self.assertEqual(
-            "123456789", self.put_records_mock.call_args[1]["Records"][0]["PartitionKey"]
-        )
+        self.put_record_mock.assert_called_once()
+        self.assertEqual("123456789", self.put_record_mock.call_args[1]["PartitionKey"])
 
     def publish_trigger_reminders(self):
         drill_instances = [
@@ -61,3 +114,196 @@ class TestCommandPublisher(unittest.TestCase):
         self.assertEqual(
             "987654321", self.put_records_mock.call_args[1]["Records"][1]["PartitionKey"]
         )
+
+    def test_chunks_to_the_put_records_limit(self):
+        outcomes = self.command_publisher._publish_commands(self._commands(1200, 1200))
+        self.assertEqual(
+            [500, 500, 200],
+            [len(call[1]["Records"]) for call in self.put_records_mock.call_args_list],
+        )
+        self.assertTrue(all(outcome.published for outcome in outcomes))
+
+    def test_chunks_to_the_size_limit(self):
+        big = "x" * (2 * 1024 * 1024)
+        self.command_publisher._publish_commands(
+            [(str(i), {"type": "START_DRILL", "payload": {"big": big}}) for i in range(3)]
+        )
+        self.assertEqual(
+            [2], [len(call[1]["Records"]) for call in self.put_records_mock.call_args_list]
+        )
+        self.put_record_mock.assert_called_once()
+
+    def test_one_command_per_phone_number_per_chunk(self):
+        self.command_publisher._publish_commands(self._commands(6, 3))
+        self.assertEqual(
+            [["0", "1", "2"], ["0", "1", "2"]],
+            [
+                [record["PartitionKey"] for record in call[1]["Records"]]
+                for call in self.put_records_mock.call_args_list
+            ],
+        )
+
+    def test_retries_failed_records(self):
+        self.errors = {
+            "0": ["ProvisionedThroughputExceededException"],
+            "1": ["InternalFailure"],
+        }
+        outcomes = self.command_publisher._publish_commands(self._commands(3, 3))
+        self.assertEqual(2, self.put_records_mock.call_count)
+        retried = self.put_records_mock.call_args[1]["Records"]
+        self.assertEqual(["0", "1"], [record["PartitionKey"] for record in retried])
+        self.assertEqual([2, 2, 1], [outcome.attempts for outcome in outcomes])
+        self.assertTrue(all(outcome.published for outcome in outcomes))
+        self.sleep_mock.assert_called_once()
+
+        metrics = self.command_publisher.metrics
+        self.assertEqual(3, metrics.records)
+        self.assertEqual(2, metrics.put_calls)
+        self.assertEqual(2, metrics.retried_records)
+        self.assertEqual(1, metrics.throttled_records)
+        self.assertEqual(0, metrics.failed_records)
+
+    def test_raises_when_retries_are_exhausted(self):
+        self.errors = {"0": ["ProvisionedThroughputExceededException"] * 5}
+        with self.assertRaises(CommandPublishError) as context:
+            self.command_publisher._publish_commands(self._commands(4, 2))
+        # the second chunk isn't published before the first. A single record is retried on its own.
+        self.assertEqual(1, self.put_records_mock.call_count)
+        self.assertEqual(4, self.put_record_mock.call_count)
+        self.assertEqual(
+            [False, True, False, False],
+            [outcome.published for outcome in context.exception.outcomes],
+        )
+        self.assertEqual(1, self.command_publisher.metrics.failed_records)
+
+    @patch.dict(os.environ, {"AGGREGATE_KINESIS_RECORDS": "true"})
+    def test_never_aggregates_commands(self):
+        self.command_publisher._publish_commands(self._commands(3, 3))
+        self.assertEqual(3, len(self.put_records_mock.call_args[1]["Records"]))
+
+    def test_orders_commands_after_the_last_published_sequence_number(self):
+        self.command_publisher.publish_start_drill_command("123456789", "slug")
+        self.assertNotIn("SequenceNumberForOrdering", self.put_record_mock.call_args[1])
+        self.command_publisher.publish_process_sms_command("123456789", "lol", {"foo": "bar"})
+        self.assertEqual("1", self.put_record_mock.call_args[1]["SequenceNumberForOrdering"])
+
+    def test_only_records_sequence_numbers_of_single_commands(self):
+        self.sequence_numbers.table.table_name = "command-sequence-numbers-test"
+        self.sequence_numbers.table.dynamodb = MagicMock()
+        self.command_publisher._publish_commands(self._commands(2, 2))
+        self.sequence_numbers.table.dynamodb.put_item.assert_not_called()
+        self.assertIsNone(self.sequence_numbers.get("1"))
+
+        self.command_publisher.publish_start_drill_command("1", "slug")
+        self.sequence_numbers.table.dynamodb.put_item.assert_called_once()
+        self.assertEqual("3", self.sequence_numbers.get("1"))
+
+    def test_retries_single_commands(self):
+        self.errors = {"123456789": ["ProvisionedThroughputExceededException"]}
+        outcomes = self.command_publisher.publish_start_drill_command("123456789", "slug")
+        self.assertEqual(2, self.put_record_mock.call_count)
+        self.assertTrue(outcomes[0].published)
+        self.assertEqual(1, self.command_publisher.metrics.throttled_records)
+
+
+class TestSequenceNumberStore(unittest.TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        self.store = SequenceNumberStore()
+        self.store.table.table_name = "command-sequence-numbers-test"
+        self.store.table.dynamodb = MagicMock()
+
+    def test_reads_each_phone_number_once(self):
+        self.store.table.dynamodb.get_item.return_value = {}
+        self.assertIsNone(self.store.get("123"))
+        self.assertIsNone(self.store.get("123"))
+        self.store.table.dynamodb.get_item.assert_called_once()
+
+        self.store.put("123", "42")
+        self.assertEqual("42", self.store.get("123"))
+        self.store.table.dynamodb.get_item.assert_called_once()
+
+    def test_shares_sequence_numbers(self):
+        self.store.put("123", "42")
+        item = self.store.table.dynamodb.put_item.call_args[1]["Item"]
+        other_store = SequenceNumberStore()
+        other_store.table.table_name = self.store.table.table_name
+        other_store.table.dynamodb = MagicMock()
+        other_store.table.dynamodb.get_item.return_value = {"Item": item}
+        self.assertEqual("42", other_store.get("123"))
+
+        item["expiration_ts"] = {"N": "0"}
+        other_store.table.cache.clear()
+        self.assertIsNone(other_store.get("123"))
+
+
+class TestBufferedCommandPublisher(FakeKinesisTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.command_publisher = BufferedCommandPublisher(max_buffer_seconds=60)
+
+    def test_publish_start_drill(self):
+        self.command_publisher.publish_start_drill_command("123456789", "slug")
+        self.command_publisher.flush()
+        self.put_record_mock.assert_called_once()
+
+    def test_buffers_commands_until_flushed(self):
+        outcomes = [
+            self.command_publisher.publish_start_drill_command(str(i), "slug")[0] for i in range(3)
+        ]
+        self.assertFalse(any(outcome.published for outcome in outcomes))
+        self.assertEqual(outcomes, self.command_publisher.flush())
+        self.assertTrue(all(outcome.published for outcome in outcomes))
+        self.put_records_mock.assert_called_once()
+        self.assertEqual(3, len(self.put_records_mock.call_args[1]["Records"]))
+        self.assertEqual([], self.command_publisher.flush())
+
+    def test_publishes_in_the_background_at_the_size_threshold(self):
+        self.command_publisher.max_buffered_commands = 2
+        for i in range(5):
+            self.command_publisher.publish_start_drill_command(str(i), "slug")
+        outcomes = self.command_publisher.flush()
+        self.assertEqual(5, len(outcomes))
+        self.assertEqual(2, self.put_records_mock.call_count)
+        self.assertEqual(1, self.put_record_mock.call_count)
+
+    def test_publishes_in_the_background_at_the_time_threshold(self):
+        self.command_publisher.max_buffer_seconds = 0
+        for i in range(3):
+            self.command_publisher.publish_start_drill_command(str(i), "slug")
+        self.command_publisher.flush()
+        self.assertEqual(3, self.put_record_mock.call_count)
+
+    def test_batches_after_a_failure_are_not_published(self):
+        self.command_publisher.max_buffered_commands = 1
+        self.errors = {"1": [THROTTLED_ERROR_CODE] * MAX_PUT_ATTEMPTS}
+        self.command_publisher.publish_start_drill_command("1", "slug")
+        self.command_publisher.publish_start_drill_command("1", "other-slug")
+        with self.assertRaises(CommandPublishError) as context:
+            self.command_publisher.flush()
+        self.assertEqual(
+            [False, False], [outcome.published for outcome in context.exception.outcomes]
+        )
+        self.assertEqual(MAX_PUT_ATTEMPTS, self.put_record_mock.call_count)
+
+        # the next flush starts afresh
+        self.command_publisher.publish_start_drill_command("1", "slug")
+        self.assertTrue(self.command_publisher.flush()[0].published)
+
+    def test_flushes_on_exit(self):
+        with self.command_publisher as publisher:
+            outcomes = publisher.publish_start_drill_command("123456789", "slug")
+        self.assertTrue(outcomes[0].published)
+
+
+class TestInboundSMSPayload(unittest.TestCase):
+    def test_round_trip(self):
+        twilio_webhook = {"From": "+15551234567", "Body": "hi", "MessageSid": "SM123"}
+        payload = make_inbound_sms_payload("+15551234567", "hi", twilio_webhook)
+        self.assertEqual({"From", "Body", "twilio_webhook_z"}, set(payload.keys()))
+        self.assertEqual(twilio_webhook, get_twilio_webhook(json.loads(json.dumps(payload))))
+
+    def test_uncompressed_payload(self):
+        twilio_webhook = {"From": "+15551234567", "Body": "hi", "MessageSid": "SM123"}
+        payload = {"From": "+15551234567", "Body": "hi", "twilio_webhook": twilio_webhook}
+        self.assertEqual(twilio_webhook, get_twilio_webhook(payload))
@@ -2,6 +2,8 @@ import datetime
 import unittest
 import uuid
 
+from marshmallow import ValidationError
+
 from stopcovid.dialog.models.events import (
     UserValidated,
     UserValidationFailed,
@@ -15,11 +17,16 @@ from stopcovid.dialog.models.events import (
     DialogEvent,
     event_from_dict,
     ReminderTriggered,
+    DialogEventBatch,
+    batch_from_dict,
+    batch_from_dynamodb_image,
+    DialogEventType,
 )
 from stopcovid.dialog.models.state import UserProfile, DialogState, PromptState
 from stopcovid.dialog.registration import CodeValidationPayload
 
 from stopcovid.drills.drills import Prompt, PromptMessage, Drill
+from stopcovid.utils import dynamodb as dynamodb_utils
 
 DRILL = Drill(
     name="test-drill",
@@ -424,3 +431,100 @@ class TestSerialization(unittest.TestCase):
         serialized = original.to_dict()
         deserialized = event_from_dict(serialized)
         self._make_base_assertions(original, deserialized)
+
+
+class TestCodecs(unittest.TestCase):
+    # to_dict() and event_from_dict() don't use marshmallow. Make sure they agree with the schemas.
+
+    def setUp(self) -> None:
+        self.prompt = Prompt(
+            slug="my-prompt",
+            messages=[
+                PromptMessage(text="one", media_url="http://giphy.com/puppies/1"),
+                PromptMessage(text="two"),
+            ],
+            response_user_profile_key="self_rating_1",
+            correct_response="{{response1}}",
+        )
+        user_profile = UserProfile(
+            True,
+            name="Mario",
+            language="en",
+            account_info={"employer_id": "1", "unit_id": 2, "employer_name": "Acme"},
+            self_rating_1="7",
+        )
+        drill_instance_id = uuid.uuid4()
+        self.events = [
+            DrillStarted("123456789", user_profile, DRILL, self.prompt),
+            ReminderTriggered("123456789", user_profile),
+            UserValidated(
+                "123456789",
+                user_profile,
+                CodeValidationPayload(valid=True, is_demo=True, account_info={"company": "Acme"}),
+            ),
+            UserValidationFailed("123456789", user_profile),
+            CompletedPrompt("123456789", user_profile, self.prompt, drill_instance_id, "a"),
+            FailedPrompt("123456789", user_profile, self.prompt, drill_instance_id, "b", False),
+            AdvancedToNextPrompt("123456789", user_profile, self.prompt, drill_instance_id),
+            DrillCompleted("123456789", user_profile, drill_instance_id),
+            OptedOut("123456789", user_profile, drill_instance_id),
+            OptedOut("123456789", user_profile, None),
+            NextDrillRequested("123456789", user_profile),
+        ]
+
+    def test_to_dict_matches_schema(self):
+        for event in self.events:
+            self.assertEqual(event.schema.dump(event), event.to_dict(), event.event_type)
+
+    def test_from_dict_matches_schema(self):
+        for event in self.events:
+            serialized = event.to_dict()
+            self.assertEqual(
+                vars(event.schema.load(serialized)),
+                vars(event_from_dict(serialized)),
+                event.event_type,
+            )
+
+    def test_invalid_event_is_validated_by_schema(self):
+        serialized = self.events[0].to_dict()
+        del serialized["drill_instance_id"]
+        with self.assertRaises(ValidationError):
+            event_from_dict(serialized)
+
+    def test_batch_round_trip(self):
+        batch = DialogEventBatch(events=self.events, phone_number="123456789", seq="12")
+        deserialized = batch_from_dict(batch.to_dict())
+        self.assertEqual(batch.batch_id, deserialized.batch_id)
+        self.assertEqual(batch.created_time, deserialized.created_time)
+        self.assertEqual([vars(e) for e in batch.events], [vars(e) for e in deserialized.events])
+
+    def test_batch_from_dynamodb_image(self):
+        batch = DialogEventBatch(events=self.events, phone_number="123456789", seq="12")
+        image = dynamodb_utils.serialize(batch.to_dict())
+
+        deserialized = batch_from_dynamodb_image(image)
+        self.assertEqual(batch.batch_id, deserialized.batch_id)
+        self.assertEqual(batch.seq, deserialized.seq)
+        self.assertEqual(batch.created_time, deserialized.created_time)
+        self.assertEqual([vars(e) for e in batch.events], [vars(e) for e in deserialized.events])
+
+        filtered = batch_from_dynamodb_image(
+            image, {DialogEventType.DRILL_STARTED, DialogEventType.OPTED_OUT}
+        )
+        self.assertEqual(
+            [self.events[0].event_id, self.events[8].event_id, self.events[9].event_id],
+            [event.event_id for event in filtered.events],
+        )
+
+    def test_batch_from_compressed_dynamodb_image(self):
+        batch = DialogEventBatch(events=self.events, phone_number="123456789", seq="12")
+        image = dynamodb_utils.serialize_compressed(
+            batch.to_dict(), ("phone_number", "batch_id", "created_time", "seq")
+        )
+
+        deserialized = batch_from_dynamodb_image(image)
+        self.assertEqual(batch.batch_id, deserialized.batch_id)
+        self.assertEqual([vars(e) for e in batch.events], [vars(e) for e in deserialized.events])
+
+        filtered = batch_from_dynamodb_image(image, {DialogEventType.DRILL_STARTED})
+        self.assertEqual([self.events[0].event_id], [event.event_id for event in filtered.events])
@@ -4,7 +4,14 @@ import unittest
 import uuid
 from unittest.mock import MagicMock, patch, Mock
 
-from stopcovid.dialog.engine import process_command, ProcessSMSMessage, StartDrill, TriggerReminder
+from stopcovid.dialog.engine import (
+    MAX_PROCESSING_ATTEMPTS,
+    process_command,
+    process_commands_for_phone_number,
+    ProcessSMSMessage,
+    StartDrill,
+    TriggerReminder,
+)
 from stopcovid.dialog.models.events import (
     DialogEventBatch,
     DialogEventType,
@@ -14,9 +21,10 @@ from stopcovid.dialog.models.events import (
     FailedPrompt,
     DrillCompleted,
 )
-from stopcovid.dialog.models.state import DialogState, PromptState
+from stopcovid.dialog.models.state import DialogState, PromptState, UserProfile
+from stopcovid.dialog.persistence import DialogStateConflict
 
-from stopcovid.dialog.registration import CodeValidationPayload
+from stopcovid.dialog.registration import CodeValidationPayload, DemoCodeFilter
 from stopcovid.drills.drills import Drill, Prompt, PromptMessage
 
 DRILL = Drill(
@@ -95,6 +103,103 @@ class TestProcessCommand(unittest.TestCase):
         process_command(command, "0", repo=self.repo)
         self.assertFalse(command.execute.called)
 
+    def test_process_several_commands_with_one_fetch_and_persist(self, get_drill_mock):
+        self.dialog_state.user_profile.validated = True
+        process_commands_for_phone_number(
+            self.phone_number,
+            [
+                (ProcessSMSMessage(self.phone_number, "go"), "3"),
+                (StartDrill(self.phone_number, self.drill.slug), "2"),
+            ],
+            repo=self.repo,
+        )
+        self.repo.fetch_dialog_state.assert_called_once()
+        self.repo.persist_dialog_state.assert_called_once()
+        batch = self.repo.persist_dialog_state.call_args[0][0]
+        self.assertEqual("3", batch.seq)
+        self.assertEqual("3", self.dialog_state.seq)
+        self._assert_event_types(
+            batch,
+            DialogEventType.DRILL_STARTED,
+            DialogEventType.COMPLETED_PROMPT,
+            DialogEventType.ADVANCED_TO_NEXT_PROMPT,
+        )
+
+    def test_process_several_commands_skips_processed_sequence_numbers(self, get_drill_mock):
+        self.dialog_state.user_profile.validated = True
+        self.dialog_state.seq = "2"
+        start_drill = Mock(wraps=StartDrill(self.phone_number, self.drill.slug))
+        process_commands_for_phone_number(
+            self.phone_number,
+            [(start_drill, "2"), (ProcessSMSMessage(self.phone_number, "more"), "3")],
+            repo=self.repo,
+        )
+        self.assertFalse(start_drill.execute.called)
+        batch = self.repo.persist_dialog_state.call_args[0][0]
+        self._assert_event_types(batch, DialogEventType.NEXT_DRILL_REQUESTED)
+
+    def test_refetch_and_retry_on_conflict(self, get_drill_mock):
+        self.repo.fetch_dialog_state.side_effect = lambda phone_number, **kwargs: DialogState(
+            phone_number=phone_number, seq="0", user_profile=UserProfile(validated=True)
+        )
+        self.repo.persist_dialog_state.side_effect = [DialogStateConflict(self.phone_number), None]
+        process_command(StartDrill(self.phone_number, self.drill.slug), "1", repo=self.repo)
+        self.assertEqual(2, self.repo.fetch_dialog_state.call_count)
+        self.assertEqual(
+            [False, True],
+            [c[1]["consistent_read"] for c in self.repo.fetch_dialog_state.call_args_list],
+        )
+        self.assertEqual(2, self.repo.persist_dialog_state.call_count)
+        self.assertEqual("0", self.repo.persist_dialog_state.call_args[1]["previous_seq"])
+
+    def test_prefetched_state_is_used_on_first_attempt(self, get_drill_mock):
+        self.repo.fetch_dialog_state.side_effect = lambda phone_number, **kwargs: DialogState(
+            phone_number=phone_number, seq="0", user_profile=UserProfile(validated=True)
+        )
+        self.repo.persist_dialog_state.side_effect = [DialogStateConflict(self.phone_number), None]
+        prefetched = DialogState(
+            phone_number=self.phone_number, seq="0", user_profile=UserProfile(validated=True)
+        )
+        process_commands_for_phone_number(
+            self.phone_number,
+            [(StartDrill(self.phone_number, self.drill.slug), "1")],
+            repo=self.repo,
+            dialog_state=prefetched,
+        )
+        self.assertIs(prefetched, self.repo.persist_dialog_state.call_args_list[0][0][1])
+        self.repo.fetch_dialog_state.assert_called_once_with(
+            self.phone_number, consistent_read=True
+        )
+
+    def test_give_up_after_repeated_conflicts(self, get_drill_mock):
+        self.repo.fetch_dialog_state.side_effect = lambda phone_number, **kwargs: DialogState(
+            phone_number=phone_number, seq="0", user_profile=UserProfile(validated=True)
+        )
+        self.repo.persist_dialog_state.side_effect = DialogStateConflict(self.phone_number)
+        with self.assertRaises(DialogStateConflict):
+            process_command(StartDrill(self.phone_number, self.drill.slug), "1", repo=self.repo)
+        self.assertEqual(MAX_PROCESSING_ATTEMPTS, self.repo.persist_dialog_state.call_count)
+
+    def test_events_keep_a_snapshot_of_the_user_profile(self, get_drill_mock):
+        self.dialog_state.user_profile.validated = True
+        self.dialog_state.user_profile.opted_out = True
+        process_commands_for_phone_number(
+            self.phone_number,
+            [
+                (ProcessSMSMessage(self.phone_number, "start"), "1"),
+                (ProcessSMSMessage(self.phone_number, "stop"), "2"),
+            ],
+            repo=self.repo,
+        )
+        batch = self.repo.persist_dialog_state.call_args[0][0]
+        self._assert_event_types(
+            batch, DialogEventType.NEXT_DRILL_REQUESTED, DialogEventType.OPTED_OUT
+        )
+        self.assertFalse(batch.events[0].user_profile.opted_out)
+        self.assertTrue(batch.events[1].user_profile.opted_out)
+        self.assertIsNot(self.dialog_state.user_profile, batch.events[1].user_profile)
+        self.assertEqual(self.dialog_state.user_profile, batch.events[1].user_profile)
+
     def test_advance_sequence_numbers(self, get_drill_mock):
         validator = MagicMock()
         validation_payload = CodeValidationPayload(valid=True, account_info={"company": "WeWork"})
@@ -160,6 +265,34 @@ class TestProcessCommand(unittest.TestCase):
             batch, DialogEventType.COMPLETED_PROMPT, DialogEventType.ADVANCED_TO_NEXT_PROMPT
         )
 
+    def test_demo_user_responses_skip_validation(self, get_drill_mock):
+        validator = MagicMock()
+        validator.validate_code = MagicMock(
+            return_value=CodeValidationPayload(valid=True, is_demo=True)
+        )
+        demo_code_filter = DemoCodeFilter()
+        command = ProcessSMSMessage(
+            self.phone_number,
+            "demo-code",
+            registration_validator=validator,
+            demo_code_filter=demo_code_filter,
+        )
+        self._process_command(command)
+        self._process_command(StartDrill(self.phone_number, self.drill.slug))
+
+        validator.validate_code.reset_mock()
+        command = ProcessSMSMessage(
+            self.phone_number,
+            "a",
+            registration_validator=validator,
+            demo_code_filter=demo_code_filter,
+        )
+        batch = self._process_command(command)
+        validator.validate_code.assert_not_called()
+        self._assert_event_types(
+            batch, DialogEventType.COMPLETED_PROMPT, DialogEventType.ADVANCED_TO_NEXT_PROMPT
+        )
+
     def test_first_message_does_not_validate_user(self, get_drill_mock):
         validator = MagicMock()
         validation_payload = CodeValidationPayload(valid=False)
@@ -348,7 +481,7 @@ class TestProcessCommand(unittest.TestCase):
         self._set_current_prompt(2, should_advance=True)
         command = TriggerReminder(
             phone_number=self.phone_number,
-            drill_instance_id=self.dialog_state.drill_instance_id,  # type:ignore
+            drill_instance_id=self.dialog_state.drill_instance_id,  # type: ignore
             prompt_slug=self.drill.prompts[2].slug,
         )
         batch = self._process_command(command)
@@ -361,7 +494,7 @@ class TestProcessCommand(unittest.TestCase):
         self._set_current_prompt(2, should_advance=True)
         command = TriggerReminder(
             phone_number=self.phone_number,
-            drill_instance_id=self.dialog_state.drill_instance_id,  # type:ignore
+            drill_instance_id=self.dialog_state.drill_instance_id,  # type: ignore
             prompt_slug=self.drill.prompts[2].slug,
         )
         batch = self._process_command(command)
@@ -373,7 +506,7 @@ class TestProcessCommand(unittest.TestCase):
         self._set_current_prompt(2, should_advance=True)
         command = TriggerReminder(
             phone_number=self.phone_number,
-            drill_instance_id=self.dialog_state.drill_instance_id,  # type:ignore
+            drill_instance_id=self.dialog_state.drill_instance_id,  # type: ignore
             prompt_slug=self.drill.prompts[2].slug,
         )
         batch = self._process_command(command)
@@ -385,7 +518,7 @@ class TestProcessCommand(unittest.TestCase):
         self.dialog_state.current_prompt_state.reminder_triggered = True
         command = TriggerReminder(
             phone_number=self.phone_number,
-            drill_instance_id=self.dialog_state.drill_instance_id,  # type:ignore
+            drill_instance_id=self.dialog_state.drill_instance_id,  # type: ignore
             prompt_slug=self.drill.prompts[2].slug,
         )
         batch = self._process_command(command)
@@ -398,7 +531,7 @@ class TestProcessCommand(unittest.TestCase):
         self._set_current_prompt(3, should_advance=True)
         command = TriggerReminder(
             phone_number=self.phone_number,
-            drill_instance_id=self.dialog_state.drill_instance_id,  # type:ignore
+            drill_instance_id=self.dialog_state.drill_instance_id,  # type: ignore
             prompt_slug=self.drill.prompts[2].slug,
         )
         batch = self._process_command(command)
@@ -1,10 +1,39 @@
+import datetime
 import unittest
 import uuid
+from unittest.mock import patch, MagicMock
 
-from stopcovid.dialog.models.events import CompletedPrompt, AdvancedToNextPrompt, DialogEventBatch
-from stopcovid.dialog.persistence import DynamoDBDialogRepository
-from stopcovid.dialog.models.state import DialogState, UserProfile
-from stopcovid.drills.drills import Prompt, PromptMessage
+from stopcovid.dialog.models.events import (
+    CompletedPrompt,
+    AdvancedToNextPrompt,
+    DialogEventBatch,
+    DrillStarted,
+    FailedPrompt,
+    NextDrillRequested,
+)
+from stopcovid.dialog.persistence import (
+    DynamoDBDialogRepository,
+    DialogStateConflict,
+    MAX_BATCH_GET_ATTEMPTS,
+    DialogStateWrite,
+)
+from stopcovid.dialog.models.state import (
+    DialogState,
+    UserProfile,
+    PromptState,
+    DialogStateSchema,
+)
+from stopcovid.drills.drills import Prompt, PromptMessage, Drill
+from stopcovid.utils import dynamodb as dynamodb_utils
+
+DRILL = Drill(
+    slug="test-drill",
+    name="test drill",
+    prompts=[
+        Prompt(slug="one", messages=[PromptMessage(text="one")], correct_response="a"),
+        Prompt(slug="two", messages=[PromptMessage(text="two")]),
+    ],
+)
 
 
 class TestPersistence(unittest.TestCase):
@@ -64,3 +93,333 @@ class TestPersistence(unittest.TestCase):
 
         event2_retrieved = batch_retrieved.events[1]
         self.assertEqual(event2.prompt.slug, event2_retrieved.prompt.slug)  # type: ignore
+
+    def _persist_new_state(self, seq: str, previous_seq=None) -> DialogState:
+        dialog_state = DialogState(self.phone_number, seq, user_profile=UserProfile(validated=True))
+        event = AdvancedToNextPrompt(
+            phone_number=self.phone_number,
+            user_profile=UserProfile(True),
+            prompt=Prompt(slug="one", messages=[PromptMessage(text="one")]),
+            drill_instance_id=uuid.uuid4(),
+        )
+        batch = DialogEventBatch(phone_number=self.phone_number, events=[event], seq=seq)
+        self.repo.persist_dialog_state(batch, dialog_state, previous_seq=previous_seq)
+        return dialog_state
+
+    def test_fetch_persisted_state_from_cache(self):
+        dialog_state = self._persist_new_state("100")
+        with patch.object(self.repo.dynamodb, "get_item") as get_item_mock:
+            self.assertIs(dialog_state, self.repo.fetch_dialog_state(self.phone_number))
+            self.assertFalse(get_item_mock.called)
+
+        # the cached state is handed out once. It returns to the cache once it is persisted again
+        self.assertIsNot(dialog_state, self.repo.fetch_dialog_state(self.phone_number))
+
+    def test_conditional_write_on_seq(self):
+        self._persist_new_state("100")
+        self._persist_new_state("200", previous_seq="100")
+        with self.assertRaises(DialogStateConflict):
+            self._persist_new_state("300", previous_seq="100")
+        self.assertEqual("200", self.repo.fetch_dialog_state(self.phone_number).seq)
+
+    def test_stale_cache_entry_does_not_overwrite_newer_state(self):
+        self._persist_new_state("100")
+        other_container_repo = DynamoDBDialogRepository(
+            region_name="us-west-2",
+            endpoint_url="http://localhost:9000",
+            aws_access_key_id="fake-key",
+            aws_secret_access_key="fake-secret",
+        )
+        other_state = other_container_repo.fetch_dialog_state(self.phone_number)
+        self.assertEqual("100", other_state.seq)
+        self._persist_new_state("200", previous_seq="100")
+
+        with self.assertRaises(DialogStateConflict):
+            self._persist_new_state("300", previous_seq=other_state.seq)
+
+    def test_delta_update(self):
+        self._persist_new_state("100")
+        dialog_state = self.repo.fetch_dialog_state(self.phone_number)
+        started = DrillStarted(
+            phone_number=self.phone_number,
+            user_profile=dialog_state.user_profile,
+            drill=DRILL,
+            first_prompt=DRILL.first_prompt(),
+        )
+        started.apply_to(dialog_state)
+        dialog_state.seq = "200"
+        self.repo.persist_dialog_state(
+            DialogEventBatch(phone_number=self.phone_number, events=[started], seq="200"),
+            dialog_state,
+            previous_seq="100",
+        )
+
+        dialog_state = self.repo.fetch_dialog_state(self.phone_number)
+        failed = FailedPrompt(
+            phone_number=self.phone_number,
+            user_profile=dialog_state.user_profile,
+            prompt=DRILL.first_prompt(),
+            drill_instance_id=dialog_state.drill_instance_id,
+            response="b",
+            abandoned=False,
+        )
+        failed.apply_to(dialog_state)
+        dialog_state.seq = "300"
+        self.repo.persist_dialog_state(
+            DialogEventBatch(phone_number=self.phone_number, events=[failed], seq="300"),
+            dialog_state,
+            previous_seq="200",
+        )
+
+        self.repo.state_cache.clear()
+        persisted = self.repo.fetch_dialog_state(self.phone_number, consistent_read=True)
+        self.assertEqual("300", persisted.seq)
+        self.assertEqual(DRILL, persisted.current_drill)
+        self.assertEqual(started.drill_instance_id, persisted.drill_instance_id)
+        self.assertEqual(1, persisted.current_prompt_state.failures)
+
+
+class TestStateWrites(unittest.TestCase):
+    def setUp(self):
+        self.repo = DynamoDBDialogRepository(
+            region_name="us-west-2", aws_access_key_id="fake-key", aws_secret_access_key="fake"
+        )
+        self.repo.dynamodb = MagicMock()
+        self.phone_number = "123456789"
+        self.now = datetime.datetime.now(datetime.timezone.utc)
+        self.dialog_state = DialogState(
+            self.phone_number,
+            "200",
+            user_profile=UserProfile(validated=True),
+            current_drill=DRILL,
+            drill_instance_id=uuid.uuid4(),
+            current_prompt_state=PromptState(slug="one", start_time=self.now),
+        )
+
+    def _persist(self, event, previous_seq="100"):
+        event.apply_to(self.dialog_state)
+        batch = DialogEventBatch(phone_number=self.phone_number, events=[event], seq="200")
+        self.repo.persist_dialog_state(batch, self.dialog_state, previous_seq=previous_seq)
+        return self.repo.dynamodb.transact_write_items.call_args[1]["TransactItems"][1]
+
+    def _failed_prompt(self, abandoned: bool):
+        return FailedPrompt(
+            phone_number=self.phone_number,
+            user_profile=self.dialog_state.user_profile,
+            prompt=DRILL.first_prompt(),
+            drill_instance_id=self.dialog_state.drill_instance_id,
+            response="b",
+            abandoned=abandoned,
+        )
+
+    def test_new_drill_is_a_full_put(self):
+        write = self._persist(
+            DrillStarted(
+                phone_number=self.phone_number,
+                user_profile=self.dialog_state.user_profile,
+                drill=DRILL,
+                first_prompt=DRILL.first_prompt(),
+            )
+        )
+        self.assertIn("current_drill", write["Put"]["Item"])
+        self.assertEqual({":previous_seq": {"S": "100"}}, write["Put"]["ExpressionAttributeValues"])
+
+    def test_new_state_is_a_full_put(self):
+        write = self._persist(self._failed_prompt(abandoned=False), previous_seq="0")
+        self.assertIn("Put", write)
+
+    def test_small_change_is_an_update(self):
+        write = self._persist(self._failed_prompt(abandoned=False))
+        update = write["Update"]
+        self.assertEqual({"phone_number": {"S": self.phone_number}}, update["Key"])
+        self.assertEqual("#seq = :previous_seq", update["ConditionExpression"])
+        self.assertEqual(
+            {"current_prompt_state", "schema_version", "seq"},
+            set(update["ExpressionAttributeNames"].values()),
+        )
+        self.assertEqual({"S": "200"}, update["ExpressionAttributeValues"][":seq"])
+        prompt_state = next(
+            value["M"]
+            for value in update["ExpressionAttributeValues"].values()
+            if "M" in value and "failures" in value["M"]
+        )
+        self.assertEqual({"N": "1"}, prompt_state["failures"])
+
+    def test_cleared_attributes_are_set_to_null(self):
+        write = self._persist(self._failed_prompt(abandoned=True))
+        update = write["Update"]
+        self.assertNotIn("REMOVE", update["UpdateExpression"])
+        name = next(
+            name
+            for name, attribute in update["ExpressionAttributeNames"].items()
+            if attribute == "current_prompt_state"
+        )
+        self.assertIn(f"{name} = :{name[1:]}", update["UpdateExpression"])
+        self.assertEqual({"NULL": True}, update["ExpressionAttributeValues"][f":{name[1:]}"])
+
+    def test_compressed_items(self):
+        self.repo.compress_items = True
+        write = self._persist(
+            DrillStarted(
+                phone_number=self.phone_number,
+                user_profile=self.dialog_state.user_profile,
+                drill=DRILL,
+                first_prompt=DRILL.first_prompt(),
+            )
+        )
+        state_item = write["Put"]["Item"]
+        self.assertEqual({"phone_number", "seq", "payload", "payload_format"}, set(state_item))
+        self.assertEqual(
+            self.dialog_state,
+            DialogStateSchema().load(dynamodb_utils.deserialize_item(state_item)),
+        )
+
+        batch_item = self.repo.dynamodb.transact_write_items.call_args[1]["TransactItems"][0][
+            "Put"
+        ]["Item"]
+        self.assertEqual(
+            {"phone_number", "batch_id", "created_time", "seq", "payload", "payload_format"},
+            set(batch_item),
+        )
+        self.repo.dynamodb.get_item.return_value = {"Item": batch_item}
+        batch = self.repo.fetch_dialog_event_batch(
+            self.phone_number, uuid.UUID(batch_item["batch_id"]["S"])
+        )
+        self.assertEqual(DRILL, batch.events[0].drill)
+
+
+class TestBatchFetch(unittest.TestCase):
+    def setUp(self):
+        self.repo = DynamoDBDialogRepository(
+            region_name="us-west-2", aws_access_key_id="fake-key", aws_secret_access_key="fake"
+        )
+        self.repo.dynamodb = MagicMock()
+        self.table_name = self.repo.state_table_name()
+        self.sleep_patcher = patch("stopcovid.dialog.persistence.time.sleep")
+        self.sleep_patcher.start()
+
+    def tearDown(self):
+        self.sleep_patcher.stop()
+
+    def _item(self, phone_number: str, seq: str = "12"):
+        return dynamodb_utils.serialize(DialogState(phone_number, seq).to_dict())
+
+    def _keys(self, call):
+        return [
+            key["phone_number"]["S"] for key in call[1]["RequestItems"][self.table_name]["Keys"]
+        ]
+
+    def test_chunks_of_100(self):
+        phone_numbers = [str(i) for i in range(250)]
+        self.repo.dynamodb.batch_get_item.side_effect = lambda RequestItems: {
+            "Responses": {
+                self.table_name: [
+                    self._item(key["phone_number"]["S"])
+                    for key in RequestItems[self.table_name]["Keys"]
+                ]
+            }
+        }
+        states = self.repo.fetch_dialog_states(phone_numbers)
+        self.assertEqual(
+            [100, 100, 50],
+            [len(self._keys(call)) for call in self.repo.dynamodb.batch_get_item.call_args_list],
+        )
+        self.assertEqual(set(phone_numbers), set(states.keys()))
+        self.assertEqual("12", states["42"].seq)
+
+    def test_cached_and_new_states(self):
+        cached = DialogState("cached", "7")
+        self.repo.state_cache.put("cached", cached)
+        self.repo.dynamodb.batch_get_item.return_value = {
+            "Responses": {self.table_name: [self._item("existing")]}
+        }
+        states = self.repo.fetch_dialog_states(["cached", "existing", "new"])
+        self.assertEqual(
+            ["existing", "new"], sorted(self._keys(self.repo.dynamodb.batch_get_item.call_args))
+        )
+        self.assertIs(cached, states["cached"])
+        self.assertEqual("12", states["existing"].seq)
+        self.assertEqual("0", states["new"].seq)
+
+    def test_retries_unprocessed_keys(self):
+        unprocessed = {self.table_name: {"Keys": [{"phone_number": {"S": "2"}}]}}
+        self.repo.dynamodb.batch_get_item.side_effect = [
+            {"Responses": {self.table_name: [self._item("1")]}, "UnprocessedKeys": unprocessed},
+            {"Responses": {self.table_name: [self._item("2")]}, "UnprocessedKeys": {}},
+        ]
+        states = self.repo.fetch_dialog_states(["1", "2"])
+        self.assertEqual(["2"], self._keys(self.repo.dynamodb.batch_get_item.call_args))
+        self.assertEqual({"1": "12", "2": "12"}, {k: v.seq for k, v in states.items()})
+
+    def test_leaves_out_keys_that_stay_unprocessed(self):
+        unprocessed = {self.table_name: {"Keys": [{"phone_number": {"S": "2"}}]}}
+        self.repo.dynamodb.batch_get_item.return_value = {
+            "Responses": {},
+            "UnprocessedKeys": unprocessed,
+        }
+        states = self.repo.fetch_dialog_states(["2"])
+        self.assertEqual({}, states)
+        self.assertEqual(MAX_BATCH_GET_ATTEMPTS, self.repo.dynamodb.batch_get_item.call_count)
+
+
+class ConditionalCheckFailed(Exception):
+    def __str__(self):
+        return "Transaction cancelled [ConditionalCheckFailed, None]"
+
+
+class TestBatchPersist(unittest.TestCase):
+    def setUp(self):
+        self.repo = DynamoDBDialogRepository(
+            region_name="us-west-2", aws_access_key_id="fake-key", aws_secret_access_key="fake"
+        )
+        self.repo.dynamodb = MagicMock()
+        self.repo.dynamodb.exceptions.TransactionCanceledException = ConditionalCheckFailed
+
+    def _write(self, phone_number: str) -> DialogStateWrite:
+        dialog_state = DialogState(phone_number, "2", user_profile=UserProfile(validated=True))
+        event = NextDrillRequested(phone_number, dialog_state.user_profile)
+        batch = DialogEventBatch(phone_number=phone_number, events=[event], seq="2")
+        return DialogStateWrite(batch, dialog_state, previous_seq="1")
+
+    def _phone_numbers(self, call):
+        return {
+            item["Update"]["Key"]["phone_number"]["S"]
+            for item in call[1]["TransactItems"]
+            if "Update" in item
+        }
+
+    def test_packs_writes_into_transactions(self):
+        writes = [self._write(str(i)) for i in range(120)]
+        failures = self.repo.persist_dialog_states(writes)
+        self.assertEqual({}, failures)
+        calls = self.repo.dynamodb.transact_write_items.call_args_list
+        self.assertEqual([100, 100, 40], [len(call[1]["TransactItems"]) for call in calls])
+        self.assertEqual({str(i) for i in range(50)}, self._phone_numbers(calls[0]))
+        self.assertIs(writes[7].dialog_state, self.repo.state_cache.get("7"))
+
+    def test_falls_back_to_one_phone_number_at_a_time(self):
+        def transact_write_items(TransactItems):
+            if "2" in self._phone_numbers(((), {"TransactItems": TransactItems})):
+                raise ConditionalCheckFailed()
+
+        self.repo.dynamodb.transact_write_items.side_effect = transact_write_items
+        failures = self.repo.persist_dialog_states([self._write(str(i)) for i in range(4)])
+        self.assertEqual(["2"], list(failures.keys()))
+        self.assertIsInstance(failures["2"], DialogStateConflict)
+        self.assertEqual(5, self.repo.dynamodb.transact_write_items.call_count)
+        self.assertIsNotNone(self.repo.state_cache.get("3"))
+        self.assertIsNone(self.repo.state_cache.get("2"))
+
+    def test_falls_back_on_any_transaction_failure(self):
+        def transact_write_items(TransactItems):
+            phone_numbers = self._phone_numbers(((), {"TransactItems": TransactItems}))
+            if len(phone_numbers) > 1:
+                raise Exception("Transaction cancelled [TransactionConflict, None]")
+            if "2" in phone_numbers:
+                raise ValueError("Item size has exceeded the maximum allowed size")
+
+        self.repo.dynamodb.transact_write_items.side_effect = transact_write_items
+        failures = self.repo.persist_dialog_states([self._write(str(i)) for i in range(4)])
+        self.assertEqual(["2"], list(failures.keys()))
+        self.assertIsInstance(failures["2"], ValueError)
+        self.assertIsNotNone(self.repo.state_cache.get("3"))
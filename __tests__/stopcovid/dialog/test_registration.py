@@ -1,8 +1,17 @@
+import time
 import unittest
+from unittest.mock import MagicMock
 
+import requests
 import requests_mock
 
-from stopcovid.dialog.registration import DefaultRegistrationValidator
+from stopcovid.dialog.registration import (
+    DefaultRegistrationValidator,
+    DemoCodeFilter,
+    CodeValidationPayload,
+    SharedValidationCache,
+    REJECTED_VALIDATION,
+)
 
 
 class TestRegistration(unittest.TestCase):
@@ -74,3 +83,118 @@ class TestRegistration(unittest.TestCase):
             validator.validate_code("foo", url=self.url, key=self.key)
             validator.validate_code("foo", url=self.url, key=self.key)
             self.assertEqual(1, m.call_count)
+
+    def test_uses_timeouts(self):
+        with requests_mock.Mocker() as m:
+            m.post(self.url, json={"valid": False})
+            DefaultRegistrationValidator().validate_code("foo", url=self.url, key=self.key)
+            self.assertIsNotNone(m.last_request.timeout)
+
+    def test_does_not_cache_failures(self):
+        with requests_mock.Mocker() as m:
+            m.post(self.url, [{"status_code": 503}, {"json": {"valid": True}}])
+            validator = DefaultRegistrationValidator()
+            with self.assertRaises(requests.HTTPError):
+                validator.validate_code("foo", url=self.url, key=self.key)
+            self.assertTrue(validator.validate_code("foo", url=self.url, key=self.key).valid)
+            self.assertTrue(validator.validate_code("foo", url=self.url, key=self.key).valid)
+            self.assertEqual(2, m.call_count)
+
+    def test_client_errors_are_invalid_and_not_cached(self):
+        with requests_mock.Mocker() as m:
+            m.post(self.url, [{"status_code": 400}, {"json": {"valid": True}}])
+            validator = DefaultRegistrationValidator()
+            self.assertIs(
+                REJECTED_VALIDATION, validator.validate_code("foo", url=self.url, key=self.key)
+            )
+            self.assertTrue(validator.validate_code("foo", url=self.url, key=self.key).valid)
+            self.assertEqual(2, m.call_count)
+
+
+class TestSharedValidationCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.url = "https://foo"
+        self.key = "access-key"
+        self.shared_cache = SharedValidationCache()
+        self.shared_cache.table.table_name = "registration-validation-cache-test"
+        self.shared_cache.table.dynamodb = MagicMock()
+        self.shared_cache.table.dynamodb.get_item.return_value = {}
+        self.payload = CodeValidationPayload(valid=True, account_info={"employer_id": 165})
+
+    def test_round_trip(self):
+        self.shared_cache.put("foo", self.payload)
+        item = self.shared_cache.table.dynamodb.put_item.call_args[1]["Item"]
+        self.assertGreater(int(item["expiration_ts"]["N"]), time.time())
+        self.shared_cache.table.dynamodb.get_item.return_value = {"Item": item}
+        self.assertEqual(self.payload, self.shared_cache.get("foo"))
+
+    def test_expired_items_are_ignored(self):
+        self.shared_cache.put("foo", self.payload)
+        item = self.shared_cache.table.dynamodb.put_item.call_args[1]["Item"]
+        item["expiration_ts"] = {"N": str(int(time.time()) - 1)}
+        self.shared_cache.table.dynamodb.get_item.return_value = {"Item": item}
+        self.assertIsNone(self.shared_cache.get("foo"))
+
+    def test_invalid_codes_are_not_stored(self):
+        self.shared_cache.put("foo", CodeValidationPayload(valid=False))
+        self.shared_cache.table.dynamodb.put_item.assert_not_called()
+
+    def test_errors_are_misses(self):
+        self.shared_cache.table.dynamodb.get_item.side_effect = RuntimeError("throttled")
+        self.assertIsNone(self.shared_cache.get("foo"))
+
+    def test_validator_consults_shared_cache_before_the_service(self):
+        validator = DefaultRegistrationValidator(shared_cache=self.shared_cache)
+        with requests_mock.Mocker() as m:
+            m.post(self.url, json={"valid": True, "account_info": {"employer_id": 165}})
+            self.assertEqual(
+                self.payload, validator.validate_code("foo", url=self.url, key=self.key)
+            )
+            item = self.shared_cache.table.dynamodb.put_item.call_args[1]["Item"]
+            self.shared_cache.table.dynamodb.get_item.return_value = {"Item": item}
+
+            other_validator = DefaultRegistrationValidator(shared_cache=self.shared_cache)
+            self.assertEqual(
+                self.payload, other_validator.validate_code("foo", url=self.url, key=self.key)
+            )
+            self.assertEqual(1, m.call_count)
+
+
+class TestDemoCodeFilter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.filter = DemoCodeFilter()
+        self.validator = MagicMock()
+        self.validator.validate_code.return_value = CodeValidationPayload(valid=False)
+
+    def test_could_be_code(self):
+        for content in ["acme-2020", "kitchen", "a1b2"]:
+            self.assertTrue(self.filter.could_be_code(content), content)
+        for content in ["a", "yes", "i don't know", "-abcd", "x" * 40]:
+            self.assertFalse(self.filter.could_be_code(content), content)
+
+    def test_learns_code_prefixes(self):
+        self.assertFalse(self.filter.could_be_code("ab1"))
+        self.filter.learn_code("ab1234")
+        self.assertTrue(self.filter.could_be_code("ab1"))
+        self.assertFalse(self.filter.could_be_code("ab"))
+
+    def test_skips_validator_for_content_that_is_not_a_code(self):
+        self.assertFalse(self.filter.validate_code("yes", self.validator).valid)
+        self.validator.validate_code.assert_not_called()
+
+    def test_caches_results(self):
+        self.assertFalse(self.filter.validate_code("hello", self.validator).valid)
+        self.assertFalse(self.filter.validate_code("hello", self.validator).valid)
+        self.validator.validate_code.assert_called_once_with("hello")
+
+        self.validator.validate_code.return_value = CodeValidationPayload(valid=True)
+        self.assertTrue(self.filter.validate_code("wework", self.validator).valid)
+        self.assertTrue(self.filter.validate_code("wework", self.validator).valid)
+        self.assertEqual(2, self.validator.validate_code.call_count)
+        self.assertTrue(self.filter.could_be_code("wew"))
+
+    def test_does_not_cache_rejected_requests(self):
+        self.validator.validate_code.return_value = REJECTED_VALIDATION
+        self.assertFalse(self.filter.validate_code("hello", self.validator).valid)
+        self.assertFalse(self.filter.validate_code("hello", self.validator).valid)
+        self.assertEqual(2, self.validator.validate_code.call_count)
@@ -3,6 +3,7 @@ import unittest
 import uuid
 from unittest.mock import patch, MagicMock
 
+from stopcovid.dialog.command_stream.publish import BufferedCommandPublisher, PublishOutcome
 from stopcovid.drill_progress.initiation import DrillInitiator
 from stopcovid.drill_progress.drill_progress import DrillProgress
 
@@ -11,10 +12,11 @@ from stopcovid.drill_progress.drill_progress import DrillProgress
 class TestInitiation(unittest.TestCase):
     def setUp(self):
         logging.disable(logging.CRITICAL)
-        mock_checker = MagicMock()
-        mock_checker.already_processed = MagicMock(return_value=False)
+        self.mock_checker = MagicMock()
+        self.mock_checker.already_processed = MagicMock(return_value=False)
         idempotency_checker_patch = patch(
-            "stopcovid.drill_progress.initiation.IdempotencyChecker", return_value=mock_checker
+            "stopcovid.drill_progress.initiation.IdempotencyChecker",
+            return_value=self.mock_checker,
         )
         idempotency_checker_patch.start()
         self.addCleanup(idempotency_checker_patch.stop)
@@ -101,3 +103,25 @@ class TestInitiation(unittest.TestCase):
         idempotency_key = str(uuid.uuid4())
         self.initiator.trigger_drill(phone_number, None, idempotency_key)
         publish_mock.assert_not_called()
+
+    def test_buffered_trigger_drill_records_idempotency_after_flush(self, publish_mock):
+        phone_number = str(uuid.uuid4())
+        outcome = PublishOutcome(phone_number=phone_number)
+        publish_mock.return_value = [outcome]
+        initiator = DrillInitiator(buffered=True)
+        with patch.object(BufferedCommandPublisher, "flush") as flush_mock:
+            initiator.trigger_drill(phone_number, "02-sample-drill", str(uuid.uuid4()))
+            self.mock_checker.record_as_processed.assert_not_called()
+
+            outcome.sequence_number = "1"
+            initiator.flush()
+            flush_mock.assert_called_once()
+            self.mock_checker.record_as_processed.assert_called_once()
+
+    def test_buffered_trigger_drill_not_recorded_when_unpublished(self, publish_mock):
+        publish_mock.return_value = [PublishOutcome(phone_number="123")]
+        initiator = DrillInitiator(buffered=True)
+        with patch.object(BufferedCommandPublisher, "flush"):
+            initiator.trigger_drill("123", "02-sample-drill", str(uuid.uuid4()))
+            initiator.flush()
+        self.mock_checker.record_as_processed.assert_not_called()
@@ -0,0 +1,123 @@
+import unittest
+from dataclasses import replace
+from unittest.mock import patch, MagicMock
+
+from stopcovid.dialog.models.events import DrillStarted, DrillStartedSchema
+from stopcovid.dialog.models.state import DialogState, DialogStateSchema, UserProfile
+from stopcovid.drills import drills
+from stopcovid.drills.drill_store import DrillStore, content_hash
+from stopcovid.utils import dynamodb as dynamodb_utils
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class TestDrillStore(unittest.TestCase):
+    def setUp(self):
+        self.drill = drills.get_drill("01-sample-drill")
+        self.store = DrillStore()
+        self.store.table.table_name = "drill-content-test"
+        self.store.table.dynamodb = MagicMock()
+        self.store.table.dynamodb.exceptions.ConditionalCheckFailedException = (
+            ConditionalCheckFailedException
+        )
+        self.store.table.dynamodb.get_item.return_value = {}
+
+    def test_content_hash_is_stable(self):
+        content = drills.DrillSchema().dump(self.drill)
+        reordered = dict(reversed(list(content.items())))
+        self.assertEqual(content_hash(content), content_hash(reordered))
+        self.assertNotEqual(
+            content_hash(content), content_hash(drills.DrillSchema().dump(self.modified_drill()))
+        )
+
+    def test_reference_round_trip(self):
+        reference = self.store.drill_reference(self.drill)
+        self.assertEqual(self.drill.slug, reference["slug"])
+        self.store.table.dynamodb.put_item.assert_called_once()
+        self.assertEqual(
+            self.drill, self.store.get_drill(reference["slug"], reference["content_hash"])
+        )
+
+        # content is only written once per process
+        self.store.drill_reference(self.drill)
+        self.store.table.dynamodb.put_item.assert_called_once()
+
+    def test_content_already_stored(self):
+        self.store.table.dynamodb.put_item.side_effect = ConditionalCheckFailedException()
+        reference = self.store.prompt_reference(self.drill.prompts[0])
+        self.assertEqual(
+            self.drill.prompts[0],
+            self.store.get_prompt(reference["slug"], reference["content_hash"]),
+        )
+
+    def test_resolves_current_content_without_dynamodb(self):
+        prompt = self.drill.prompts[1]
+        prompt_hash = content_hash(drills.PromptSchema().dump(prompt))
+        self.assertEqual(prompt, self.store.get_prompt(prompt.slug, prompt_hash))
+        self.store.table.dynamodb.get_item.assert_not_called()
+
+    def test_resolves_old_content_from_dynamodb(self):
+        old_drill = self.modified_drill()
+        content = drills.DrillSchema().dump(old_drill)
+        old_hash = content_hash(content)
+        self.store.table.dynamodb.get_item.return_value = {
+            "Item": dynamodb_utils.serialize(
+                {
+                    "content_hash": old_hash,
+                    "kind": "drill",
+                    "slug": old_drill.slug,
+                    "content": content,
+                }
+            )
+        }
+        self.assertEqual(old_drill, self.store.get_drill(old_drill.slug, old_hash))
+        self.assertEqual(old_drill, self.store.get_drill(old_drill.slug, old_hash))
+        self.store.table.dynamodb.get_item.assert_called_once()
+
+    def test_unknown_content(self):
+        with self.assertRaises(ValueError):
+            self.store.get_drill(self.drill.slug, "not-a-hash")
+
+    def modified_drill(self) -> drills.Drill:
+        return replace(self.drill, name="An older name")
+
+
+class TestSerializationByReference(unittest.TestCase):
+    def setUp(self):
+        self.drill = drills.get_drill("01-sample-drill")
+        self.store = DrillStore()
+        self.store.table.table_name = "drill-content-test"
+        self.store.table.dynamodb = MagicMock()
+        self.store.table.dynamodb.get_item.return_value = {}
+
+    def test_event_by_reference(self):
+        event = DrillStarted(
+            phone_number="123456789",
+            user_profile=UserProfile(validated=True),
+            drill=self.drill,
+            first_prompt=self.drill.prompts[0],
+        )
+        with patch("stopcovid.drills.drill_store.get_drill_store", return_value=self.store):
+            serialized = DrillStartedSchema().dump(event)
+            self.assertEqual({"slug", "content_hash"}, set(serialized["drill"].keys()))
+            self.assertEqual({"slug", "content_hash"}, set(serialized["first_prompt"].keys()))
+            deserialized = DrillStartedSchema().load(serialized)
+        self.assertEqual(self.drill, deserialized.drill)
+        self.assertEqual(self.drill.prompts[0], deserialized.first_prompt)
+
+    def test_state_by_reference(self):
+        state = DialogState("123456789", "0", current_drill=self.drill)
+        with patch("stopcovid.drills.drill_store.get_drill_store", return_value=self.store):
+            serialized = DialogStateSchema().dump(state)
+            self.assertEqual({"slug", "content_hash"}, set(serialized["current_drill"].keys()))
+            self.assertEqual(self.drill, DialogStateSchema().load(serialized).current_drill)
+
+    def test_legacy_state_by_value(self):
+        state = DialogState("123456789", "0", current_drill=self.drill)
+        with patch("stopcovid.drills.drill_store.get_drill_store", return_value=DrillStore()):
+            serialized = DialogStateSchema().dump(state)
+        self.assertEqual(self.drill.name, serialized["current_drill"]["name"])
+        with patch("stopcovid.drills.drill_store.get_drill_store", return_value=self.store):
+            self.assertEqual(self.drill, DialogStateSchema().load(serialized).current_drill)
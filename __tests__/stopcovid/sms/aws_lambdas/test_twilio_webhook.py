@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+import unittest
+from unittest.mock import patch
+
+from stopcovid.sms.aws_lambdas import twilio_webhook
+
+
+@patch.dict(os.environ, {"STAGE": "test"})
+@patch("stopcovid.sms.aws_lambdas.twilio_webhook.verify_deploy_stage")
+@patch("stopcovid.sms.aws_lambdas.twilio_webhook.is_signature_valid", return_value=True)
+@patch("stopcovid.sms.aws_lambdas.twilio_webhook.IdempotencyChecker")
+@patch("stopcovid.sms.aws_lambdas.twilio_webhook.CommandPublisher")
+@patch("stopcovid.sms.aws_lambdas.twilio_webhook.boto3")
+class TestTwilioWebhook(unittest.TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+
+    def _event(self, body: str):
+        return {
+            "body": f"From=%2B15555555555&To=%2B15556666666&Body={body}",
+            "headers": {"I-Twilio-Idempotency-Token": "token"},
+        }
+
+    def _invoke(self, body, idempotency_mock):
+        idempotency_mock.return_value.already_processed.return_value = False
+        return twilio_webhook.handler(self._event(body), None)
+
+    def test_publishes_inbound_sms(self, boto3_mock, publisher_mock, idempotency_mock, *args):
+        response = self._invoke("hello", idempotency_mock)
+        self.assertEqual(200, response["statusCode"])
+        publisher_mock.return_value.publish_process_sms_command.assert_called_once()
+        boto3_mock.client.return_value.put_record.assert_not_called()
+
+    def test_answers_help_without_the_command_stream(
+        self, boto3_mock, publisher_mock, idempotency_mock, *args
+    ):
+        response = self._invoke("HELP", idempotency_mock)
+        self.assertEqual(200, response["statusCode"])
+        self.assertIn("<Response", response["body"])
+        publisher_mock.return_value.publish_process_sms_command.assert_not_called()
+
+        kwargs = boto3_mock.client.return_value.put_record.call_args[1]
+        self.assertEqual("message-log-test", kwargs["StreamName"])
+        self.assertEqual("+15555555555", kwargs["PartitionKey"])
+        logged = json.loads(kwargs["Data"])
+        self.assertEqual("INBOUND_SMS", logged["type"])
+        self.assertEqual("HELP", logged["payload"]["Body"])
+        idempotency_mock.return_value.record_as_processed.assert_called_once()
+
+    @patch.dict(
+        "stopcovid.dialog.keywords.STATELESS_KEYWORD_RESPONSES",
+        {"info": "Reply STOP to unsubscribe"},
+    )
+    def test_responds_with_keyword_text(self, boto3_mock, publisher_mock, idempotency_mock, *args):
+        response = self._invoke("info", idempotency_mock)
+        self.assertIn("Reply STOP to unsubscribe", response["body"])
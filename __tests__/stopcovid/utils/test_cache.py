@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from stopcovid.utils.cache import LRUCache, TTLCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        self.assertEqual(1, cache.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(2, len(cache))
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        self.assertEqual(1, cache.pop("a"))
+        self.assertIsNone(cache.pop("a"))
+        self.assertNotIn("a", cache)
+
+
+@patch("stopcovid.utils.cache.time.monotonic")
+class TestTTLCache(unittest.TestCase):
+    def test_entries_expire(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        cache = TTLCache(2, ttl_seconds=10)
+        cache.put("a", 1)
+        monotonic_mock.return_value = 109
+        self.assertEqual(1, cache.get("a"))
+        self.assertIn("a", cache)
+        monotonic_mock.return_value = 110
+        self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+        self.assertEqual(0, len(cache))
+
+    def test_evicts_least_recently_used(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        cache = TTLCache(2, ttl_seconds=10)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.pop("a"))
+        self.assertIsNone(cache.pop("a"))
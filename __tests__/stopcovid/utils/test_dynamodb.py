@@ -0,0 +1,47 @@
+import base64
+import unittest
+from decimal import Decimal
+
+from stopcovid.utils import dynamodb as dynamodb_utils
+
+
+class TestCompressedItems(unittest.TestCase):
+    def setUp(self):
+        self.item_dict = {
+            "phone_number": "123456789",
+            "seq": "12",
+            "profile": {"validated": True, "account_info": {"employer_id": Decimal(1)}},
+            "nothing": None,
+        }
+
+    def test_round_trip(self):
+        item = dynamodb_utils.serialize_compressed(self.item_dict, ("phone_number", "seq"))
+        self.assertEqual({"S": "123456789"}, item["phone_number"])
+        self.assertEqual({"S": "12"}, item["seq"])
+        self.assertNotIn("profile", item)
+        self.assertTrue(dynamodb_utils.is_compressed(item))
+        self.assertEqual(self.item_dict, dynamodb_utils.deserialize_item(item))
+
+    def test_plain_item(self):
+        item = dynamodb_utils.serialize(self.item_dict)
+        self.assertFalse(dynamodb_utils.is_compressed(item))
+        self.assertEqual(self.item_dict, dynamodb_utils.deserialize_item(item))
+
+    def test_stream_image_with_base64_payload(self):
+        item = dynamodb_utils.serialize_compressed(self.item_dict, ("phone_number",))
+        item["payload"] = {"B": base64.b64encode(item["payload"]["B"]).decode("ascii")}
+        self.assertEqual(self.item_dict, dynamodb_utils.deserialize_item(item))
+
+    def test_readable_attributes_take_precedence(self):
+        item = dynamodb_utils.serialize_compressed(self.item_dict, ("phone_number", "seq"))
+        item["seq"] = {"S": "13"}
+        item["nothing"] = {"S": "something"}
+        deserialized = dynamodb_utils.deserialize_item(item)
+        self.assertEqual("13", deserialized["seq"])
+        self.assertEqual("something", deserialized["nothing"])
+
+    def test_unknown_format(self):
+        item = dynamodb_utils.serialize_compressed(self.item_dict, ("phone_number",))
+        item["payload_format"] = {"N": "99"}
+        with self.assertRaises(ValueError):
+            dynamodb_utils.deserialize_item(item)
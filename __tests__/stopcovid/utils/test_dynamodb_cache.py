@@ -0,0 +1,77 @@
+import logging
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from stopcovid.utils.dynamodb_cache import DynamoDBCache
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class TestDynamoDBCache(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def _cache(self, **kwargs) -> DynamoDBCache:
+        cache = DynamoDBCache(None, "id", **kwargs)
+        cache.table_name = "cache-test"
+        cache.dynamodb = MagicMock()
+        cache.dynamodb.exceptions.ConditionalCheckFailedException = ConditionalCheckFailedException
+        cache.dynamodb.get_item.return_value = {}
+        return cache
+
+    def test_round_trip(self):
+        cache = self._cache(ttl_seconds=60)
+        cache.put("foo", {"value": "bar"})
+        item = cache.dynamodb.put_item.call_args[1]["Item"]
+        self.assertEqual({"S": "foo"}, item["id"])
+        self.assertGreater(int(item["expiration_ts"]["N"]), time.time())
+        cache.dynamodb.get_item.return_value = {"Item": item}
+        self.assertEqual("bar", cache.get("foo")["value"])
+
+    def test_expired_items_are_ignored(self):
+        cache = self._cache(ttl_seconds=60)
+        cache.dynamodb.get_item.return_value = {
+            "Item": {"id": {"S": "foo"}, "expiration_ts": {"N": str(int(time.time()) - 1)}}
+        }
+        self.assertIsNone(cache.get("foo"))
+
+    def test_reads_each_key_once_when_cached_in_memory(self):
+        cache = self._cache(cache_size=10)
+        self.assertIsNone(cache.get("foo"))
+        self.assertIsNone(cache.get("foo"))
+        cache.dynamodb.get_item.assert_called_once()
+
+        cache.put("foo", {"value": "bar"})
+        self.assertEqual("bar", cache.get("foo")["value"])
+        cache.dynamodb.get_item.assert_called_once()
+
+    def test_errors_are_misses(self):
+        cache = self._cache(cache_size=10)
+        cache.dynamodb.get_item.side_effect = RuntimeError("throttled")
+        self.assertIsNone(cache.get("foo"))
+        # errors aren't cached
+        self.assertIsNone(cache.get("foo"))
+        self.assertEqual(2, cache.dynamodb.get_item.call_count)
+
+        cache.errors_are_misses = False
+        with self.assertRaises(RuntimeError):
+            cache.get("foo")
+
+    def test_put_if_absent(self):
+        cache = self._cache()
+        cache.dynamodb.put_item.side_effect = ConditionalCheckFailedException()
+        cache.put("foo", {"value": "bar"}, if_absent=True)
+        self.assertEqual(
+            "attribute_not_exists(id)",
+            cache.dynamodb.put_item.call_args[1]["ConditionExpression"],
+        )
+
+    def test_without_a_table(self):
+        cache = DynamoDBCache(None, "id", cache_size=10)
+        self.assertIsNone(cache.get("foo"))
+        cache.put("foo", {"value": "bar"})
+        self.assertEqual("bar", cache.get("foo")["value"])
+        self.assertIsNone(DynamoDBCache(None, "id").get("foo"))
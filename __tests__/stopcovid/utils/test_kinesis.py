@@ -0,0 +1,106 @@
+import json
+import os
+import unittest
+from base64 import b64encode
+from unittest.mock import MagicMock, patch
+
+from stopcovid.utils import kinesis as kinesis_utils
+
+# two shards, splitting the hash key space in half
+STARTING_HASH_KEYS = [0, 2**127]
+
+
+def _kinesis_record(data: bytes) -> dict:
+    return {"kinesis": {"data": b64encode(data).decode("utf-8"), "sequenceNumber": "1"}}
+
+
+def _partition_keys_for_shard(shard: int, count: int):
+    keys = []
+    i = 0
+    while len(keys) < count:
+        key = f"+1555{i:07d}"
+        if (kinesis_utils.hash_key(key) >= STARTING_HASH_KEYS[1]) == (shard == 1):
+            keys.append(key)
+        i += 1
+    return keys
+
+
+class TestAggregation(unittest.TestCase):
+    def _record(self, partition_key: str, i: int) -> dict:
+        return {"Data": json.dumps({"type": "INBOUND_SMS", "i": i}), "PartitionKey": partition_key}
+
+    def test_plain_record(self):
+        record = _kinesis_record(json.dumps({"i": 1}).encode("utf-8"))
+        self.assertEqual([(0, {"i": 1})], kinesis_utils.get_payloads_from_kinesis_record(record))
+
+    def test_round_trip(self):
+        keys = _partition_keys_for_shard(0, 3)
+        records = [self._record(key, i) for i, key in enumerate(keys)]
+        entries = kinesis_utils.aggregate_records(records, STARTING_HASH_KEYS)
+        self.assertEqual(1, len(entries))
+        entry, indices = entries[0]
+        self.assertEqual([0, 1, 2], indices)
+        self.assertEqual(str(kinesis_utils.hash_key(keys[0])), entry["ExplicitHashKey"])
+        self.assertEqual(
+            [(i, {"type": "INBOUND_SMS", "i": i}) for i in range(3)],
+            kinesis_utils.get_payloads_from_kinesis_record(_kinesis_record(entry["Data"])),
+        )
+
+    def test_groups_by_shard(self):
+        shard_0 = _partition_keys_for_shard(0, 2)
+        shard_1 = _partition_keys_for_shard(1, 2)
+        records = [self._record(key, i) for i, key in enumerate(shard_0 + shard_1)]
+        entries = kinesis_utils.aggregate_records(records, STARTING_HASH_KEYS)
+        self.assertEqual([[0, 1], [2, 3]], sorted(indices for _, indices in entries))
+
+    def test_aggregates_records_with_the_same_partition_key(self):
+        key = _partition_keys_for_shard(0, 1)[0]
+        records = [self._record(key, i) for i in range(3)]
+        entries = kinesis_utils.aggregate_records(records, STARTING_HASH_KEYS)
+        self.assertEqual([[0, 1, 2]], [indices for _, indices in entries])
+
+    def test_single_records_are_put_as_they_are(self):
+        records = [self._record(key, i) for i, key in enumerate(_partition_keys_for_shard(0, 1))]
+        entries = kinesis_utils.aggregate_records(records, STARTING_HASH_KEYS)
+        self.assertEqual([(records[0], [0])], entries)
+
+    def test_put_records_without_aggregation(self):
+        kinesis = MagicMock()
+        kinesis.put_records.return_value = {"Records": [{"SequenceNumber": "1"}, {}]}
+        records = [self._record(key, i) for i, key in enumerate(_partition_keys_for_shard(0, 2))]
+        with patch.dict(os.environ, {"AGGREGATE_KINESIS_RECORDS": "false"}):
+            kinesis_utils.put_records(kinesis, "stream", records)
+        kinesis.put_records.assert_called_once_with(StreamName="stream", Records=records)
+        kinesis.list_shards.assert_not_called()
+
+    def test_put_records_expands_results(self):
+        kinesis = MagicMock()
+        kinesis.list_shards.return_value = {
+            "Shards": [
+                {
+                    "HashKeyRange": {"StartingHashKey": str(start)},
+                    "SequenceNumberRange": {"StartingSequenceNumber": "0"},
+                }
+                for start in STARTING_HASH_KEYS
+            ]
+        }
+        kinesis.put_records.return_value = {
+            "Records": [
+                {"SequenceNumber": "1", "ShardId": "shard-0"},
+                {"ErrorCode": "ProvisionedThroughputExceededException"},
+            ]
+        }
+        records = [
+            self._record(key, i)
+            for i, key in enumerate(
+                _partition_keys_for_shard(0, 2) + _partition_keys_for_shard(1, 1)
+            )
+        ]
+        with patch.dict(os.environ, {"AGGREGATE_KINESIS_RECORDS": "true"}):
+            results = kinesis_utils.put_records(kinesis, "test-put-records-stream", records)
+        self.assertEqual(2, len(kinesis.put_records.call_args[1]["Records"]))
+        self.assertEqual(
+            ["1", "1", None],
+            [result.get("SequenceNumber") for result in results],
+        )
+        self.assertIn("ErrorCode", results[2])
@@ -0,0 +1,173 @@
+import argparse
+import logging
+import sys
+import timeit
+import uuid
+from copy import copy, deepcopy
+from dataclasses import replace
+from typing import Optional
+
+from stopcovid.dialog.engine import process_command, StartDrill, ProcessSMSMessage
+from stopcovid.dialog.models.events import (
+    DialogEventBatch,
+    DrillStarted,
+    ReminderTriggered,
+    UserValidated,
+    CompletedPrompt,
+    FailedPrompt,
+    AdvancedToNextPrompt,
+    DrillCompleted,
+    OptedOut,
+    event_from_dict,
+)
+from stopcovid.dialog.models.state import DialogState, UserProfile
+from stopcovid.dialog.registration import CodeValidationPayload
+from stopcovid.dialog.persistence import DialogRepository
+from stopcovid.drills.drills import get_drill, get_first_drill_slug
+
+PHONE_NUMBER = "123456789"
+
+
+class NoopRepository(DialogRepository):
+    def __init__(self, dialog_state: DialogState):
+        self.dialog_state = dialog_state
+
+    def fetch_dialog_state(self, phone_number: str, consistent_read: bool = False) -> DialogState:
+        # a fresh copy of everything that commands can mutate. Drills are never mutated.
+        return replace(
+            self.dialog_state,
+            user_profile=replace(self.dialog_state.user_profile),
+            current_prompt_state=copy(self.dialog_state.current_prompt_state),
+        )
+
+    def persist_dialog_state(
+        self,
+        event_batch: DialogEventBatch,
+        dialog_state: DialogState,
+        previous_seq: Optional[str] = None,
+    ):
+        pass
+
+
+def _report(name: str, number: int, seconds: float):
+    print(f"{name:<48} {seconds / number * 1_000_000:10.1f} µs/op ({number} ops)")
+
+
+def benchmark_apply_events(args):
+    drill = get_drill(get_first_drill_slug())
+    dialog_state = DialogState(PHONE_NUMBER, "0", user_profile=UserProfile(validated=True))
+    event = DrillStarted(
+        phone_number=PHONE_NUMBER,
+        user_profile=dialog_state.user_profile,
+        drill=drill,
+        first_prompt=drill.first_prompt(),
+    )
+
+    def with_deepcopy():
+        deepcopy(event).apply_to(dialog_state)
+
+    def with_profile_snapshot():
+        event.apply_to(dialog_state)
+        event.user_profile = replace(dialog_state.user_profile)
+
+    _report(
+        "apply DrillStarted (deepcopy)",
+        args.number,
+        timeit.timeit(with_deepcopy, number=args.number),
+    )
+    _report(
+        "apply DrillStarted (profile snapshot)",
+        args.number,
+        timeit.timeit(with_profile_snapshot, number=args.number),
+    )
+
+
+def benchmark_process_command(args):
+    drill = get_drill(get_first_drill_slug())
+    repo = NoopRepository(DialogState(PHONE_NUMBER, "0", user_profile=UserProfile(validated=True)))
+
+    def start_drill():
+        process_command(StartDrill(PHONE_NUMBER, drill.slug), "1", repo=repo)
+
+    _report("process START_DRILL", args.number, timeit.timeit(start_drill, number=args.number))
+
+    started = repo.fetch_dialog_state(PHONE_NUMBER)
+    DrillStarted(
+        phone_number=PHONE_NUMBER,
+        user_profile=started.user_profile,
+        drill=drill,
+        first_prompt=drill.first_prompt(),
+    ).apply_to(started)
+    repo.dialog_state = started
+
+    def answer_prompt():
+        process_command(ProcessSMSMessage(PHONE_NUMBER, "a"), "2", repo=repo)
+
+    _report("process INBOUND_SMS", args.number, timeit.timeit(answer_prompt, number=args.number))
+
+
+def benchmark_codecs(args):
+    drill = get_drill(get_first_drill_slug())
+    prompt = drill.first_prompt()
+    user_profile = UserProfile(
+        validated=True, name="Mario", language="en", account_info={"employer_id": 1, "unit_id": 1}
+    )
+    events = [
+        DrillStarted(PHONE_NUMBER, user_profile, drill, prompt),
+        ReminderTriggered(PHONE_NUMBER, user_profile),
+        UserValidated(PHONE_NUMBER, user_profile, CodeValidationPayload(valid=True)),
+        CompletedPrompt(PHONE_NUMBER, user_profile, prompt, uuid.uuid4(), "a"),
+        FailedPrompt(PHONE_NUMBER, user_profile, prompt, uuid.uuid4(), "b", abandoned=False),
+        AdvancedToNextPrompt(PHONE_NUMBER, user_profile, prompt, uuid.uuid4()),
+        DrillCompleted(PHONE_NUMBER, user_profile, uuid.uuid4()),
+        OptedOut(PHONE_NUMBER, user_profile, uuid.uuid4()),
+    ]
+    for event in events:
+        serialized = event.to_dict()
+        name = event.event_type.name
+        _report(
+            f"encode {name} (marshmallow)",
+            args.number,
+            timeit.timeit(lambda: event.schema.dump(event), number=args.number),
+        )
+        _report(f"encode {name}", args.number, timeit.timeit(event.to_dict, number=args.number))
+        _report(
+            f"decode {name} (marshmallow)",
+            args.number,
+            timeit.timeit(lambda: event.schema.load(serialized), number=args.number),
+        )
+        _report(
+            f"decode {name}",
+            args.number,
+            timeit.timeit(lambda: event_from_dict(serialized), number=args.number),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the dialog engine")
+    parser.add_argument("--number", type=int, default=10000)
+    subparsers = parser.add_subparsers(
+        required=True, title="subcommands", description="valid subcommands"
+    )
+    apply_events_parser = subparsers.add_parser(
+        "apply-events", description="time applying an event to dialog state"
+    )
+    apply_events_parser.set_defaults(func=benchmark_apply_events)
+
+    process_command_parser = subparsers.add_parser(
+        "process-command", description="time processing commands against an in-memory repository"
+    )
+    process_command_parser.set_defaults(func=benchmark_process_command)
+
+    codecs_parser = subparsers.add_parser(
+        "codecs", description="compare event serialization with marshmallow, per event type"
+    )
+    codecs_parser.set_defaults(func=benchmark_codecs)
+
+    args = parser.parse_args(sys.argv[1:])
+    logging.disable(logging.CRITICAL)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
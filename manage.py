@@ -1,4 +1,5 @@
 import argparse
+import os
 import sys
 import uuid
 from typing import Iterator
@@ -94,7 +95,7 @@ def _get_dialog_events(phone_number: str, stage: str) -> Iterator[DialogEventBat
             **args,
         )
         for item in result["Items"]:
-            yield batch_from_dict(dynamodb_utils.deserialize(item))
+            yield batch_from_dict(dynamodb_utils.deserialize_item(item))
         if not result.get("LastEvaluatedKey"):
             break
         args["ExclusiveStartKey"] = result["LastEvaluatedKey"]
@@ -245,6 +246,8 @@ def main():
     show_command_parser.set_defaults(func=show_command)
 
     args = parser.parse_args(sys.argv if len(sys.argv) == 1 else None)
+    # dialog events refer to drill content that's stored in this table
+    os.environ.setdefault("DRILL_CONTENT_TABLE_NAME", f"drill-content-{args.stage}")
     args.func(args)
 
 
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
 from time import sleep
-from typing import List
+from typing import List, Optional
 
 from stopcovid.dialog.persistence import DialogRepository
 from stopcovid.dialog.models.events import (
@@ -59,7 +59,7 @@ class InMemoryRepository(DialogRepository):
         self.repo = {}
         self.lang = lang
 
-    def fetch_dialog_state(self, phone_number: str) -> DialogState:
+    def fetch_dialog_state(self, phone_number: str, consistent_read: bool = False) -> DialogState:
         if phone_number in self.repo:
             state = DialogStateSchema().loads(self.repo[phone_number])
             return state
@@ -71,7 +71,10 @@ class InMemoryRepository(DialogRepository):
             )
 
     def persist_dialog_state(  # noqa: C901
-        self, event_batch: DialogEventBatch, dialog_state: DialogState
+        self,
+        event_batch: DialogEventBatch,
+        dialog_state: DialogState,
+        previous_seq: Optional[str] = None,
     ):
         self.repo[dialog_state.phone_number] = DialogStateSchema().dumps(dialog_state)
 
@@ -1,14 +1,28 @@
+import os
+
 from stopcovid.utils.kinesis import get_payload_from_kinesis_record
 
 from stopcovid.dialog.command_stream.types import InboundCommandSchema
 from stopcovid.dialog.command_stream.command_stream import handle_inbound_commands
+from stopcovid.dialog.command_stream.failures import CommandFailureRecorder
+from stopcovid.dialog.persistence import DynamoDBDialogRepository
 from stopcovid.utils.logging import configure_logging
 from stopcovid.utils.verify_deploy_stage import verify_deploy_stage
 
 configure_logging()
 
+MAX_WORKERS = int(os.getenv("COMMAND_HANDLER_MAX_WORKERS", "8"))
+DEADLINE_MARGIN_MS = int(os.getenv("COMMAND_HANDLER_DEADLINE_MARGIN_MS", "1000"))
+MAX_FAILED_ATTEMPTS = int(os.getenv("COMMAND_HANDLER_MAX_FAILED_ATTEMPTS", "3"))
+
+# created once per container so that its dialog state cache is reused across invocations
+DIALOG_REPOSITORY = DynamoDBDialogRepository()
+# created once per container so that failed attempts are counted across invocations
+COMMAND_FAILURES = CommandFailureRecorder(max_attempts=MAX_FAILED_ATTEMPTS)
+
 
 def _make_inbound_command(record):
+    # The command stream is never aggregated (see CommandPublisher._put)
     event = get_payload_from_kinesis_record(record)
     return InboundCommandSchema().load(
         {
@@ -22,5 +36,11 @@ def _make_inbound_command(record):
 def handler(event, context):
     verify_deploy_stage()
     inbound_commands = [_make_inbound_command(record) for record in event["Records"]]
-    handle_inbound_commands(inbound_commands)
-    return {"statusCode": 200}
+    return handle_inbound_commands(
+        inbound_commands,
+        repo=DIALOG_REPOSITORY,
+        max_workers=MAX_WORKERS,
+        time_remaining_ms=context.get_remaining_time_in_millis,
+        deadline_margin_ms=DEADLINE_MARGIN_MS,
+        failures=COMMAND_FAILURES,
+    )
@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+import boto3
+
+from .publish import PublishMetrics
+
+DEFAULT_COMMANDS_PER_SECOND = 50.0
+DEFAULT_MIN_COMMANDS_PER_SECOND = 5.0
+DEFAULT_MAX_COMMANDS_PER_SECOND = 200.0
+# added to the rate for every second without throttling, and the factor it's cut by when
+# Kinesis throttles us
+RATE_INCREASE_PER_SECOND = 5.0
+RATE_DECREASE_FACTOR = 0.5
+
+# Bulk commands produce outbound messages. Past this many messages waiting to be sent, we
+# stop publishing and leave the rest for a later invocation.
+DEFAULT_MAX_OUTBOUND_BACKLOG = 1000
+BACKLOG_CHECK_INTERVAL_SECONDS = 5.0
+
+DEFAULT_DEADLINE_MARGIN_MS = 5000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_rate(self, rate: float):
+        # tokens earned so far are earned at the old rate
+        self._refill()
+        self.rate = rate
+
+    def seconds_until_available(self, tokens: float = 1) -> float:
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def acquire(self, tokens: float = 1):
+        wait = self.seconds_until_available(tokens)
+        if wait > 0:
+            time.sleep(wait)
+            self._refill()
+        self.tokens -= tokens
+
+
+class BulkPublishGovernor:
+    # Paces bulk commands (reminders, scheduled drills) so they don't crowd out interactive
+    # traffic. Each command waits for a token from a bucket whose rate adapts to Kinesis: it's
+    # cut whenever the publisher reports throttled records, and creeps back up while it doesn't.
+    # Once the outbound SMS queue is backed up, or the invocation is running out of time,
+    # admit() returns False and the caller should leave the remaining commands for a later
+    # invocation.
+
+    def __init__(
+        self,
+        commands_per_second: float = DEFAULT_COMMANDS_PER_SECOND,
+        min_commands_per_second: float = DEFAULT_MIN_COMMANDS_PER_SECOND,
+        max_commands_per_second: float = DEFAULT_MAX_COMMANDS_PER_SECOND,
+        max_outbound_backlog: int = DEFAULT_MAX_OUTBOUND_BACKLOG,
+        time_remaining_ms: Optional[Callable[[], int]] = None,
+        deadline_margin_ms: int = DEFAULT_DEADLINE_MARGIN_MS,
+        **kwargs,
+    ):
+        self.stage = os.environ.get("STAGE")
+        self.min_commands_per_second = min_commands_per_second
+        self.max_commands_per_second = max_commands_per_second
+        self.max_outbound_backlog = max_outbound_backlog
+        self.time_remaining_ms = time_remaining_ms
+        self.deadline_margin_ms = deadline_margin_ms
+        # a second's worth of burst
+        self.bucket = TokenBucket(commands_per_second, max(1.0, commands_per_second))
+        self.sqs = boto3.client("sqs", **kwargs)
+        self._queue_url: Optional[str] = None
+        self._throttled_records = 0
+        self._rate_updated_at = time.monotonic()
+        self._backlog = 0
+        self._backlog_checked_at: Optional[float] = None
+
+    @property
+    def commands_per_second(self) -> float:
+        return self.bucket.rate
+
+    def admit(self, metrics: PublishMetrics) -> bool:
+        """Waits until the next command can be published. Returns False if it should be
+        deferred instead."""
+        self._adapt_rate(metrics)
+        if self._outbound_backlog() > self.max_outbound_backlog:
+            logging.warning(
+                f"{self._backlog} outbound messages are waiting. Deferring bulk commands."
+            )
+            return False
+        wait_ms = self.bucket.seconds_until_available() * 1000
+        if self.time_remaining_ms is not None and (
+            self.time_remaining_ms() - wait_ms < self.deadline_margin_ms
+        ):
+            logging.warning("Running out of time. Deferring bulk commands.")
+            return False
+        self.bucket.acquire()
+        return True
+
+    def _adapt_rate(self, metrics: PublishMetrics):
+        now = time.monotonic()
+        if metrics.throttled_records > self._throttled_records:
+            rate = max(self.min_commands_per_second, self.bucket.rate * RATE_DECREASE_FACTOR)
+            logging.info(f"Kinesis is throttling us. Publishing {rate:.1f} commands per second.")
+        else:
+            rate = min(
+                self.max_commands_per_second,
+                self.bucket.rate + (now - self._rate_updated_at) * RATE_INCREASE_PER_SECOND,
+            )
+        self._throttled_records = metrics.throttled_records
+        self._rate_updated_at = now
+        self.bucket.set_rate(rate)
+
+    def _outbound_backlog(self) -> int:
+        now = time.monotonic()
+        if (
+            self._backlog_checked_at is not None
+            and now - self._backlog_checked_at < BACKLOG_CHECK_INTERVAL_SECONDS
+        ):
+            return self._backlog
+        self._backlog_checked_at = now
+        try:
+            response = self.sqs.get_queue_attributes(
+                QueueUrl=self._get_queue_url(), AttributeNames=["ApproximateNumberOfMessages"]
+            )
+            self._backlog = int(response["Attributes"]["ApproximateNumberOfMessages"])
+        except Exception:
+            # pacing is best effort, so this shouldn't stop us from publishing
+            logging.warning("Unable to read the outbound SMS backlog", exc_info=True)
+            self._backlog = 0
+        return self._backlog
+
+    def _get_queue_url(self) -> str:
+        if self._queue_url is None:
+            self._queue_url = self.sqs.get_queue_url(QueueName=f"outbound-sms-{self.stage}.fifo")[
+                "QueueUrl"
+            ]
+        return self._queue_url
@@ -1,38 +1,277 @@
-from typing import List
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Set, Hashable, Optional, Callable, TypeVar
 import uuid
 
-from stopcovid.dialog.engine import process_command, StartDrill, TriggerReminder, ProcessSMSMessage
+from stopcovid.dialog.engine import (
+    apply_commands_for_phone_number,
+    process_commands_for_phone_number,
+    Command,
+    StartDrill,
+    TriggerReminder,
+    ProcessSMSMessage,
+)
+from stopcovid.dialog.models.state import DialogState
+from stopcovid.dialog.persistence import (
+    DialogRepository,
+    DynamoDBDialogRepository,
+    DialogStateWrite,
+    DialogStateConflict,
+)
+from .failures import CommandFailureRecorder
 from .types import InboundCommand, InboundCommandType
 
+T = TypeVar("T")
 
-def handle_inbound_commands(commands: List[InboundCommand]):
+# We stop starting work for new phone numbers once less than this much time remains in the
+# invocation, which leaves time to persist the work that's in progress.
+DEFAULT_DEADLINE_MARGIN_MS = 1000
+# returned in place of a result for phone numbers that we didn't get to
+_OUT_OF_TIME = object()
 
-    for command in commands:
-        if command.command_type == InboundCommandType.INBOUND_SMS:
-            process_command(
-                ProcessSMSMessage(
-                    phone_number=command.payload["From"], content=command.payload["Body"]
-                ),
-                command.sequence_number,
-            )
-        elif command.command_type == InboundCommandType.START_DRILL:
-            process_command(
-                StartDrill(
-                    phone_number=command.payload["phone_number"],
-                    drill_slug=command.payload["drill_slug"],
-                ),
-                command.sequence_number,
+# shared by callers that don't bring their own, so that failed attempts accumulate
+_DEFAULT_FAILURES: Optional[CommandFailureRecorder] = None
+
+
+def _get_default_failures() -> CommandFailureRecorder:
+    global _DEFAULT_FAILURES
+    if _DEFAULT_FAILURES is None:
+        _DEFAULT_FAILURES = CommandFailureRecorder()
+    return _DEFAULT_FAILURES
+
+
+def _make_command(command: InboundCommand) -> Command:
+    if command.command_type == InboundCommandType.INBOUND_SMS:
+        return ProcessSMSMessage(
+            phone_number=command.payload["From"], content=command.payload["Body"]
+        )
+    elif command.command_type == InboundCommandType.START_DRILL:
+        return StartDrill(
+            phone_number=command.payload["phone_number"],
+            drill_slug=command.payload["drill_slug"],
+        )
+    elif command.command_type == InboundCommandType.TRIGGER_REMINDER:
+        return TriggerReminder(
+            phone_number=command.payload["phone_number"],
+            drill_instance_id=uuid.UUID(command.payload["drill_instance_id"]),
+            prompt_slug=command.payload["prompt_slug"],
+        )
+    raise RuntimeError(f"Unknown command: {command.command_type}")
+
+
+def _deduplication_key(command: InboundCommand) -> Hashable:
+    # START_DRILL and TRIGGER_REMINDER commands are published by scheduled jobs that can
+    # publish the same command more than once. Inbound SMS are never considered duplicates.
+    if command.command_type == InboundCommandType.START_DRILL:
+        return command.command_type, command.payload["drill_slug"]
+    if command.command_type == InboundCommandType.TRIGGER_REMINDER:
+        return (
+            command.command_type,
+            command.payload["drill_instance_id"],
+            command.payload["prompt_slug"],
+        )
+    return command.command_type, command.sequence_number
+
+
+def _group_by_phone_number(
+    commands: List[InboundCommand],
+) -> Dict[str, List[Tuple[Command, str]]]:
+    grouped: Dict[str, List[Tuple[Command, str]]] = defaultdict(list)
+    seen: Dict[str, Set[Hashable]] = defaultdict(set)
+    for inbound_command in sorted(commands, key=lambda c: int(c.sequence_number)):
+        command = _make_command(inbound_command)
+        key = _deduplication_key(inbound_command)
+        if key in seen[command.phone_number]:
+            logging.info(
+                f"({command.phone_number}) Dropping duplicate {inbound_command.command_type} "
+                f"command {inbound_command.sequence_number}"
             )
-        elif command.command_type == InboundCommandType.TRIGGER_REMINDER:
-            process_command(
-                TriggerReminder(
-                    phone_number=command.payload["phone_number"],
-                    drill_instance_id=uuid.UUID(command.payload["drill_instance_id"]),
-                    prompt_slug=command.payload["prompt_slug"],
-                ),
-                command.sequence_number,
+            continue
+        seen[command.phone_number].add(key)
+        grouped[command.phone_number].append((command, inbound_command.sequence_number))
+    return grouped
+
+
+def _is_interactive(commands: List[Tuple[Command, str]]) -> bool:
+    # a user is waiting for our reply
+    return any(isinstance(command, ProcessSMSMessage) for command, _ in commands)
+
+
+def _prioritize(grouped: Dict[str, List[Tuple[Command, str]]]) -> List[str]:
+    # Phone numbers with inbound messages go first, ahead of bulk START_DRILL and
+    # TRIGGER_REMINDER commands. When we run short of time, bulk commands are left for the retry.
+    return sorted(
+        grouped.keys(), key=lambda phone_number: not _is_interactive(grouped[phone_number])
+    )
+
+
+def _apply_commands(
+    phone_number: str,
+    commands: List[Tuple[Command, str]],
+    repo: DialogRepository,
+    dialog_state: Optional[DialogState],
+) -> Tuple[Optional[DialogStateWrite], Optional[Exception]]:
+    # Errors are returned rather than raised, so that a failure for one phone number doesn't stop
+    # us from processing commands for the others.
+    try:
+        return (
+            apply_commands_for_phone_number(
+                phone_number, commands, repo=repo, dialog_state=dialog_state
+            ),
+            None,
+        )
+    except Exception as e:
+        logging.error(f"({phone_number}) Failed to process commands", exc_info=True)
+        return None, e
+
+
+def _reprocess_commands(
+    phone_number: str, commands: List[Tuple[Command, str]], repo: DialogRepository
+) -> Optional[Exception]:
+    try:
+        process_commands_for_phone_number(phone_number, commands, repo=repo, consistent_read=True)
+        return None
+    except Exception as e:
+        logging.error(f"({phone_number}) Failed to process commands", exc_info=True)
+        return e
+
+
+def _map(fn: Callable[[str], T], phone_numbers: List[str], max_workers: int) -> Dict[str, T]:
+    if max_workers > 1 and len(phone_numbers) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(phone_numbers))) as executor:
+            return dict(zip(phone_numbers, executor.map(fn, phone_numbers)))
+    return {phone_number: fn(phone_number) for phone_number in phone_numbers}
+
+
+def _batch_item_failures(
+    grouped: Dict[str, List[Tuple[Command, str]]], phone_numbers: List[str]
+) -> List[Dict[str, str]]:
+    # The stream is checkpointed just before the earliest sequence number we report, so every
+    # record from that point on is delivered again, including records for phone numbers that we
+    # did process. Those are skipped because their dialog state sequence numbers have advanced.
+    sequence_numbers = sorted(
+        (grouped[phone_number][0][1] for phone_number in phone_numbers), key=int
+    )
+    return [{"itemIdentifier": sequence_number} for sequence_number in sequence_numbers]
+
+
+def _phone_numbers_to_retry(
+    errors: Dict[str, Exception],
+    grouped: Dict[str, List[Tuple[Command, str]]],
+    commands: List[InboundCommand],
+    failures: Optional[CommandFailureRecorder],
+) -> List[str]:
+    if not errors:
+        return []
+    if failures is None:
+        failures = _get_default_failures()
+    by_sequence_number = {command.sequence_number: command for command in commands}
+    return [
+        phone_number
+        for phone_number, error in errors.items()
+        if failures.should_retry(
+            phone_number, [by_sequence_number[seq] for _, seq in grouped[phone_number]], error
+        )
+    ]
+
+
+def handle_inbound_commands(
+    commands: List[InboundCommand],
+    repo: DialogRepository = None,
+    max_workers: int = 1,
+    time_remaining_ms: Optional[Callable[[], int]] = None,
+    deadline_margin_ms: int = DEFAULT_DEADLINE_MARGIN_MS,
+    failures: CommandFailureRecorder = None,
+):
+    # Commands are processed one phone number at a time, so each phone number's dialog state is
+    # fetched once and persisted once per batch of commands. Ordering only matters within a phone
+    # number, so different phone numbers can be processed concurrently.
+    #
+    # time_remaining_ms is typically the lambda context's get_remaining_time_in_millis. When time
+    # runs short we stop starting work for new phone numbers and report the rest of the batch as
+    # failed, so that the retry resumes where we left off rather than starting over.
+    #
+    # Failures are handled the same way, one phone number at a time: commands for other phone
+    # numbers are unaffected, and failing commands are retried until the failure recorder gives up
+    # on them and sends them to the command failure queue.
+    def out_of_time() -> bool:
+        return time_remaining_ms is not None and time_remaining_ms() < deadline_margin_ms
+
+    grouped = _group_by_phone_number(commands)
+    phone_numbers = _prioritize(grouped)
+    if repo is None:
+        # boto3 clients are thread safe, but creating them isn't. Share one repository.
+        repo = DynamoDBDialogRepository()
+    # one round trip for up to 100 phone numbers, rather than one for each
+    dialog_states = repo.fetch_dialog_states(phone_numbers)
+
+    results = _map(
+        lambda phone_number: (
+            _OUT_OF_TIME
+            if out_of_time()
+            else _apply_commands(
+                phone_number, grouped[phone_number], repo, dialog_states.get(phone_number)
             )
-        else:
-            raise RuntimeError(f"Unknown command: {command.command_type}")
+        ),
+        phone_numbers,
+        max_workers,
+    )
+    unprocessed = [
+        phone_number for phone_number, result in results.items() if result is _OUT_OF_TIME
+    ]
+    results = {
+        phone_number: result
+        for phone_number, result in results.items()
+        if result is not _OUT_OF_TIME
+    }
+    errors = {
+        phone_number: error for phone_number, (_, error) in results.items() if error is not None
+    }
+
+    # The results for every phone number are persisted together, in as few transactions as
+    # possible. Phone numbers whose dialog state changed in the meantime are processed again on
+    # their own, from a consistent read, with the usual retries. Other failures to persist are
+    # handled like any other failure.
+    persist_failures = repo.persist_dialog_states(
+        [write for write, _ in results.values() if write is not None]
+    )
+    conflicts = {
+        phone_number: error
+        for phone_number, error in persist_failures.items()
+        if isinstance(error, DialogStateConflict)
+    }
+    errors.update(
+        {
+            phone_number: error
+            for phone_number, error in persist_failures.items()
+            if phone_number not in conflicts
+        }
+    )
+    retried = _map(
+        lambda phone_number: (
+            _OUT_OF_TIME
+            if out_of_time()
+            else _reprocess_commands(phone_number, grouped[phone_number], repo)
+        ),
+        list(conflicts.keys()),
+        max_workers,
+    )
+    unprocessed.extend(
+        phone_number for phone_number, result in retried.items() if result is _OUT_OF_TIME
+    )
+    errors.update(
+        {
+            phone_number: error
+            for phone_number, error in retried.items()
+            if error is not None and error is not _OUT_OF_TIME
+        }
+    )
 
-    return {"statusCode": 200}
+    if unprocessed:
+        logging.warning(
+            f"Running out of time. Leaving commands for {len(unprocessed)} of "
+            f"{len(phone_numbers)} phone numbers unprocessed."
+        )
+    to_retry = unprocessed + _phone_numbers_to_retry(errors, grouped, commands, failures)
+    return {"statusCode": 200, "batchItemFailures": _batch_item_failures(grouped, to_retry)}
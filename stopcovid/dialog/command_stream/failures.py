@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import traceback
+from typing import List, Optional
+
+import boto3
+
+from stopcovid.utils.cache import LRUCache
+from .types import InboundCommand
+
+DEFAULT_MAX_FAILED_ATTEMPTS = 3
+ATTEMPTS_CACHE_SIZE = 1024
+
+
+class CommandFailureRecorder:
+    # Counts failed attempts to process each phone number's commands. A failure is retried by
+    # reporting it to lambda, which redelivers the stream from the earliest failed record. Once a
+    # phone number's commands have failed max_attempts times, we send them to the command failure
+    # queue, with the error, and let the stream move on.
+    #
+    # Attempts are counted in memory. Retries of a shard are almost always handled by the same
+    # warm container, and the event source's maximumRetryAttempts is the backstop when they
+    # aren't.
+
+    def __init__(self, max_attempts: int = DEFAULT_MAX_FAILED_ATTEMPTS, **kwargs):
+        self.stage = os.environ.get("STAGE")
+        self.max_attempts = max_attempts
+        self.sqs = boto3.client("sqs", **kwargs)
+        self.attempts = LRUCache(ATTEMPTS_CACHE_SIZE)
+        self._queue_url: Optional[str] = None
+
+    def should_retry(
+        self, phone_number: str, commands: List[InboundCommand], error: Exception
+    ) -> bool:
+        # A retry redelivers the same commands, so the earliest sequence number identifies them.
+        key = (phone_number, commands[0].sequence_number)
+        attempts = (self.attempts.get(key) or 0) + 1
+        if attempts < self.max_attempts:
+            self.attempts.put(key, attempts)
+            return True
+        try:
+            self._send_to_failure_queue(phone_number, commands, error, attempts)
+        except Exception:
+            logging.error(
+                f"({phone_number}) Unable to send failed commands to the failure queue",
+                exc_info=True,
+            )
+            return True
+        self.attempts.invalidate(key)
+        return False
+
+    def _send_to_failure_queue(
+        self, phone_number: str, commands: List[InboundCommand], error: Exception, attempts: int
+    ):
+        logging.error(
+            f"({phone_number}) Giving up on {len(commands)} commands after {attempts} attempts"
+        )
+        self.sqs.send_message(
+            QueueUrl=self._get_queue_url(),
+            MessageBody=json.dumps(
+                {
+                    "phone_number": phone_number,
+                    "attempts": attempts,
+                    "error": repr(error),
+                    "traceback": "".join(
+                        traceback.format_exception(type(error), error, error.__traceback__)
+                    ),
+                    "commands": [
+                        {
+                            "command_type": command.command_type,
+                            "sequence_number": command.sequence_number,
+                            "payload": command.payload,
+                        }
+                        for command in commands
+                    ],
+                }
+            ),
+        )
+
+    def _get_queue_url(self) -> str:
+        if self._queue_url is None:
+            self._queue_url = self.sqs.get_queue_url(QueueName=f"command-failures-{self.stage}")[
+                "QueueUrl"
+            ]
+        return self._queue_url
@@ -1,20 +1,74 @@
 import json
 import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import Dict, Any, Optional, List, Tuple
 
 import boto3
+from botocore.exceptions import ClientError
 
 from stopcovid.drill_progress.drill_progress import DrillInstance
+from .sequence_numbers import get_sequence_number_store
+from .types import make_inbound_sms_payload
+
+# Kinesis limits for a single PutRecords call
+MAX_RECORDS_PER_PUT = 500
+MAX_BYTES_PER_PUT = 5 * 1024 * 1024
+
+MAX_PUT_ATTEMPTS = 5
+BASE_BACKOFF_SECONDS = 0.1
+MAX_BACKOFF_SECONDS = 2.0
+
+THROTTLED_ERROR_CODE = "ProvisionedThroughputExceededException"
+
+# thresholds at which a BufferedCommandPublisher publishes its buffer in the background
+DEFAULT_MAX_BUFFERED_COMMANDS = MAX_RECORDS_PER_PUT
+DEFAULT_MAX_BUFFER_SECONDS = 0.5
+
+
+@dataclass
+class PublishOutcome:
+    phone_number: str
+    sequence_number: Optional[str] = None
+    error_code: Optional[str] = None
+    attempts: int = 0
+
+    @property
+    def published(self) -> bool:
+        return self.sequence_number is not None
+
+
+@dataclass
+class PublishMetrics:
+    records: int = 0
+    put_calls: int = 0
+    retried_records: int = 0
+    throttled_records: int = 0
+    failed_records: int = 0
+
+
+class CommandPublishError(Exception):
+    def __init__(self, outcomes: List[PublishOutcome]):
+        self.outcomes = outcomes
+        failed = [outcome for outcome in outcomes if not outcome.published]
+        super().__init__(f"Failed to publish {len(failed)} of {len(outcomes)} commands")
 
 
 class CommandPublisher:
     def __init__(self):
         self.stage = os.environ.get("STAGE")
+        # accumulated over the life of the publisher
+        self.metrics = PublishMetrics()
 
-    def publish_start_drill_command(self, phone_number: str, drill_slug: str):
+    def publish_start_drill_command(
+        self, phone_number: str, drill_slug: str
+    ) -> List[PublishOutcome]:
         logging.info(f"({phone_number}) publishing START_DRILL command")
-        self._publish_commands(
+        return self._publish_commands(
             [
                 (
                     phone_number,
@@ -26,9 +80,11 @@ class CommandPublisher:
             ]
         )
 
-    def publish_trigger_reminder_commands(self, drills: List[DrillInstance]):
+    def publish_trigger_reminder_commands(
+        self, drills: List[DrillInstance]
+    ) -> List[PublishOutcome]:
         logging.info(f"publishing {len(drills)} TRIGGER_REMINDER commands")
-        self._publish_commands(
+        return self._publish_commands(
             [
                 (
                     drill.phone_number,
@@ -45,19 +101,17 @@ class CommandPublisher:
             ]
         )
 
-    def publish_process_sms_command(self, phone_number: str, content: str, twilio_webhook: dict):
+    def publish_process_sms_command(
+        self, phone_number: str, content: str, twilio_webhook: dict
+    ) -> List[PublishOutcome]:
         logging.info(f"({phone_number}) publishing INBOUND_SMS command")
-        self._publish_commands(
+        return self._publish_commands(
             [
                 (
                     phone_number,
                     {
                         "type": "INBOUND_SMS",
-                        "payload": {
-                            "From": phone_number,
-                            "Body": content,
-                            "twilio_webhook": twilio_webhook,
-                        },
+                        "payload": make_inbound_sms_payload(phone_number, content, twilio_webhook),
                     },
                 )
             ]
@@ -69,21 +123,212 @@ class CommandPublisher:
 
     @staticmethod
     def _get_last_seq(phone_number) -> Optional[str]:
-        return None
+        return get_sequence_number_store().get(phone_number)
 
     @staticmethod
     def _try_record_seq(phone_number, seq):
-        pass
+        try:
+            get_sequence_number_store().put(phone_number, seq)
+        except Exception:
+            # only ordering is at stake, so this shouldn't fail the publish
+            logging.warning(f"({phone_number}) Unable to record sequence number", exc_info=True)
+
+    def _publish_commands(self, commands: List[Tuple[str, Dict[str, Any]]]) -> List[PublishOutcome]:
+        outcomes = [PublishOutcome(phone_number=phone_number) for phone_number, _ in commands]
+        self._publish(commands, outcomes)
+        return outcomes
 
-    def _publish_commands(self, commands: List[Tuple[str, Dict[str, Any]]]):
+    def _publish(self, commands: List[Tuple[str, Dict[str, Any]]], outcomes: List[PublishOutcome]):
+        # Commands are published in chunks that respect the PutRecords limits. Each chunk has at
+        # most one command per phone number, and we only move on to the next chunk once every
+        # record in this one has been published. Retrying failed records can't reorder a phone
+        # number's commands that way.
         kinesis = self._get_kinesis_client()
-        records = []
-        for phone_number, data in commands:
-            last_seq = self._get_last_seq(phone_number)
-            record = {"Data": json.dumps(data), "PartitionKey": phone_number}
-            if last_seq:
-                record["SequenceNumberForOrdering"] = last_seq
-            records.append(record)
-        response = kinesis.put_records(StreamName=f"command-stream-{self.stage}", Records=records)
-        for i, result in enumerate(response["Records"]):
-            self._try_record_seq(records[i]["PartitionKey"], result["SequenceNumber"])
+        records = [
+            {"Data": json.dumps(data), "PartitionKey": phone_number}
+            for phone_number, data in commands
+        ]
+        self.metrics.records += len(records)
+        for chunk in self._chunks(records):
+            if not self._put_chunk(kinesis, records, outcomes, chunk):
+                raise CommandPublishError(outcomes)
+
+    @staticmethod
+    def _chunks(records: List[Dict[str, Any]]) -> List[List[int]]:
+        chunks: List[List[int]] = []
+        chunk: List[int] = []
+        chunk_bytes = 0
+        partition_keys = set()
+        for i, record in enumerate(records):
+            record_bytes = len(record["Data"].encode("utf-8")) + len(
+                record["PartitionKey"].encode("utf-8")
+            )
+            if chunk and (
+                len(chunk) == MAX_RECORDS_PER_PUT
+                or chunk_bytes + record_bytes > MAX_BYTES_PER_PUT
+                or record["PartitionKey"] in partition_keys
+            ):
+                chunks.append(chunk)
+                chunk, chunk_bytes, partition_keys = [], 0, set()
+            chunk.append(i)
+            chunk_bytes += record_bytes
+            partition_keys.add(record["PartitionKey"])
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _put_chunk(
+        self,
+        kinesis,
+        records: List[Dict[str, Any]],
+        outcomes: List[PublishOutcome],
+        chunk: List[int],
+    ) -> bool:
+        pending = chunk
+        for attempt in range(MAX_PUT_ATTEMPTS):
+            if attempt > 0:
+                self.metrics.retried_records += len(pending)
+                time.sleep(
+                    random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2**attempt))
+                )
+            self.metrics.put_calls += 1
+            failed = []
+            for i, result in zip(pending, self._put(kinesis, [records[i] for i in pending])):
+                outcome = outcomes[i]
+                outcome.attempts += 1
+                if "ErrorCode" in result:
+                    outcome.error_code = result["ErrorCode"]
+                    if outcome.error_code == THROTTLED_ERROR_CODE:
+                        self.metrics.throttled_records += 1
+                    failed.append(i)
+                else:
+                    outcome.sequence_number = result["SequenceNumber"]
+                    outcome.error_code = None
+            if not failed:
+                return True
+            logging.warning(
+                f"{len(failed)} of {len(pending)} commands weren't published "
+                f"(attempt {attempt + 1} of {MAX_PUT_ATTEMPTS})"
+            )
+            pending = failed
+        self.metrics.failed_records += len(pending)
+        return False
+
+    def _put(self, kinesis, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Returns a result per record, as PutRecords does. SequenceNumberForOrdering is only
+        # supported by PutRecord, so single commands, which are most of them, are published with
+        # PutRecord, ordered after the last command published for the same phone number.
+        stream_name = f"command-stream-{self.stage}"
+        if len(records) > 1:
+            # Never aggregated: handleCommand processes a shard with a parallelization factor, which
+            # only keeps records in order within a partition key. A command aggregated under
+            # another phone number's partition key could run after its phone number's later
+            # commands, and be skipped as already processed.
+            return kinesis.put_records(StreamName=stream_name, Records=records)["Records"]
+        record = dict(records[0])
+        last_seq = self._get_last_seq(record["PartitionKey"])
+        if last_seq:
+            record["SequenceNumberForOrdering"] = last_seq
+        try:
+            result = kinesis.put_record(StreamName=stream_name, **record)
+        except ClientError as e:
+            return [{"ErrorCode": e.response["Error"]["Code"], "ErrorMessage": str(e)}]
+        # Only PutRecord sequence numbers are recorded. Commands published in bulk with
+        # PutRecords can't be ordered anyway, and recording theirs would cost a DynamoDB write
+        # per record.
+        self._try_record_seq(record["PartitionKey"], result["SequenceNumber"])
+        return [result]
+
+
+class BufferedCommandPublisher(CommandPublisher):
+    # Buffers commands and publishes them in the background, in batches, once
+    # max_buffered_commands are buffered or the oldest buffered command has waited
+    # max_buffer_seconds. The outcomes returned by the publish methods are filled in when their
+    # batch is published.
+    #
+    # Lambda freezes background threads between invocations, so call flush() (or use the
+    # publisher as a context manager) before the handler returns, and only record commands as
+    # processed once flush() has confirmed that they were published.
+
+    def __init__(
+        self,
+        max_buffered_commands: int = DEFAULT_MAX_BUFFERED_COMMANDS,
+        max_buffer_seconds: float = DEFAULT_MAX_BUFFER_SECONDS,
+    ):
+        super().__init__()
+        self.max_buffered_commands = max_buffered_commands
+        self.max_buffer_seconds = max_buffer_seconds
+        self._lock = threading.Lock()
+        self._buffer: List[Tuple[str, Dict[str, Any]]] = []
+        self._buffered_outcomes: List[PublishOutcome] = []
+        self._buffer_started_at = 0.0
+        self._batches: List[Tuple[Future, List[PublishOutcome]]] = []
+        # A single thread publishes batches in the order they were buffered. Once a batch fails,
+        # later batches aren't published, so a phone number's commands can't be reordered.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _publish_commands(self, commands: List[Tuple[str, Dict[str, Any]]]) -> List[PublishOutcome]:
+        outcomes = [PublishOutcome(phone_number=phone_number) for phone_number, _ in commands]
+        with self._lock:
+            if not self._buffer:
+                self._buffer_started_at = time.monotonic()
+            self._buffer.extend(commands)
+            self._buffered_outcomes.extend(outcomes)
+            if (
+                len(self._buffer) >= self.max_buffered_commands
+                or time.monotonic() - self._buffer_started_at >= self.max_buffer_seconds
+            ):
+                self._submit_buffer()
+        return outcomes
+
+    def _submit_buffer(self):
+        # called with the lock held
+        commands, outcomes = self._buffer, self._buffered_outcomes
+        self._buffer, self._buffered_outcomes = [], []
+        self._batches.append(
+            (self._executor.submit(self._publish_batch, commands, outcomes), outcomes)
+        )
+
+    def _publish_batch(
+        self, commands: List[Tuple[str, Dict[str, Any]]], outcomes: List[PublishOutcome]
+    ):
+        if self._failed:
+            raise CommandPublishError(outcomes)
+        try:
+            self._publish(commands, outcomes)
+        except Exception:
+            self._failed = True
+            raise
+
+    def flush(self) -> List[PublishOutcome]:
+        """Publishes any buffered commands and waits for every batch to be published.
+
+        Returns the outcomes of the commands published since the last flush. Raises
+        CommandPublishError with all of those outcomes if any of them weren't published.
+        """
+        with self._lock:
+            if self._buffer:
+                self._submit_buffer()
+            batches, self._batches = self._batches, []
+        outcomes: List[PublishOutcome] = []
+        error: Optional[Exception] = None
+        for future, batch_outcomes in batches:
+            outcomes.extend(batch_outcomes)
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+        # the next flush starts afresh
+        self._failed = False
+        if isinstance(error, CommandPublishError):
+            raise CommandPublishError(outcomes)
+        if error is not None:
+            raise error
+        return outcomes
@@ -0,0 +1,48 @@
+import os
+from typing import Optional
+
+from stopcovid.utils.dynamodb_cache import DynamoDBCache
+
+DEFAULT_CACHE_SIZE = 4096
+# Kinesis retains records for 24 hours, so older sequence numbers are no use for ordering.
+SEQUENCE_NUMBER_TTL_SECONDS = 24 * 60 * 60
+
+
+class SequenceNumberStore:
+    # The sequence number of the last command published with PutRecord for each phone number,
+    # used as the SequenceNumberForOrdering of the next one. Commands for a phone number are
+    # published from several lambdas, so sequence numbers are shared in a DynamoDB table when
+    # there is one, and cached in memory. We read the table at most once per phone number per
+    # container. A cached sequence number may be older than the latest one, which still orders
+    # the next command after it.
+
+    def __init__(self, table_name: Optional[str] = None, **kwargs):
+        self.table = DynamoDBCache(
+            table_name,
+            "phone_number",
+            ttl_seconds=SEQUENCE_NUMBER_TTL_SECONDS,
+            cache_size=DEFAULT_CACHE_SIZE,
+            **kwargs,
+        )
+
+    def get(self, phone_number: str) -> Optional[str]:
+        item = self.table.get(phone_number)
+        return item["seq"] if item else None
+
+    def put(self, phone_number: str, seq: str):
+        self.table.put(phone_number, {"seq": seq})
+
+    def ensure_table_exists(self):
+        self.table.ensure_table_exists()
+
+
+SEQUENCE_NUMBER_STORE = None
+
+
+def get_sequence_number_store() -> SequenceNumberStore:
+    global SEQUENCE_NUMBER_STORE
+    if SEQUENCE_NUMBER_STORE is None:
+        SEQUENCE_NUMBER_STORE = SequenceNumberStore(
+            os.getenv("COMMAND_SEQUENCE_NUMBERS_TABLE_NAME")
+        )
+    return SEQUENCE_NUMBER_STORE
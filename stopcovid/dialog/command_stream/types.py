@@ -1,6 +1,18 @@
+import base64
+import json
+import zlib
 from dataclasses import dataclass
+from typing import Any, Dict
+
 from marshmallow import Schema, fields, post_load
 
+# INBOUND_SMS commands carry From and Body in the clear, for the dialog handler. The rest of the
+# twilio webhook form is only read by the message log, so it travels as a compressed blob that
+# the dialog handler never has to decode. Older commands carry the form as "twilio_webhook".
+TWILIO_WEBHOOK_KEY = "twilio_webhook"
+COMPRESSED_TWILIO_WEBHOOK_KEY = "twilio_webhook_z"
+_ROUTING_FIELDS = ("From", "Body")
+
 
 class InboundCommandType:
     INBOUND_SMS = "INBOUND_SMS"
@@ -23,3 +35,28 @@ class InboundCommandSchema(Schema):
     @post_load
     def make_sms(self, data, **kwargs):
         return InboundCommand(**data)
+
+
+def make_inbound_sms_payload(
+    phone_number: str, content: str, twilio_webhook: Dict[str, Any]
+) -> Dict[str, Any]:
+    # From and Body are restored from the clear fields, so they aren't stored twice
+    rest = {k: v for k, v in twilio_webhook.items() if k not in _ROUTING_FIELDS}
+    return {
+        "From": phone_number,
+        "Body": content,
+        COMPRESSED_TWILIO_WEBHOOK_KEY: base64.b64encode(
+            zlib.compress(json.dumps(rest, separators=(",", ":")).encode("utf-8"))
+        ).decode("ascii"),
+    }
+
+
+def get_twilio_webhook(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the twilio webhook form from an INBOUND_SMS command payload in either format."""
+    if COMPRESSED_TWILIO_WEBHOOK_KEY not in payload:
+        return payload[TWILIO_WEBHOOK_KEY]
+    twilio_webhook = json.loads(
+        zlib.decompress(base64.b64decode(payload[COMPRESSED_TWILIO_WEBHOOK_KEY])).decode("utf-8")
+    )
+    twilio_webhook.update({key: payload[key] for key in _ROUTING_FIELDS})
+    return twilio_webhook
@@ -1,8 +1,8 @@
 import logging
 import uuid
 from abc import ABC, abstractmethod
-from copy import deepcopy
-from typing import List, Optional, Dict, Any
+from dataclasses import replace
+from typing import List, Optional, Dict, Any, Tuple
 
 import stopcovid.dialog.models.events
 from stopcovid.dialog.models.events import (
@@ -19,12 +19,26 @@ from stopcovid.dialog.models.events import (
     DialogEvent,
     DialogEventBatch,
 )
-from stopcovid.dialog.persistence import DialogRepository, DynamoDBDialogRepository
-from stopcovid.dialog.registration import RegistrationValidator, DefaultRegistrationValidator
+from stopcovid.dialog.persistence import (
+    DialogRepository,
+    DynamoDBDialogRepository,
+    DialogStateConflict,
+    DialogStateWrite,
+)
+from stopcovid.dialog.keywords import is_stateless_keyword
+from stopcovid.dialog.registration import (
+    RegistrationValidator,
+    DefaultRegistrationValidator,
+    DemoCodeFilter,
+    CodeValidationPayload,
+)
 from stopcovid.dialog.models.state import DialogState
 from stopcovid.drills.drills import get_drill
 
 DEFAULT_REGISTRATION_VALIDATOR = DefaultRegistrationValidator()
+DEFAULT_DEMO_CODE_FILTER = DemoCodeFilter()
+
+MAX_PROCESSING_ATTEMPTS = 3
 
 
 class Command(ABC):
@@ -37,33 +51,98 @@ class Command(ABC):
 
 
 def process_command(command: Command, seq: str, repo: DialogRepository = None):
+    process_commands_for_phone_number(command.phone_number, [(command, seq)], repo=repo)
+
+
+def process_commands_for_phone_number(
+    phone_number: str,
+    commands: List[Tuple[Command, str]],
+    repo: DialogRepository = None,
+    dialog_state: Optional[DialogState] = None,
+    consistent_read: bool = False,
+):
+    # dialog_state, if provided, is a prefetched state to use instead of fetching on the first
+    # attempt. consistent_read forces a consistent read on the first attempt, e.g. when we
+    # already know that our view of the dialog state is stale.
     if repo is None:
         repo = DynamoDBDialogRepository()
-    dialog_state = repo.fetch_dialog_state(command.phone_number)
-    command_seq = int(seq)
-    state_seq = int(dialog_state.seq)
-    if command_seq <= state_seq:
+    for attempt in range(1, MAX_PROCESSING_ATTEMPTS + 1):
+        try:
+            # Start with a cheap, eventually consistent read. The dialog state write is
+            # conditional on the sequence number we read, so stale state, duplicate deliveries
+            # and out-of-order deliveries are all rejected at write time. When that happens,
+            # nothing was persisted: we fetch the state again, consistently, and reprocess.
+            write = apply_commands_for_phone_number(
+                phone_number,
+                commands,
+                repo,
+                dialog_state=dialog_state if attempt == 1 else None,
+                consistent_read=consistent_read or attempt > 1,
+            )
+            if write is not None:
+                repo.persist_dialog_state(
+                    write.event_batch, write.dialog_state, previous_seq=write.previous_seq
+                )
+            return
+        except DialogStateConflict:
+            if attempt == MAX_PROCESSING_ATTEMPTS:
+                raise
+            logging.info(
+                f"({phone_number}) Dialog state changed while processing (attempt {attempt}). "
+                f"Retrying."
+            )
+
+
+def apply_commands_for_phone_number(
+    phone_number: str,
+    commands: List[Tuple[Command, str]],
+    repo: DialogRepository,
+    dialog_state: Optional[DialogState] = None,
+    consistent_read: bool = False,
+) -> Optional[DialogStateWrite]:
+    # Applies every command for one phone number to a single fetch of the dialog state, without
+    # persisting anything. The events from all of the commands go into one event batch, tagged
+    # with the sequence number of the last command that was processed. Returns None if every
+    # command had already been processed.
+    if dialog_state is None:
+        dialog_state = repo.fetch_dialog_state(phone_number, consistent_read=consistent_read)
+    previous_seq = dialog_state.seq
+    events: List[DialogEvent] = []
+    last_processed_seq = None
+    for command, seq in sorted(commands, key=lambda command_and_seq: int(command_and_seq[1])):
+        if int(seq) <= int(dialog_state.seq):
+            logging.info(
+                f"({phone_number}) Processing already processed command {seq}. Current "
+                f"dialog state has sequence {dialog_state.seq}."
+            )
+            continue
+
         logging.info(
-            f"({command.phone_number}) Processing already processed command {seq}. Current "
-            f"dialog state has sequence {dialog_state.seq}."
+            f"({phone_number}) Processing command {command}. Current state: {dialog_state}."
         )
-        return
 
-    logging.info(
-        f"({command.phone_number}) Processing command {command}. " f"Current state: {dialog_state}."
-    )
-
-    events = command.execute(dialog_state)
-    event_types = ", ".join(f"{event.event_type}" for event in events)
-    logging.info(f"({command.phone_number}) Applying events: {event_types}")
-    for event in events:
-        # deep copying the event so that modifications to the dialog_state don't have
-        # side effects on the events that we're persisting. The user_profile on the event
-        # should reflect the user_profile *before* the event is applied to the dialog_state.
-        deepcopy(event).apply_to(dialog_state)
-    dialog_state.seq = seq
-    repo.persist_dialog_state(
-        DialogEventBatch(events=events, phone_number=command.phone_number, seq=seq), dialog_state
+        command_events = command.execute(dialog_state)
+        event_types = ", ".join(f"{event.event_type}" for event in command_events)
+        logging.info(f"({phone_number}) Applying events: {event_types}")
+        for event in command_events:
+            event.apply_to(dialog_state)
+            # Events are created with a reference to the dialog state's user profile, which
+            # apply_to() mutates. Give each event its own shallow snapshot of the profile as of
+            # that event, so that later events don't change what earlier events persist. Events
+            # never mutate anything else that they share with the dialog state.
+            event.user_profile = replace(dialog_state.user_profile)
+        dialog_state.seq = seq
+        events.extend(command_events)
+        last_processed_seq = seq
+
+    if last_processed_seq is None:
+        return None
+    return DialogStateWrite(
+        event_batch=DialogEventBatch(
+            events=events, phone_number=phone_number, seq=last_processed_seq
+        ),
+        dialog_state=dialog_state,
+        previous_seq=previous_seq,
     )
 
 
@@ -138,13 +217,19 @@ class ProcessSMSMessage(Command):
         phone_number: str,
         content: str,
         registration_validator: Optional[RegistrationValidator] = None,
+        demo_code_filter: Optional[DemoCodeFilter] = None,
     ):
         super().__init__(phone_number)
         self.content = content.strip()
         self.content_lower = self.content.lower()
         if registration_validator is None:
             registration_validator = DEFAULT_REGISTRATION_VALIDATOR
+            # the filter caches results from the validator, so the default filter only goes with
+            # the default validator
+            if demo_code_filter is None:
+                demo_code_filter = DEFAULT_DEMO_CODE_FILTER
         self.registration_validator = registration_validator
+        self.demo_code_filter = demo_code_filter
 
     def __str__(self):
         return f"Process SMS: '{self.content}'"
@@ -173,8 +258,9 @@ class ProcessSMSMessage(Command):
     def _respond_to_help(
         self, dialog_state: DialogState, base_args: Dict[str, Any]
     ) -> Optional[List[stopcovid.dialog.models.events.DialogEvent]]:
-        if self.content_lower == "help":
-            # Twilio will respond with help text
+        if is_stateless_keyword(self.content_lower):
+            # Twilio will respond with help text. The twilio webhook doesn't publish these, but
+            # messages published before it stopped may still be in the stream.
             return []
 
     def _handle_opt_out(
@@ -196,12 +282,25 @@ class ProcessSMSMessage(Command):
     ) -> Optional[List[stopcovid.dialog.models.events.DialogEvent]]:
 
         if dialog_state.user_profile.is_demo or not dialog_state.user_profile.validated:
-            validation_payload = self.registration_validator.validate_code(self.content_lower)
+            validation_payload = self._validate_code(dialog_state)
             if validation_payload.valid:
                 return [UserValidated(code_validation_payload=validation_payload, **base_args)]
             if not dialog_state.user_profile.validated:
                 return [UserValidationFailed(**base_args)]
 
+    def _validate_code(self, dialog_state: DialogState) -> CodeValidationPayload:
+        if self.demo_code_filter is None:
+            return self.registration_validator.validate_code(self.content_lower)
+        if dialog_state.user_profile.validated:
+            # a demo user, most likely responding to a drill
+            return self.demo_code_filter.validate_code(
+                self.content_lower, self.registration_validator
+            )
+        validation_payload = self.registration_validator.validate_code(self.content_lower)
+        if validation_payload.valid:
+            self.demo_code_filter.learn_code(self.content_lower)
+        return validation_payload
+
     def _check_response(
         self, dialog_state: DialogState, base_args: Dict[str, Any]
     ) -> Optional[List[stopcovid.dialog.models.events.DialogEvent]]:
@@ -0,0 +1,14 @@
+from typing import Dict, Optional
+
+# Keywords whose handling doesn't depend on dialog state, mapped to the text we respond with.
+# None means that we don't respond ourselves: Twilio's messaging service responds to HELP with
+# the help text configured there.
+STATELESS_KEYWORD_RESPONSES: Dict[str, Optional[str]] = {"help": None}
+
+
+def is_stateless_keyword(content: str) -> bool:
+    return content.strip().lower() in STATELESS_KEYWORD_RESPONSES
+
+
+def stateless_keyword_response(content: str) -> Optional[str]:
+    return STATELESS_KEYWORD_RESPONSES.get(content.strip().lower())
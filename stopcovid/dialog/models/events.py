@@ -3,7 +3,7 @@ import enum
 import uuid
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Optional, Dict, Type, Any, List
+from typing import Optional, Dict, Type, Any, List, Tuple, Collection, Iterable
 
 from marshmallow import fields, post_load, utils, Schema
 
@@ -11,6 +11,15 @@ from stopcovid.dialog.registration import CodeValidationPayloadSchema, CodeValid
 from stopcovid.dialog.models.state import DialogState, UserProfileSchema, UserProfile, PromptState
 from stopcovid.dialog.models import SCHEMA_VERSION
 from stopcovid.drills import drills
+from stopcovid.utils import dynamodb as dynamodb_utils
+from stopcovid.drills.drill_store import (
+    DrillField,
+    PromptField,
+    serialize_drill,
+    deserialize_drill,
+    serialize_prompt,
+    deserialize_prompt,
+)
 
 
 class EventTypeField(fields.Field):
@@ -35,9 +44,9 @@ class DialogEventSchema(Schema):
 
 
 class DrillStartedSchema(DialogEventSchema):
-    drill = fields.Nested(drills.DrillSchema, required=True)
+    drill = DrillField(required=True)
     drill_instance_id = fields.UUID(required=True)
-    first_prompt = fields.Nested(drills.PromptSchema, required=True)
+    first_prompt = PromptField(required=True)
 
     @post_load
     def make_drill_started(self, data, **kwargs):
@@ -58,15 +67,17 @@ class DialogEventType(enum.Enum):
 
 
 class DialogEvent(ABC):
+    # the top-level DialogState attributes that apply_to() may change. Used to persist only what
+    # changed.
+    changed_state_attributes: Tuple[str, ...] = ()
+
     def __init__(
         self,
-        schema: Schema,
         event_type: DialogEventType,
         phone_number: str,
         user_profile: UserProfile,
         **kwargs,
     ):
-        self.schema = schema
         self.phone_number = phone_number
 
         # relying on created time to determine ordering. We should be fine and it's simpler than
@@ -82,11 +93,38 @@ class DialogEvent(ABC):
     def apply_to(self, dialog_state: DialogState):
         pass
 
+    @property
+    def schema(self) -> Schema:
+        return TYPE_TO_SCHEMA[self.event_type]()
+
     def to_dict(self) -> Dict:
-        return self.schema.dump(self)
+        # Equivalent to self.schema.dump(self). Every event is serialized by handleCommand and
+        # deserialized by each consumer of the event stream, and marshmallow is several times
+        # slower than building the dict ourselves. The schemas remain the reference
+        # implementation: tests check that the two agree.
+        return {
+            "phone_number": self.phone_number,
+            "created_time": self.created_time.isoformat(),
+            "event_id": str(self.event_id),
+            "event_type": self.event_type.name,
+            "user_profile": self.user_profile.to_dict(),
+            "schema_version": self.schema_version,
+            **self._fields_to_dict(),
+        }
+
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        # the fields that are specific to the event type
+        return {}
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "DialogEvent":
+        # kwargs holds the fields that all events share
+        return cls(**kwargs)
 
 
 class DrillStarted(DialogEvent):
+    changed_state_attributes = ("current_drill", "drill_instance_id", "current_prompt_state")
+
     def __init__(
         self,
         phone_number: str,
@@ -96,7 +134,6 @@ class DrillStarted(DialogEvent):
         **kwargs,
     ):
         super().__init__(
-            DrillStartedSchema(),
             DialogEventType.DRILL_STARTED,
             phone_number,
             user_profile,
@@ -106,6 +143,22 @@ class DrillStarted(DialogEvent):
         self.first_prompt = first_prompt
         self.drill_instance_id = kwargs.get("drill_instance_id", uuid.uuid4())
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        return {
+            "drill": serialize_drill(self.drill),
+            "drill_instance_id": str(self.drill_instance_id),
+            "first_prompt": serialize_prompt(self.first_prompt),
+        }
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "DrillStarted":
+        return cls(
+            drill=deserialize_drill(event_dict["drill"]),
+            drill_instance_id=uuid.UUID(event_dict["drill_instance_id"]),
+            first_prompt=deserialize_prompt(event_dict["first_prompt"]),
+            **kwargs,
+        )
+
     def apply_to(self, dialog_state: DialogState):
         dialog_state.current_drill = self.drill
         dialog_state.drill_instance_id = self.drill_instance_id
@@ -121,9 +174,10 @@ class ReminderTriggeredSchema(DialogEventSchema):
 
 
 class ReminderTriggered(DialogEvent):
+    changed_state_attributes = ("current_prompt_state",)
+
     def __init__(self, phone_number: str, user_profile: UserProfile, **kwargs):
         super().__init__(
-            ReminderTriggeredSchema(),
             DialogEventType.REMINDER_TRIGGERED,
             phone_number,
             user_profile,
@@ -143,6 +197,13 @@ class UserValidatedSchema(DialogEventSchema):
 
 
 class UserValidated(DialogEvent):
+    changed_state_attributes = (
+        "drill_instance_id",
+        "current_prompt_state",
+        "current_drill",
+        "user_profile",
+    )
+
     def __init__(
         self,
         phone_number: str,
@@ -151,7 +212,6 @@ class UserValidated(DialogEvent):
         **kwargs,
     ):
         super().__init__(
-            UserValidatedSchema(),
             DialogEventType.USER_VALIDATED,
             phone_number,
             user_profile,
@@ -159,13 +219,41 @@ class UserValidated(DialogEvent):
         )
         self.code_validation_payload = code_validation_payload
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        payload = self.code_validation_payload
+        return {
+            "code_validation_payload": {
+                "valid": payload.valid,
+                "is_demo": payload.is_demo,
+                "account_info": (
+                    None
+                    if payload.account_info is None
+                    else {str(k): v for k, v in payload.account_info.items()}
+                ),
+            }
+        }
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "UserValidated":
+        payload = event_dict["code_validation_payload"]
+        account_info = payload.get("account_info", {})
+        return cls(
+            code_validation_payload=CodeValidationPayload(
+                valid=payload["valid"],
+                is_demo=payload.get("is_demo", False),
+                account_info=None if account_info is None else dict(account_info),
+            ),
+            **kwargs,
+        )
+
     def apply_to(self, dialog_state: DialogState):
         dialog_state.drill_instance_id = None
         dialog_state.current_prompt_state = None
         dialog_state.current_drill = None
         dialog_state.user_profile.validated = True
         dialog_state.user_profile.is_demo = self.code_validation_payload.is_demo
-        dialog_state.user_profile.account_info = self.code_validation_payload.account_info
+        # copied so that the dialog state and the event don't share a mutable dict
+        dialog_state.user_profile.account_info = dict(self.code_validation_payload.account_info)
 
 
 class UserValidationFailedSchema(DialogEventSchema):
@@ -177,7 +265,6 @@ class UserValidationFailedSchema(DialogEventSchema):
 class UserValidationFailed(DialogEvent):
     def __init__(self, phone_number: str, user_profile: UserProfile, **kwargs):
         super().__init__(
-            UserValidationFailedSchema(),
             DialogEventType.USER_VALIDATION_FAILED,
             phone_number,
             user_profile,
@@ -189,7 +276,7 @@ class UserValidationFailed(DialogEvent):
 
 
 class CompletedPromptSchema(DialogEventSchema):
-    prompt = fields.Nested(drills.PromptSchema, required=True)
+    prompt = PromptField(required=True)
     response = fields.String(required=True)
     drill_instance_id = fields.UUID(required=True)
 
@@ -199,6 +286,8 @@ class CompletedPromptSchema(DialogEventSchema):
 
 
 class CompletedPrompt(DialogEvent):
+    changed_state_attributes = ("current_prompt_state", "user_profile")
+
     def __init__(
         self,
         phone_number: str,
@@ -209,7 +298,6 @@ class CompletedPrompt(DialogEvent):
         **kwargs,
     ):
         super().__init__(
-            CompletedPromptSchema(),
             DialogEventType.COMPLETED_PROMPT,
             phone_number,
             user_profile,
@@ -219,6 +307,22 @@ class CompletedPrompt(DialogEvent):
         self.response = response
         self.drill_instance_id = drill_instance_id
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt": serialize_prompt(self.prompt),
+            "response": self.response,
+            "drill_instance_id": str(self.drill_instance_id),
+        }
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "CompletedPrompt":
+        return cls(
+            prompt=deserialize_prompt(event_dict["prompt"]),
+            response=event_dict["response"],
+            drill_instance_id=uuid.UUID(event_dict["drill_instance_id"]),
+            **kwargs,
+        )
+
     def apply_to(self, dialog_state: DialogState):
         dialog_state.current_prompt_state = None
         if self.prompt.response_user_profile_key:
@@ -226,7 +330,7 @@ class CompletedPrompt(DialogEvent):
 
 
 class FailedPromptSchema(DialogEventSchema):
-    prompt = fields.Nested(drills.PromptSchema, required=True)
+    prompt = PromptField(required=True)
     abandoned = fields.Boolean(required=True)
     response = fields.String(required=True)
     drill_instance_id = fields.UUID(required=True)
@@ -237,6 +341,8 @@ class FailedPromptSchema(DialogEventSchema):
 
 
 class FailedPrompt(DialogEvent):
+    changed_state_attributes = ("current_prompt_state",)
+
     def __init__(
         self,
         phone_number: str,
@@ -248,7 +354,6 @@ class FailedPrompt(DialogEvent):
         **kwargs,
     ):
         super().__init__(
-            FailedPromptSchema(),
             DialogEventType.FAILED_PROMPT,
             phone_number,
             user_profile,
@@ -259,6 +364,24 @@ class FailedPrompt(DialogEvent):
         self.response = response
         self.drill_instance_id = drill_instance_id
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt": serialize_prompt(self.prompt),
+            "abandoned": self.abandoned,
+            "response": self.response,
+            "drill_instance_id": str(self.drill_instance_id),
+        }
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "FailedPrompt":
+        return cls(
+            prompt=deserialize_prompt(event_dict["prompt"]),
+            abandoned=event_dict["abandoned"],
+            response=event_dict["response"],
+            drill_instance_id=uuid.UUID(event_dict["drill_instance_id"]),
+            **kwargs,
+        )
+
     def apply_to(self, dialog_state: DialogState):
         if self.abandoned:
             dialog_state.current_prompt_state = None
@@ -268,7 +391,7 @@ class FailedPrompt(DialogEvent):
 
 
 class AdvancedToNextPromptSchema(DialogEventSchema):
-    prompt = fields.Nested(drills.PromptSchema, required=True)
+    prompt = PromptField(required=True)
     drill_instance_id = fields.UUID(required=True)
 
     @post_load
@@ -277,6 +400,8 @@ class AdvancedToNextPromptSchema(DialogEventSchema):
 
 
 class AdvancedToNextPrompt(DialogEvent):
+    changed_state_attributes = ("current_prompt_state",)
+
     def __init__(
         self,
         phone_number: str,
@@ -286,7 +411,6 @@ class AdvancedToNextPrompt(DialogEvent):
         **kwargs,
     ):
         super().__init__(
-            AdvancedToNextPromptSchema(),
             DialogEventType.ADVANCED_TO_NEXT_PROMPT,
             phone_number,
             user_profile,
@@ -295,6 +419,20 @@ class AdvancedToNextPrompt(DialogEvent):
         self.prompt = prompt
         self.drill_instance_id = drill_instance_id
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt": serialize_prompt(self.prompt),
+            "drill_instance_id": str(self.drill_instance_id),
+        }
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "AdvancedToNextPrompt":
+        return cls(
+            prompt=deserialize_prompt(event_dict["prompt"]),
+            drill_instance_id=uuid.UUID(event_dict["drill_instance_id"]),
+            **kwargs,
+        )
+
     def apply_to(self, dialog_state: DialogState):
         dialog_state.current_prompt_state = PromptState(
             self.prompt.slug, start_time=self.created_time
@@ -310,11 +448,12 @@ class DrillCompletedSchema(DialogEventSchema):
 
 
 class DrillCompleted(DialogEvent):
+    changed_state_attributes = ("current_drill", "drill_instance_id", "current_prompt_state")
+
     def __init__(
         self, phone_number: str, user_profile: UserProfile, drill_instance_id: uuid.UUID, **kwargs
     ):
         super().__init__(
-            DrillCompletedSchema(),
             DialogEventType.DRILL_COMPLETED,
             phone_number,
             user_profile,
@@ -322,6 +461,13 @@ class DrillCompleted(DialogEvent):
         )
         self.drill_instance_id = drill_instance_id
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        return {"drill_instance_id": str(self.drill_instance_id)}
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "DrillCompleted":
+        return cls(drill_instance_id=uuid.UUID(event_dict["drill_instance_id"]), **kwargs)
+
     def apply_to(self, dialog_state: DialogState):
         dialog_state.current_drill = None
         dialog_state.drill_instance_id = None
@@ -329,7 +475,7 @@ class DrillCompleted(DialogEvent):
 
 
 class OptedOutSchema(DialogEventSchema):
-    drill_instance_id = fields.UUID()
+    drill_instance_id = fields.UUID(allow_none=True)
 
     @post_load
     def make_opted_out(self, data, **kwargs):
@@ -337,6 +483,13 @@ class OptedOutSchema(DialogEventSchema):
 
 
 class OptedOut(DialogEvent):
+    changed_state_attributes = (
+        "drill_instance_id",
+        "user_profile",
+        "current_drill",
+        "current_prompt_state",
+    )
+
     def __init__(
         self,
         phone_number: str,
@@ -344,11 +497,24 @@ class OptedOut(DialogEvent):
         drill_instance_id: Optional[uuid.UUID],
         **kwargs,
     ):
-        super().__init__(
-            OptedOutSchema(), DialogEventType.OPTED_OUT, phone_number, user_profile, **kwargs
-        )
+        super().__init__(DialogEventType.OPTED_OUT, phone_number, user_profile, **kwargs)
         self.drill_instance_id = drill_instance_id
 
+    def _fields_to_dict(self) -> Dict[str, Any]:
+        return {
+            "drill_instance_id": (
+                None if self.drill_instance_id is None else str(self.drill_instance_id)
+            )
+        }
+
+    @classmethod
+    def _from_dict(cls, event_dict: Dict[str, Any], **kwargs) -> "OptedOut":
+        drill_instance_id = event_dict.get("drill_instance_id")
+        return cls(
+            drill_instance_id=None if drill_instance_id is None else uuid.UUID(drill_instance_id),
+            **kwargs,
+        )
+
     def apply_to(self, dialog_state: DialogState):
         dialog_state.drill_instance_id = None
         dialog_state.user_profile.opted_out = True
@@ -363,9 +529,10 @@ class NextDrillRequestedSchema(DialogEventSchema):
 
 
 class NextDrillRequested(DialogEvent):
+    changed_state_attributes = ("user_profile",)
+
     def __init__(self, phone_number: str, user_profile: UserProfile, **kwargs):
         super().__init__(
-            NextDrillRequestedSchema(),
             DialogEventType.NEXT_DRILL_REQUESTED,
             phone_number,
             user_profile,
@@ -390,9 +557,33 @@ TYPE_TO_SCHEMA: Dict[DialogEventType, Type[DialogEventSchema]] = {
 }
 
 
+TYPE_TO_EVENT: Dict[DialogEventType, Type[DialogEvent]] = {
+    DialogEventType.ADVANCED_TO_NEXT_PROMPT: AdvancedToNextPrompt,
+    DialogEventType.DRILL_COMPLETED: DrillCompleted,
+    DialogEventType.USER_VALIDATION_FAILED: UserValidationFailed,
+    DialogEventType.DRILL_STARTED: DrillStarted,
+    DialogEventType.USER_VALIDATED: UserValidated,
+    DialogEventType.COMPLETED_PROMPT: CompletedPrompt,
+    DialogEventType.FAILED_PROMPT: FailedPrompt,
+    DialogEventType.REMINDER_TRIGGERED: ReminderTriggered,
+    DialogEventType.OPTED_OUT: OptedOut,
+    DialogEventType.NEXT_DRILL_REQUESTED: NextDrillRequested,
+}
+
+
 def event_from_dict(event_dict: Dict[str, Any]) -> DialogEvent:
     event_type = DialogEventType[event_dict["event_type"]]
-    return TYPE_TO_SCHEMA[event_type]().load(event_dict)
+    try:
+        return TYPE_TO_EVENT[event_type]._from_dict(
+            event_dict,
+            phone_number=event_dict["phone_number"],
+            created_time=datetime.datetime.fromisoformat(event_dict["created_time"]),
+            event_id=uuid.UUID(event_dict["event_id"]),
+            user_profile=UserProfile.from_dict(event_dict["user_profile"]),
+        )
+    except (KeyError, TypeError, ValueError, AttributeError):
+        # Not something that we wrote. Let marshmallow validate it and explain what's wrong.
+        return TYPE_TO_SCHEMA[event_type]().load(event_dict)
 
 
 @dataclass
@@ -410,7 +601,7 @@ class DialogEventBatch:
             "batch_id": str(self.batch_id),
             "seq": self.seq,
             "phone_number": self.phone_number,
-            "created_time": utils.isoformat(self.created_time),
+            "created_time": self.created_time.isoformat(),
             "events": [event.to_dict() for event in self.events],
         }
 
@@ -423,3 +614,35 @@ def batch_from_dict(batch_dict: Dict[str, Any]) -> DialogEventBatch:
         created_time=utils.from_iso_datetime(batch_dict["created_time"]),
         events=[event_from_dict(event_dict) for event_dict in batch_dict["events"]],
     )
+
+
+def batch_from_dynamodb_image(
+    image: Dict[str, Any], event_types: Optional[Collection[DialogEventType]] = None
+) -> DialogEventBatch:
+    # Builds a batch from the low-level attribute map in a DynamoDB stream record. Stream
+    # consumers usually care about a few event types, so we peek at each event's type and only
+    # deserialize the events in event_types (all of them if event_types is None).
+    if dynamodb_utils.is_compressed(image):
+        batch_dict = dynamodb_utils.deserialize_item(image)
+        event_dicts: Iterable[Dict[str, Any]] = (
+            event_dict
+            for event_dict in batch_dict["events"]
+            if event_types is None or DialogEventType[event_dict["event_type"]] in event_types
+        )
+    else:
+        batch_dict = {
+            key: image[key]["S"] for key in ("batch_id", "phone_number", "seq", "created_time")
+        }
+        event_dicts = (
+            dynamodb_utils.deserialize(event_attribute["M"])
+            for event_attribute in image["events"]["L"]
+            if event_types is None
+            or DialogEventType[event_attribute["M"]["event_type"]["S"]] in event_types
+        )
+    return DialogEventBatch(
+        batch_id=uuid.UUID(batch_dict["batch_id"]),
+        phone_number=batch_dict["phone_number"],
+        seq=batch_dict["seq"],
+        created_time=utils.from_iso_datetime(batch_dict["created_time"]),
+        events=[event_from_dict(event_dict) for event_dict in event_dicts],
+    )
@@ -7,16 +7,21 @@ from marshmallow import Schema, fields, post_load
 
 from stopcovid.dialog.models import SCHEMA_VERSION
 from stopcovid.drills import drills
+from stopcovid.drills.drill_store import DrillField
+
+
+def _serialize_account_info(value):
+    if "employer_id" in value:
+        value["employer_id"] = int(value["employer_id"])
+
+    if "unit_id" in value:
+        value["unit_id"] = int(value["unit_id"])
+    return value
 
 
 class AccountInfoField(fields.Mapping):
     def _serialize(self, value, attr, obj, **kwargs):
-        if "employer_id" in value:
-            value["employer_id"] = int(value["employer_id"])
-
-        if "unit_id" in value:
-            value["unit_id"] = int(value["unit_id"])
-        return value
+        return _serialize_account_info(value)
 
     def _deserialize(self, value, attr, data, **kwargs):
         return value
@@ -62,7 +67,30 @@ class UserProfile:
         return f"lang={self.language}, validated={self.validated}, " f"name={self.name}"
 
     def to_dict(self):
-        return UserProfileSchema().dump(self)
+        # equivalent to UserProfileSchema().dump(self). User profiles are serialized with every
+        # dialog event, so we skip marshmallow.
+        return {
+            "validated": self.validated,
+            "opted_out": self.opted_out,
+            "language": self.language,
+            "name": self.name,
+            "account_info": _serialize_account_info(self.account_info),
+            "is_demo": self.is_demo,
+            "self_rating_1": self.self_rating_1,
+            "self_rating_2": self.self_rating_2,
+            "self_rating_3": self.self_rating_3,
+            "self_rating_4": self.self_rating_4,
+            "self_rating_5": self.self_rating_5,
+            "self_rating_6": self.self_rating_6,
+            "self_rating_7": self.self_rating_7,
+        }
+
+    @staticmethod
+    def from_dict(profile_dict: Dict[str, Any]) -> "UserProfile":
+        try:
+            return UserProfile(**profile_dict)
+        except TypeError:
+            return UserProfileSchema().load(profile_dict)
 
 
 class PromptStateSchema(Schema):
@@ -92,7 +120,7 @@ class DialogStateSchema(Schema):
     user_profile = fields.Nested(UserProfileSchema, allow_none=True)
     # persist the entire drill so that modifications to drills don"t affect
     # drills that are in flight
-    current_drill = fields.Nested(drills.DrillSchema, allow_none=True)
+    current_drill = DrillField(allow_none=True)
     drill_instance_id = fields.UUID(allow_none=True)
     current_prompt_state = fields.Nested(PromptStateSchema, allow_none=True)
     schema_version = fields.Integer(missing=1)
@@ -1,31 +1,122 @@
+import logging
 import os
+import time
 import uuid
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Tuple, Iterable, List
 
 import boto3
 
 from stopcovid.utils import dynamodb as dynamodb_utils
+from stopcovid.utils.cache import LRUCache
 from .models.state import DialogState, DialogStateSchema
 from .models.events import DialogEventBatch, batch_from_dict
 
+DEFAULT_STATE_CACHE_SIZE = 1024
+
+# BatchGetItem accepts at most 100 keys
+MAX_BATCH_GET_KEYS = 100
+MAX_BATCH_GET_ATTEMPTS = 4
+BATCH_GET_BACKOFF_SECONDS = 0.05
+
+# A transaction can contain at most 100 items. Each phone number needs two: its event batch and
+# its dialog state.
+MAX_TRANSACTION_ITEMS = 100
+MAX_WRITES_PER_TRANSACTION = MAX_TRANSACTION_ITEMS // 2
+
+# the sequence number of a dialog state that has never been persisted
+INITIAL_SEQ = "0"
+
+# Attributes that stay readable when an item is compressed: keys, index keys, and attributes that
+# are used in condition expressions.
+STATE_READABLE_ATTRIBUTES = ("phone_number", "seq")
+EVENT_BATCH_READABLE_ATTRIBUTES = ("phone_number", "batch_id", "created_time", "seq")
+
+
+class DialogStateConflict(Exception):
+    """The persisted dialog state has changed since it was fetched."""
+
+
+@dataclass
+class DialogStateWrite:
+    event_batch: DialogEventBatch
+    dialog_state: DialogState
+    previous_seq: Optional[str] = None
+
 
 class DialogRepository(ABC):
     @abstractmethod
-    def fetch_dialog_state(self, phone_number: str) -> DialogState:
+    def fetch_dialog_state(self, phone_number: str, consistent_read: bool = False) -> DialogState:
         pass
 
+    def fetch_dialog_states(
+        self, phone_numbers: Iterable[str], consistent_read: bool = False
+    ) -> Dict[str, DialogState]:
+        # Repositories that can fetch several states at once should override this. Phone numbers
+        # whose states couldn't be fetched may be left out of the result.
+        return {
+            phone_number: self.fetch_dialog_state(phone_number, consistent_read=consistent_read)
+            for phone_number in set(phone_numbers)
+        }
+
     @abstractmethod
-    def persist_dialog_state(self, event_batch: DialogEventBatch, dialog_state: DialogState):
+    def persist_dialog_state(
+        self,
+        event_batch: DialogEventBatch,
+        dialog_state: DialogState,
+        previous_seq: Optional[str] = None,
+    ):
+        # If previous_seq is provided, the write must fail with DialogStateConflict unless the
+        # persisted dialog state is still at previous_seq.
         pass
 
+    def persist_dialog_states(self, writes: List[DialogStateWrite]) -> Dict[str, Exception]:
+        # Persists writes for several phone numbers. Each write succeeds or fails on its own.
+        # Returns the failures by phone number: DialogStateConflict when the state has moved on,
+        # or whatever else went wrong. Repositories that can persist several states at once
+        # should override this.
+        failures: Dict[str, Exception] = {}
+        for write in writes:
+            phone_number = write.dialog_state.phone_number
+            try:
+                self.persist_dialog_state(
+                    write.event_batch, write.dialog_state, previous_seq=write.previous_seq
+                )
+            except DialogStateConflict as e:
+                failures[phone_number] = e
+            except Exception as e:
+                logging.error(f"({phone_number}) Failed to persist dialog state", exc_info=True)
+                failures[phone_number] = e
+        return failures
+
 
 class DynamoDBDialogRepository(DialogRepository):
-    def __init__(self, table_name_suffix=None, **kwargs):
+    def __init__(
+        self,
+        table_name_suffix=None,
+        state_cache_size: int = DEFAULT_STATE_CACHE_SIZE,
+        compress_items: Optional[bool] = None,
+        **kwargs,
+    ):
         self.dynamodb = boto3.client("dynamodb", **kwargs)
         if table_name_suffix is None:
             table_name_suffix = os.getenv("DIALOG_TABLE_NAME_SUFFIX", "")
         self.table_name_suffix = table_name_suffix
 
+        # Whether new items are written as a compressed payload. Items are read in either format,
+        # so this can be switched on or off at any time.
+        if compress_items is None:
+            compress_items = os.getenv("COMPRESS_DIALOG_ITEMS", "false").lower() == "true"
+        self.compress_items = compress_items
+
+        # Commands are partitioned by phone number, so a warm container tends to see the same
+        # phone numbers over and over. We keep the states that we've persisted so that we don't
+        # need to read and deserialize them again. A cached state is handed out (and removed from
+        # the cache) on fetch, and only put back once a write that is conditional on its sequence
+        # number succeeds. So a stale cached state can never overwrite newer state.
+        self.state_cache = LRUCache(state_cache_size)
+
     def event_batch_table_name(self):
         return (
             f"dialog-event-batches-{self.table_name_suffix}"
@@ -38,44 +129,218 @@ class DynamoDBDialogRepository(DialogRepository):
             f"dialog-state-{self.table_name_suffix}" if self.table_name_suffix else "dialog-state"
         )
 
-    def fetch_dialog_state(self, phone_number: str) -> DialogState:
+    def fetch_dialog_state(self, phone_number: str, consistent_read: bool = False) -> DialogState:
+        # An eventually consistent read is usually good enough: writes are conditional on the
+        # sequence number that we read, so a stale read is rejected when we persist.
+        cached_state = self.state_cache.pop(phone_number)
+        if cached_state is not None:
+            return cached_state
         response = self.dynamodb.get_item(
             TableName=self.state_table_name(),
             Key={"phone_number": {"S": phone_number}},
-            ConsistentRead=True,
+            ConsistentRead=consistent_read,
         )
         if "Item" not in response:
-            return DialogState(phone_number=phone_number, seq="0")
-        dialog_dict = dynamodb_utils.deserialize(response["Item"])
+            return DialogState(phone_number=phone_number, seq=INITIAL_SEQ)
+        dialog_dict = dynamodb_utils.deserialize_item(response["Item"])
         return DialogStateSchema().load(dialog_dict)
 
+    def fetch_dialog_states(
+        self, phone_numbers: Iterable[str], consistent_read: bool = False
+    ) -> Dict[str, DialogState]:
+        states = {}
+        to_fetch = []
+        for phone_number in set(phone_numbers):
+            cached_state = self.state_cache.pop(phone_number)
+            if cached_state is not None:
+                states[phone_number] = cached_state
+            else:
+                to_fetch.append(phone_number)
+
+        for start in range(0, len(to_fetch), MAX_BATCH_GET_KEYS):
+            end = start + MAX_BATCH_GET_KEYS
+            chunk = to_fetch[start:end]
+            fetched = self._batch_get_states(chunk, consistent_read)
+            for phone_number in chunk:
+                if phone_number in fetched:
+                    states[phone_number] = fetched[phone_number]
+        return states
+
+    def _batch_get_states(
+        self, phone_numbers: List[str], consistent_read: bool
+    ) -> Dict[str, DialogState]:
+        # Returns the states for the phone numbers that DynamoDB processed, including new states
+        # for phone numbers that have none. Keys that are still unprocessed after
+        # MAX_BATCH_GET_ATTEMPTS are left out, and will be fetched individually.
+        table_name = self.state_table_name()
+        request_items = {
+            table_name: {
+                "Keys": [{"phone_number": {"S": phone_number}} for phone_number in phone_numbers],
+                "ConsistentRead": consistent_read,
+            }
+        }
+        states = {}
+        unprocessed = set()
+        for attempt in range(MAX_BATCH_GET_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(BATCH_GET_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            response = self.dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(table_name, []):
+                state = DialogStateSchema().load(dynamodb_utils.deserialize_item(item))
+                states[state.phone_number] = state
+            request_items = response.get("UnprocessedKeys") or {}
+            unprocessed = {
+                key["phone_number"]["S"]
+                for key in request_items.get(table_name, {}).get("Keys", [])
+            }
+            if not unprocessed:
+                break
+
+        if unprocessed:
+            logging.warning(f"Unable to batch fetch dialog state for {len(unprocessed)} phones")
+        for phone_number in phone_numbers:
+            if phone_number not in states and phone_number not in unprocessed:
+                states[phone_number] = DialogState(phone_number=phone_number, seq=INITIAL_SEQ)
+        return states
+
     def fetch_dialog_event_batch(self, phone_number: str, batch_id: uuid.UUID) -> DialogEventBatch:
         response = self.dynamodb.get_item(
             TableName=self.event_batch_table_name(),
             Key={"phone_number": {"S": phone_number}, "batch_id": {"S": str(batch_id)}},
             ConsistentRead=True,
         )
-        dialog_dict = dynamodb_utils.deserialize(response["Item"])
+        dialog_dict = dynamodb_utils.deserialize_item(response["Item"])
 
         return batch_from_dict(dialog_dict)
 
-    def persist_dialog_state(self, event_batch: DialogEventBatch, dialog_state: DialogState):
+    def persist_dialog_state(
+        self,
+        event_batch: DialogEventBatch,
+        dialog_state: DialogState,
+        previous_seq: Optional[str] = None,
+    ):
         if event_batch.events:
-            write_items = [
-                {
-                    "Put": {
-                        "TableName": self.event_batch_table_name(),
-                        "Item": dynamodb_utils.serialize(event_batch.to_dict()),
-                    }
-                },
-                {
-                    "Put": {
-                        "TableName": self.state_table_name(),
-                        "Item": dynamodb_utils.serialize(dialog_state.to_dict()),
-                    }
+            write_items = self._write_items(
+                DialogStateWrite(event_batch, dialog_state, previous_seq)
+            )
+            try:
+                self.dynamodb.transact_write_items(TransactItems=write_items)
+            except self.dynamodb.exceptions.TransactionCanceledException as e:
+                if "ConditionalCheckFailed" in str(e):
+                    logging.info(
+                        f"({dialog_state.phone_number}) Dialog state is no longer at seq "
+                        f"{previous_seq}"
+                    )
+                    raise DialogStateConflict(dialog_state.phone_number) from e
+                raise
+            self.state_cache.put(dialog_state.phone_number, dialog_state)
+
+    def persist_dialog_states(self, writes: List[DialogStateWrite]) -> Dict[str, Exception]:
+        # Writes for many phone numbers are packed into as few transactions as possible. Each
+        # phone number's state write is still conditional on its own sequence number. When a
+        # transaction fails for any reason (a failed condition, a transaction conflict, throttling,
+        # an oversized item), we fall back to writing each phone number in it on its own, so that
+        # only the phone numbers with a problem fail.
+        writes = [write for write in writes if write.event_batch.events]
+        failures: Dict[str, Exception] = {}
+        for start in range(0, len(writes), MAX_WRITES_PER_TRANSACTION):
+            end = start + MAX_WRITES_PER_TRANSACTION
+            chunk = writes[start:end]
+            try:
+                self.dynamodb.transact_write_items(
+                    TransactItems=[item for write in chunk for item in self._write_items(write)]
+                )
+            except Exception as e:
+                logging.info(
+                    f"Transaction of {len(chunk)} phone numbers failed ({e}). "
+                    f"Persisting them one at a time."
+                )
+                failures.update(super().persist_dialog_states(chunk))
+                continue
+            for write in chunk:
+                self.state_cache.put(write.dialog_state.phone_number, write.dialog_state)
+        return failures
+
+    def _write_items(self, write: DialogStateWrite) -> List[Dict[str, Any]]:
+        return [
+            {
+                "Put": {
+                    "TableName": self.event_batch_table_name(),
+                    "Item": self._serialize_item(
+                        write.event_batch.to_dict(), EVENT_BATCH_READABLE_ATTRIBUTES
+                    ),
+                }
+            },
+            self._state_write_item(write.event_batch, write.dialog_state, write.previous_seq),
+        ]
+
+    def _state_write_item(
+        self, event_batch: DialogEventBatch, dialog_state: DialogState, previous_seq: Optional[str]
+    ) -> Dict[str, Any]:
+        changed_attributes = {
+            attribute
+            for event in event_batch.events
+            for attribute in event.changed_state_attributes
+        }
+        if (
+            previous_seq is None
+            or previous_seq == INITIAL_SEQ
+            or (dialog_state.current_drill is not None and "current_drill" in changed_attributes)
+        ):
+            # The whole item is written when we can't be sure that an item already exists or when
+            # a new drill is stored. Anything else is a small change to an existing item.
+            state_put: Dict[str, Any] = {
+                "TableName": self.state_table_name(),
+                "Item": self._serialize_item(dialog_state.to_dict(), STATE_READABLE_ATTRIBUTES),
+            }
+            if previous_seq is not None:
+                state_put.update(self._seq_condition(previous_seq))
+            return {"Put": state_put}
+
+        state_dict = DialogStateSchema(only=("schema_version", *sorted(changed_attributes))).dump(
+            dialog_state
+        )
+        # Cleared attributes are set to null rather than removed, because a removed attribute
+        # would fall back to its value in a compressed payload.
+        set_clauses = ["#seq = :seq"]
+        names = {}
+        values: Dict[str, Any] = {":seq": dialog_state.seq}
+        for i, (attribute, value) in enumerate(sorted(state_dict.items())):
+            names[f"#a{i}"] = attribute
+            set_clauses.append(f"#a{i} = :a{i}")
+            values[f":a{i}"] = value
+        update_expression = f"SET {', '.join(set_clauses)}"
+        # an update would create a partial item if the item didn't exist
+        condition = self._seq_condition(previous_seq, allow_new_item=False)
+        return {
+            "Update": {
+                "TableName": self.state_table_name(),
+                "Key": {"phone_number": {"S": dialog_state.phone_number}},
+                "UpdateExpression": update_expression,
+                "ConditionExpression": condition["ConditionExpression"],
+                "ExpressionAttributeNames": {**names, **condition["ExpressionAttributeNames"]},
+                "ExpressionAttributeValues": {
+                    **dynamodb_utils.serialize(values),
+                    **condition["ExpressionAttributeValues"],
                 },
-            ]
-            self.dynamodb.transact_write_items(TransactItems=write_items)
+            }
+        }
+
+    def _serialize_item(self, item_dict: Dict[str, Any], readable_attributes: Tuple[str, ...]):
+        if self.compress_items:
+            return dynamodb_utils.serialize_compressed(item_dict, readable_attributes)
+        return dynamodb_utils.serialize(item_dict)
+
+    @staticmethod
+    def _seq_condition(previous_seq: str, allow_new_item: bool = True) -> Dict[str, Any]:
+        condition_expression = "#seq = :previous_seq"
+        if allow_new_item:
+            condition_expression = f"attribute_not_exists(phone_number) OR {condition_expression}"
+        return {
+            "ConditionExpression": condition_expression,
+            "ExpressionAttributeNames": {"#seq": "seq"},
+            "ExpressionAttributeValues": {":previous_seq": {"S": previous_seq}},
+        }
 
     def ensure_tables_exist(self):
         # useful for testing but will likely be duplicated elsewhere
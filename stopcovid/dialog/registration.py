@@ -1,11 +1,26 @@
-import functools
+import json
+import logging
 import os
+import re
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import requests
 from marshmallow import Schema, fields, post_load
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from stopcovid.utils.cache import LRUCache, TTLCache
+from stopcovid.utils.dynamodb_cache import DynamoDBCache
+
+VALIDATION_CACHE_SIZE = 1024
+VALIDATION_CACHE_TTL_SECONDS = 900
+VALIDATION_CONNECT_TIMEOUT_SECONDS = 1
+VALIDATION_READ_TIMEOUT_SECONDS = 2
+VALIDATION_MAX_RETRIES = 2
+VALIDATION_BACKOFF_FACTOR = 0.1
+SHARED_VALIDATION_CACHE_TTL_SECONDS = 3600
 
 
 class CodeValidationPayloadSchema(Schema):
@@ -25,20 +40,166 @@ class CodeValidationPayload:
     account_info: Dict[str, Any] = field(default_factory=lambda: {})
 
 
+# Returned when the validation service rejects a request (a 4xx other than 429). That tells us
+# nothing lasting about the code, so unlike other results it's never cached.
+REJECTED_VALIDATION = CodeValidationPayload(valid=False)
+
+
 class RegistrationValidator(ABC):
     @abstractmethod
     def validate_code(self, code) -> CodeValidationPayload:
         pass
 
 
+class SharedValidationCache:
+    # Valid codes, shared by every container in a DynamoDB table. All of a company's employees
+    # register with the same code, often around the same time, so this saves a call to the
+    # validation service for everyone but the first. Items expire after ttl_seconds. Without a
+    # table, nothing is shared.
+    #
+    # Only valid codes are stored: a code that isn't valid yet may become valid.
+
+    def __init__(
+        self,
+        table_name: Optional[str] = None,
+        ttl_seconds: float = SHARED_VALIDATION_CACHE_TTL_SECONDS,
+        **kwargs,
+    ):
+        self.table = DynamoDBCache(table_name, "code", ttl_seconds=ttl_seconds, **kwargs)
+
+    def get(self, code: str) -> Optional[CodeValidationPayload]:
+        item = self.table.get(code)
+        if item is None:
+            return None
+        return CodeValidationPayloadSchema().load(json.loads(item["payload"]))
+
+    def put(self, code: str, payload: CodeValidationPayload):
+        if not payload.valid:
+            return
+        try:
+            self.table.put(
+                code, {"payload": json.dumps(CodeValidationPayloadSchema().dump(payload))}
+            )
+        except Exception:
+            logging.warning(f"Unable to write to {self.table.table_name}", exc_info=True)
+
+    def ensure_table_exists(self):
+        self.table.ensure_table_exists()
+
+
 class DefaultRegistrationValidator(RegistrationValidator):
-    @functools.lru_cache(maxsize=1024)
+    # Validation happens while we process a user's message, so its latency delays our reply. We
+    # keep connections to the validation service alive between calls, bound each call with
+    # timeouts, and retry transient failures. Successful responses are cached for a while; errors
+    # never are. Valid codes are also cached across containers, in the shared cache.
+
+    def __init__(
+        self,
+        cache_size: int = VALIDATION_CACHE_SIZE,
+        ttl_seconds: float = VALIDATION_CACHE_TTL_SECONDS,
+        shared_cache: Optional[SharedValidationCache] = None,
+    ):
+        self.cache = TTLCache(cache_size, ttl_seconds)
+        if shared_cache is None:
+            shared_cache = SharedValidationCache(
+                os.getenv("REGISTRATION_VALIDATION_CACHE_TABLE_NAME")
+            )
+        self.shared_cache = shared_cache
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                max_retries=Retry(
+                    total=VALIDATION_MAX_RETRIES,
+                    # a service that's slow to respond is unlikely to be faster the second time
+                    read=0,
+                    backoff_factor=VALIDATION_BACKOFF_FACTOR,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    # validating a code has no side effects, so it's safe to retry
+                    method_whitelist=frozenset(["POST"]),
+                    raise_on_status=False,
+                )
+            ),
+        )
+
     def validate_code(self, code, **kwargs) -> CodeValidationPayload:
         url = kwargs.get("url", os.getenv("REGISTRATION_VALIDATION_URL"))
         key = kwargs.get("key", os.getenv("REGISTRATION_VALIDATION_KEY"))
-        response = requests.post(
+        payload = self.cache.get((url, code))
+        if payload is not None:
+            return payload
+        payload = self.shared_cache.get(code)
+        if payload is None:
+            payload = self._request_validation(url, key, code)
+            if payload is None:
+                return REJECTED_VALIDATION
+            self.shared_cache.put(code, payload)
+        self.cache.put((url, code), payload)
+        return payload
+
+    def _request_validation(self, url: str, key: str, code: str) -> Optional[CodeValidationPayload]:
+        response = self.session.post(
             url=url,
             json={"code": code, "stage": os.getenv("STAGE")},
             headers={"authorization": f"Basic {key}", "content-type": "application/json"},
+            timeout=(VALIDATION_CONNECT_TIMEOUT_SECONDS, VALIDATION_READ_TIMEOUT_SECONDS),
         )
+        if response.status_code == 429 or response.status_code >= 500:
+            # still failing after the retries. Raised, so that the command is retried later.
+            response.raise_for_status()
+        if not response.ok:
+            logging.warning(
+                f"Registration validation failed with status {response.status_code}. "
+                f"Treating the code as invalid."
+            )
+            return None
         return CodeValidationPayloadSchema().load(response.json())
+
+
+# Registration codes are a single token of letters, digits, dashes and underscores.
+CODE_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{3,31}$")
+CODE_PREFIX_LENGTH = 3
+DEMO_CODE_CACHE_SIZE = 1024
+DEMO_CODE_CACHE_TTL_SECONDS = 600
+
+
+class DemoCodeFilter:
+    # Demo users can text a registration code at any time to switch to a real account, so every
+    # message they send is checked with the registration validator, which calls an external
+    # service. Most of their messages are drill responses, though. We only validate messages that
+    # could plausibly be codes: those with the shape of a code, and those that start like a code
+    # we've seen validated. Validation results, including "not a code", are cached for a while.
+
+    def __init__(
+        self,
+        cache_size: int = DEMO_CODE_CACHE_SIZE,
+        ttl_seconds: float = DEMO_CODE_CACHE_TTL_SECONDS,
+    ):
+        self.results = TTLCache(cache_size, ttl_seconds)
+        self.known_prefixes = LRUCache(cache_size)
+
+    def learn_code(self, code: str):
+        self.known_prefixes.put(code[:CODE_PREFIX_LENGTH], True)
+
+    def could_be_code(self, content: str) -> bool:
+        if CODE_PATTERN.match(content):
+            return True
+        return (
+            len(content) >= CODE_PREFIX_LENGTH
+            and content[:CODE_PREFIX_LENGTH] in self.known_prefixes
+        )
+
+    def validate_code(self, code: str, validator: RegistrationValidator) -> CodeValidationPayload:
+        payload = self.results.get(code)
+        if payload is not None:
+            return payload
+        if not self.could_be_code(code):
+            payload = CodeValidationPayload(valid=False)
+        else:
+            payload = validator.validate_code(code)
+            if payload is REJECTED_VALIDATION:
+                return payload
+            if payload.valid:
+                self.learn_code(code)
+        self.results.put(code, payload)
+        return payload
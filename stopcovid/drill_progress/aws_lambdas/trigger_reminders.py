@@ -1,3 +1,6 @@
+import os
+
+from stopcovid.dialog.command_stream.backpressure import BulkPublishGovernor
 from stopcovid.drill_progress.trigger_reminders import ReminderTriggerer
 
 from stopcovid.utils.logging import configure_logging
@@ -5,9 +8,18 @@ from stopcovid.utils.verify_deploy_stage import verify_deploy_stage
 
 configure_logging()
 
+COMMANDS_PER_SECOND = float(os.getenv("BULK_PUBLISH_COMMANDS_PER_SECOND", "50"))
+MAX_OUTBOUND_BACKLOG = int(os.getenv("BULK_PUBLISH_MAX_OUTBOUND_BACKLOG", "1000"))
+
 
 def handler(event, context):
     verify_deploy_stage()
-    ReminderTriggerer().trigger_reminders()
+    ReminderTriggerer().trigger_reminders(
+        BulkPublishGovernor(
+            commands_per_second=COMMANDS_PER_SECOND,
+            max_outbound_backlog=MAX_OUTBOUND_BACKLOG,
+            time_remaining_ms=context.get_remaining_time_in_millis,
+        )
+    )
 
     return {"statusCode": 200}
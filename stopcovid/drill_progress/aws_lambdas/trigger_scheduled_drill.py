@@ -1,6 +1,10 @@
 import logging
+import os
+
 from stopcovid.utils import dynamodb as dynamodb_utils
 
+from stopcovid.dialog.command_stream.backpressure import BulkPublishGovernor
+from stopcovid.drill_progress.drill_scheduler import DrillScheduler
 from stopcovid.drill_progress.initiation import DrillInitiator
 from stopcovid.drill_progress.drill_progress import DrillProgressSchema
 
@@ -9,6 +13,11 @@ from stopcovid.utils.verify_deploy_stage import verify_deploy_stage
 
 configure_logging()
 
+COMMANDS_PER_SECOND = float(os.getenv("BULK_PUBLISH_COMMANDS_PER_SECOND", "50"))
+MAX_OUTBOUND_BACKLOG = int(os.getenv("BULK_PUBLISH_MAX_OUTBOUND_BACKLOG", "1000"))
+# drills that we don't have capacity for are rescheduled over this window
+DEFERRAL_WINDOW_MINUTES = 15
+
 
 def handler(event, context):
     verify_deploy_stage()
@@ -19,8 +28,14 @@ def handler(event, context):
             drill_progresses_to_schedule[item["idempotency_key"]] = DrillProgressSchema().load(
                 item["drill_progress"]
             )
-    initiator = DrillInitiator()
+    initiator = DrillInitiator(buffered=True)
+    governor = BulkPublishGovernor(
+        commands_per_second=COMMANDS_PER_SECOND,
+        max_outbound_backlog=MAX_OUTBOUND_BACKLOG,
+        time_remaining_ms=context.get_remaining_time_in_millis,
+    )
 
+    deferred = []
     for idempotency_key, drill_progress in drill_progresses_to_schedule.items():
         slug = drill_progress.next_drill_slug_to_trigger()
         if slug is None:
@@ -29,6 +44,15 @@ def handler(event, context):
                 f"for {drill_progress.phone_number}. Ignoring."
             )
             continue
+        if deferred or not governor.admit(initiator.command_publisher.metrics):
+            deferred.append(drill_progress)
+            continue
         initiator.trigger_drill_if_not_stale(drill_progress.phone_number, slug, idempotency_key)
+    initiator.flush()
+
+    if deferred:
+        # Rescheduled with the same idempotency keys, so they're only triggered once.
+        logging.info(f"Deferring {len(deferred)} scheduled drills")
+        DrillScheduler().schedule_drills_to_trigger(deferred, DEFERRAL_WINDOW_MINUTES)
 
     return {"statusCode": 200}
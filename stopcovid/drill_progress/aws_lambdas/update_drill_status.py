@@ -1,5 +1,4 @@
-from stopcovid.dialog.models.events import batch_from_dict
-from stopcovid.utils import dynamodb as dynamodb_utils
+from stopcovid.dialog.models.events import batch_from_dynamodb_image
 from stopcovid.drill_progress import status
 from stopcovid.utils.logging import configure_logging
 from stopcovid.utils.verify_deploy_stage import verify_deploy_stage
@@ -10,7 +9,8 @@ configure_logging()
 def handler(event, context):
     verify_deploy_stage()
     event_batches = [
-        batch_from_dict(dynamodb_utils.deserialize(record["dynamodb"]["NewImage"]))
+        # every event type is needed: each event updates the user's last interaction time
+        batch_from_dynamodb_image(record["dynamodb"]["NewImage"])
         for record in event["Records"]
         if record["dynamodb"].get("NewImage")
     ]
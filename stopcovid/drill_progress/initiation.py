@@ -1,8 +1,12 @@
 import logging
-from typing import Optional
+from typing import Optional, List, Tuple
 
 from .drill_progress import DrillProgressRepository
-from ..dialog.command_stream.publish import CommandPublisher
+from ..dialog.command_stream.publish import (
+    CommandPublisher,
+    BufferedCommandPublisher,
+    PublishOutcome,
+)
 from ..drills.drills import get_first_drill_slug
 from ..utils.idempotency import IdempotencyChecker
 
@@ -11,10 +15,14 @@ IDEMPOTENCY_EXPIRATION_MINUTES = 600
 
 
 class DrillInitiator:
-    def __init__(self):
+    def __init__(self, buffered: bool = False):
+        # Buffered initiators publish START_DRILL commands in batches. Call flush() once every
+        # drill has been triggered.
         self.drill_progress_repository = DrillProgressRepository()
-        self.command_publisher = CommandPublisher()
+        self.buffered = buffered
+        self.command_publisher = BufferedCommandPublisher() if buffered else CommandPublisher()
         self.idempotency_checker = IdempotencyChecker()
+        self._pending: List[Tuple[str, List[PublishOutcome]]] = []
 
     def trigger_first_drill(self, phone_number: str, idempotency_key: str):
         self.trigger_drill(phone_number, get_first_drill_slug(), idempotency_key)
@@ -48,7 +56,24 @@ class DrillInitiator:
             return
         consolidated_key = f"{phone_number}:{drill_slug}:{idempotency_key}"
         if not self.idempotency_checker.already_processed(consolidated_key, IDEMPOTENCY_REALM):
-            self.command_publisher.publish_start_drill_command(phone_number, drill_slug)
+            outcomes = self.command_publisher.publish_start_drill_command(phone_number, drill_slug)
+            if self.buffered:
+                # recorded as processed once flush() confirms that the command was published
+                self._pending.append((consolidated_key, outcomes))
+                return
             self.idempotency_checker.record_as_processed(
                 consolidated_key, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
             )
+
+    def flush(self):
+        if not self.buffered:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self.command_publisher.flush()
+        finally:
+            for consolidated_key, outcomes in pending:
+                if all(outcome.published for outcome in outcomes):
+                    self.idempotency_checker.record_as_processed(
+                        consolidated_key, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
+                    )
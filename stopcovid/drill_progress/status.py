@@ -8,16 +8,18 @@ from ..dialog.models.events import UserValidated, NextDrillRequested, DialogEven
 def handle_dialog_event_batches(batches: List[DialogEventBatch]):
     # trigger initiation before updating status. The status updates could be slow because of
     # aurora cold start time.
-    initiator = DrillInitiator()
+    initiator = DrillInitiator(buffered=True)
     for batch in batches:
         if initiates_first_drill(batch):
             initiator.trigger_first_drill(batch.phone_number, str(batch.batch_id))
+    initiator.flush()
 
     user_repo = DrillProgressRepository()
     for batch in batches:
         user_repo.update_user(batch)
         if initiates_subsequent_drill(batch):
             initiator.trigger_next_drill_for_user(batch.phone_number, str(batch.batch_id))
+    initiator.flush()
 
 
 def initiates_first_drill(batch: DialogEventBatch):
@@ -1,7 +1,10 @@
+import logging
 import os
+from typing import Optional
 
 from stopcovid.drill_progress.drill_progress import DrillProgressRepository
-from stopcovid.dialog.command_stream.publish import CommandPublisher
+from stopcovid.dialog.command_stream.backpressure import BulkPublishGovernor
+from stopcovid.dialog.command_stream.publish import BufferedCommandPublisher
 from stopcovid.utils.idempotency import IdempotencyChecker
 
 REMINDER_TRIGGER_FLOOR_MINUTES = 60 * 4
@@ -16,28 +19,45 @@ class ReminderTriggerer:
     def __init__(self, **kwargs):
         self.stage = os.environ.get("STAGE")
         self.drill_progress_repo = self._get_drill_progress_repo()
-        self.command_publisher = CommandPublisher()
+        self.command_publisher = BufferedCommandPublisher()
         self.idempotency_checker = IdempotencyChecker()
 
     def _get_drill_progress_repo(self):
         return DrillProgressRepository()
 
-    def trigger_reminders(self):
+    def trigger_reminders(self, governor: Optional[BulkPublishGovernor] = None):
         drill_instances = self.drill_progress_repo.get_incomplete_drills(
             inactive_for_minutes_floor=REMINDER_TRIGGER_FLOOR_MINUTES,
             inactive_for_minutes_ceil=REMINDER_TRIGGER_CEIL_MINUTES,
         )
 
-        for drill_instance in drill_instances:
+        pending = []
+        for i, drill_instance in enumerate(drill_instances):
             idempotency_key = (
                 f"{drill_instance.drill_instance_id}-{drill_instance.current_prompt_slug}"
             )
             if self.idempotency_checker.already_processed(idempotency_key, IDEMPOTENCY_REALM):
                 continue
+            if governor is not None and not governor.admit(self.command_publisher.metrics):
+                # Reminders that we don't record as triggered are picked up by the next run.
+                logging.info(f"Deferring up to {len(drill_instances) - i} reminders")
+                break
 
             # The dialog agent wont send a reminder for the same drill/prompt combo twice
             # publishing to the stream twice should be avoided, but isn't a big deal.
-            self.command_publisher.publish_trigger_reminder_commands([drill_instance])
-            self.idempotency_checker.record_as_processed(
-                idempotency_key, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
+            pending.append(
+                (
+                    idempotency_key,
+                    self.command_publisher.publish_trigger_reminder_commands([drill_instance]),
+                )
             )
+
+        # reminders are only recorded as triggered once they've been published
+        try:
+            self.command_publisher.flush()
+        finally:
+            for idempotency_key, outcomes in pending:
+                if all(outcome.published for outcome in outcomes):
+                    self.idempotency_checker.record_as_processed(
+                        idempotency_key, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
+                    )
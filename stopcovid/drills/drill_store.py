@@ -0,0 +1,229 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Optional, Dict, Any, Tuple
+
+from marshmallow import fields
+
+from stopcovid.utils.cache import LRUCache
+from stopcovid.utils.dynamodb_cache import DynamoDBCache
+from .drills import Drill, DrillSchema, Prompt, PromptSchema, PromptMessage
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+def content_hash(content: Dict[str, Any]) -> str:
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+class DrillStore:
+    # An immutable, content-addressed store of drills and prompts. Dialog state and dialog events
+    # refer to drill and prompt content by (slug, content_hash) rather than embedding it, so
+    # drills stay pinned for users who are in the middle of them even after the content changes.
+    #
+    # Content is resolved from an in-process cache, then from the current drill content, then
+    # from DynamoDB. Without a DynamoDB table, content can't be shared with other processes, so
+    # it's serialized by value, as it always has been.
+
+    def __init__(self, table_name: Optional[str] = None, **kwargs):
+        # reads aren't best effort here: content we can't read can't be resolved at all
+        self.table = DynamoDBCache(table_name, "content_hash", errors_are_misses=False, **kwargs)
+        self.cache = LRUCache(DEFAULT_CACHE_SIZE)
+        # content hashes that we know are in DynamoDB
+        self._stored_keys = LRUCache(DEFAULT_CACHE_SIZE)
+        self._hashes_by_id = LRUCache(DEFAULT_CACHE_SIZE)
+        self._current_drills: Optional[Dict[str, Drill]] = None
+        self._current_content: Dict[str, Any] = {}
+
+    def stores_by_reference(self) -> bool:
+        return self.table.table_name is not None
+
+    def drill_reference(self, drill: Drill) -> Dict[str, str]:
+        return {"slug": drill.slug, "content_hash": self._put("drill", drill, _drill_to_dict)}
+
+    def prompt_reference(self, prompt: Prompt) -> Dict[str, str]:
+        return {"slug": prompt.slug, "content_hash": self._put("prompt", prompt, _prompt_to_dict)}
+
+    def get_drill(self, slug: str, drill_content_hash: str) -> Drill:
+        return self._get("drill", slug, drill_content_hash, _drill_from_dict)
+
+    def get_prompt(self, slug: str, prompt_content_hash: str) -> Prompt:
+        return self._get("prompt", slug, prompt_content_hash, _prompt_from_dict)
+
+    def _put(self, kind: str, obj, to_dict) -> str:
+        # drills and prompts are never mutated, so we only hash each object once
+        hashed = self._hashes_by_id.get(id(obj))
+        if hashed is not None and hashed[0] is obj:
+            key = hashed[1]
+        else:
+            content = to_dict(obj)
+            key = content_hash(content)
+            self._hashes_by_id.put(id(obj), (obj, key))
+        if self.stores_by_reference() and self._stored_keys.get(key) is None:
+            # content is immutable, so if another process has already stored it, we're done
+            self.table.put(
+                key, {"kind": kind, "slug": obj.slug, "content": to_dict(obj)}, if_absent=True
+            )
+            self._stored_keys.put(key, True)
+        self.cache.put(key, obj)
+        return key
+
+    def _get(self, kind: str, slug: str, key: str, from_dict):
+        obj = self.cache.get(key)
+        if obj is None:
+            obj = self._current_content_index().get(key)
+        if obj is None and self.stores_by_reference():
+            logging.info(f"Fetching {kind} {slug} ({key}) from {self.table.table_name}")
+            item = self.table.get(key)
+            if item is not None:
+                obj = from_dict(item["content"])
+                self._stored_keys.put(key, True)
+        if obj is None:
+            raise ValueError(f"Unknown content for {kind} {slug} ({key})")
+        self.cache.put(key, obj)
+        return obj
+
+    def _current_content_index(self) -> Dict[str, Any]:
+        # Most references are to the current version of a drill, which we already have in memory.
+        # We index it by content hash, and rebuild the index when the content loader reloads.
+        from .content_loader import get_content_loader
+
+        drills = get_content_loader().get_drills()
+        if drills is not self._current_drills:
+            index: Dict[str, Any] = {}
+            for drill in drills.values():
+                index[content_hash(_drill_to_dict(drill))] = drill
+                for prompt in drill.prompts:
+                    index[content_hash(_prompt_to_dict(prompt))] = prompt
+            self._current_drills = drills
+            self._current_content = index
+        return self._current_content
+
+    def ensure_table_exists(self):
+        self.table.ensure_table_exists()
+
+
+DRILL_STORE = None
+
+
+def get_drill_store() -> DrillStore:
+    global DRILL_STORE
+    if DRILL_STORE is None:
+        DRILL_STORE = DrillStore(os.getenv("DRILL_CONTENT_TABLE_NAME"))
+    return DRILL_STORE
+
+
+def _is_reference(value: Dict[str, Any]) -> bool:
+    return "content_hash" in value
+
+
+def _reference_parts(value: Dict[str, Any]) -> Tuple[str, str]:
+    return value["slug"], value["content_hash"]
+
+
+# Hand-written equivalents of DrillSchema().dump() and DrillSchema().load() (and the same for
+# prompts). Drills are serialized with every event that carries one, and building marshmallow
+# schemas for nested drills dominates the cost. The marshmallow schemas remain the reference
+# implementation and are used to load anything that doesn't match the expected shape.
+
+
+def _prompt_to_dict(prompt: Prompt) -> Dict[str, Any]:
+    return {
+        "slug": prompt.slug,
+        "messages": [
+            {"text": message.text, "media_url": message.media_url} for message in prompt.messages
+        ],
+        "response_user_profile_key": prompt.response_user_profile_key,
+        "correct_response": prompt.correct_response,
+    }
+
+
+def _drill_to_dict(drill: Drill) -> Dict[str, Any]:
+    return {
+        "name": drill.name,
+        "slug": drill.slug,
+        "prompts": [_prompt_to_dict(prompt) for prompt in drill.prompts],
+    }
+
+
+def _prompt_from_dict(value: Dict[str, Any]) -> Prompt:
+    try:
+        return Prompt(
+            slug=value["slug"],
+            messages=[
+                PromptMessage(text=message["text"], media_url=message.get("media_url"))
+                for message in value["messages"]
+            ],
+            response_user_profile_key=value.get("response_user_profile_key"),
+            correct_response=value.get("correct_response"),
+        )
+    except (KeyError, TypeError):
+        return PromptSchema().load(value)
+
+
+def _drill_from_dict(value: Dict[str, Any]) -> Drill:
+    try:
+        return Drill(
+            slug=value["slug"],
+            name=value["name"],
+            prompts=[_prompt_from_dict(prompt) for prompt in value["prompts"]],
+        )
+    except (KeyError, TypeError):
+        return DrillSchema().load(value)
+
+
+def serialize_drill(drill: Drill) -> Dict[str, Any]:
+    store = get_drill_store()
+    if store.stores_by_reference():
+        return store.drill_reference(drill)
+    return _drill_to_dict(drill)
+
+
+def deserialize_drill(value: Dict[str, Any]) -> Drill:
+    if _is_reference(value):
+        return get_drill_store().get_drill(*_reference_parts(value))
+    return _drill_from_dict(value)
+
+
+def serialize_prompt(prompt: Prompt) -> Dict[str, Any]:
+    store = get_drill_store()
+    if store.stores_by_reference():
+        return store.prompt_reference(prompt)
+    return _prompt_to_dict(prompt)
+
+
+def deserialize_prompt(value: Dict[str, Any]) -> Prompt:
+    if _is_reference(value):
+        return get_drill_store().get_prompt(*_reference_parts(value))
+    return _prompt_from_dict(value)
+
+
+class DrillField(fields.Field):
+    """Serializes a drill as a reference to the drill store when the store supports it.
+    Deserializes both references and drills that were stored by value.
+    """
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+        return serialize_drill(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        return deserialize_drill(value)
+
+
+class PromptField(fields.Field):
+    """Serializes a prompt as a reference to the drill store when the store supports it.
+    Deserializes both references and prompts that were stored by value.
+    """
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+        return serialize_prompt(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        return deserialize_prompt(value)
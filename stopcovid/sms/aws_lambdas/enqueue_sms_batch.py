@@ -1,10 +1,12 @@
 import logging
 
-from stopcovid.dialog.models.events import batch_from_dict
-from stopcovid.utils import dynamodb as dynamodb_utils
+from stopcovid.dialog.models.events import batch_from_dynamodb_image
 
 
-from stopcovid.sms.enqueue_outbound_sms import enqueue_outbound_sms_commands
+from stopcovid.sms.enqueue_outbound_sms import (
+    enqueue_outbound_sms_commands,
+    OUTBOUND_SMS_EVENT_TYPES,
+)
 from stopcovid.utils.logging import configure_logging
 from stopcovid.utils.verify_deploy_stage import verify_deploy_stage
 
@@ -14,7 +16,7 @@ configure_logging()
 def handler(event, context):
     verify_deploy_stage()
     event_batches = [
-        batch_from_dict(dynamodb_utils.deserialize(record["dynamodb"]["NewImage"]))
+        batch_from_dynamodb_image(record["dynamodb"]["NewImage"], OUTBOUND_SMS_EVENT_TYPES)
         for record in event["Records"]
         if record["dynamodb"].get("NewImage")
     ]
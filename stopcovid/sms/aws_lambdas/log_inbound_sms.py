@@ -4,13 +4,14 @@ import os
 
 import boto3
 
+from stopcovid.utils import kinesis as kinesis_utils
 from stopcovid.utils.idempotency import IdempotencyChecker
-from stopcovid.utils.kinesis import get_payload_from_kinesis_record
 
 from stopcovid.dialog.command_stream.types import (
     InboundCommandSchema,
     InboundCommandType,
     InboundCommand,
+    get_twilio_webhook,
 )
 from stopcovid.utils.logging import configure_logging
 from stopcovid.utils.verify_deploy_stage import verify_deploy_stage
@@ -22,7 +23,8 @@ IDEMPOTENCY_EXPIRATION_MINUTES = 60
 
 
 def _make_inbound_command(record) -> InboundCommand:
-    event = get_payload_from_kinesis_record(record)
+    # the command stream is never aggregated (see CommandPublisher._put)
+    event = kinesis_utils.get_payload_from_kinesis_record(record)
     return InboundCommandSchema().load(
         {
             "payload": event["payload"],
@@ -38,21 +40,41 @@ def handler(event, context):
     stage = os.environ["STAGE"]
     idempotency_checker = IdempotencyChecker()
 
-    inbound_commands = [_make_inbound_command(record) for record in event["Records"]]
-    for command in inbound_commands:
+    to_log = []
+    for record in event["Records"]:
+        command = _make_inbound_command(record)
         if command.command_type == InboundCommandType.INBOUND_SMS:
             if not idempotency_checker.already_processed(
                 command.sequence_number, IDEMPOTENCY_REALM
             ):
-                logging.info(f"Logging an INBOUND_SMS message in the message log")
-                twilio_webhook = command.payload["twilio_webhook"]
-                kinesis.put_record(
-                    Data=json.dumps({"type": "INBOUND_SMS", "payload": twilio_webhook}),
-                    PartitionKey=command.payload["From"],
-                    StreamName=f"message-log-{stage}",
-                )
-                idempotency_checker.record_as_processed(
-                    command.sequence_number, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
-                )
+                to_log.append((command.sequence_number, command))
+    if not to_log:
+        return {"statusCode": 200}
+
+    logging.info(f"Logging {len(to_log)} INBOUND_SMS messages in the message log")
+    results = kinesis_utils.put_records(
+        kinesis,
+        f"message-log-{stage}",
+        [
+            {
+                "Data": json.dumps(
+                    {"type": "INBOUND_SMS", "payload": get_twilio_webhook(command.payload)}
+                ),
+                "PartitionKey": command.payload["From"],
+            }
+            for _, command in to_log
+        ],
+    )
+    failed = 0
+    for (idempotency_key, _), result in zip(to_log, results):
+        if "ErrorCode" in result:
+            failed += 1
+            continue
+        idempotency_checker.record_as_processed(
+            idempotency_key, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
+        )
+    if failed:
+        # the batch is retried, and messages that were logged are skipped
+        raise RuntimeError(f"Failed to log {failed} INBOUND_SMS messages")
 
     return {"statusCode": 200}
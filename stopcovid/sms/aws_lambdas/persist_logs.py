@@ -1,5 +1,5 @@
 import datetime
-from stopcovid.utils.kinesis import get_payload_from_kinesis_record
+from stopcovid.utils.kinesis import get_payloads_from_kinesis_record
 from stopcovid.sms.message_log.message_log import log_messages
 from stopcovid.sms.message_log.types import LogMessageCommandSchema
 
@@ -13,20 +13,20 @@ def handle(event, context):
     verify_deploy_stage()
     commands = []
     for record in event["Records"]:
-        command = get_payload_from_kinesis_record(record)
         approximate_arrival = (
             datetime.datetime.fromtimestamp(record["kinesis"]["approximateArrivalTimestamp"])
             .replace(tzinfo=datetime.timezone.utc)
             .isoformat()
         )
-        commands.append(
-            LogMessageCommandSchema().load(
-                {
-                    "command_type": command["type"],
-                    "payload": command["payload"],
-                    "approximate_arrival": approximate_arrival,
-                }
+        for _, command in get_payloads_from_kinesis_record(record):
+            commands.append(
+                LogMessageCommandSchema().load(
+                    {
+                        "command_type": command["type"],
+                        "payload": command["payload"],
+                        "approximate_arrival": approximate_arrival,
+                    }
+                )
             )
-        )
     log_messages(commands)
     return {"statusCode": 200}
@@ -9,6 +9,7 @@ from twilio.request_validator import RequestValidator
 from twilio.twiml.messaging_response import MessagingResponse
 
 from stopcovid.dialog.command_stream.publish import CommandPublisher
+from stopcovid.dialog.keywords import is_stateless_keyword, stateless_keyword_response
 from stopcovid.utils.idempotency import IdempotencyChecker
 
 from stopcovid.utils.logging import configure_logging
@@ -35,6 +36,7 @@ def handler(event, context):
     if idempotency_checker.already_processed(idempotency_key, IDEMPOTENCY_REALM):
         logging.info(f"Already processed webhook with idempotency key {idempotency_key}. Skipping.")
         return {"statusCode": 200}
+    twiml = MessagingResponse()
     if "MessageStatus" in form:
         logging.info(f"Outbound message to {form['To']}: Recording STATUS_UPDATE in message log")
         kinesis.put_record(
@@ -42,6 +44,19 @@ def handler(event, context):
             PartitionKey=form["To"],
             StreamName=f"message-log-{stage}",
         )
+    elif is_stateless_keyword(form["Body"]):
+        # Keywords like HELP don't need dialog state, so we answer them here rather than sending
+        # them through the command stream. They're logged just as the command stream would log
+        # them.
+        logging.info(f"Inbound keyword from {form['From']}: '{form['Body']}'")
+        kinesis.put_record(
+            Data=json.dumps({"type": "INBOUND_SMS", "payload": form}),
+            PartitionKey=form["From"],
+            StreamName=f"message-log-{stage}",
+        )
+        response = stateless_keyword_response(form["Body"])
+        if response is not None:
+            twiml.message(response)
     else:
         logging.info(f"Inbound message from {form['From']}: '{form['Body']}'")
         CommandPublisher().publish_process_sms_command(form["From"], form["Body"], form)
@@ -52,7 +67,7 @@ def handler(event, context):
     return {
         "statusCode": 200,
         "headers": {"content-type": "application/xml"},
-        "body": str(MessagingResponse()),
+        "body": str(twiml),
     }
 
 
@@ -21,6 +21,7 @@ from stopcovid.dialog.models.events import (
     NextDrillRequested,
     DialogEvent,
     ReminderTriggered,
+    DialogEventType,
 )
 from stopcovid.drills.drills import PromptMessage
 from stopcovid.drills.localize import localize
@@ -68,6 +69,19 @@ def get_localized_messages(
     ]
 
 
+# the event types that get_messages_for_event() can send messages for
+OUTBOUND_SMS_EVENT_TYPES = frozenset(
+    [
+        DialogEventType.ADVANCED_TO_NEXT_PROMPT,
+        DialogEventType.FAILED_PROMPT,
+        DialogEventType.COMPLETED_PROMPT,
+        DialogEventType.USER_VALIDATION_FAILED,
+        DialogEventType.DRILL_STARTED,
+        DialogEventType.REMINDER_TRIGGERED,
+    ]
+)
+
+
 def get_messages_for_event(event: DialogEvent):  # noqa: C901
     if isinstance(event, AdvancedToNextPrompt):
         return get_localized_messages(event, event.prompt.messages)
@@ -2,6 +2,8 @@ import boto3
 import os
 import json
 
+from stopcovid.utils import kinesis as kinesis_utils
+
 
 def publish_outbound_sms(twilio_responses):
     kinesis = boto3.client("kinesis")
@@ -24,4 +26,6 @@ def publish_outbound_sms(twilio_responses):
         for response in twilio_responses
     ]
 
-    return kinesis.put_records(Records=records, StreamName=f"message-log-{stage}")
+    # the message log doesn't rely on sequence numbers, so a phone number's messages can share an
+    # aggregated record
+    return kinesis_utils.put_records(kinesis, f"message-log-{stage}", records)
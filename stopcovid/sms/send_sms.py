@@ -17,19 +17,22 @@ IDEMPOTENCY_REALM = "send-sms"
 IDEMPOTENCY_EXPIRATION_MINUTES = 24 * 60  # one day
 
 
-def _publish_send(twilio_response):
+def _publish_sends(twilio_responses):
+    if not twilio_responses:
+        return
     try:
-        publish.publish_outbound_sms([twilio_response])
+        publish.publish_outbound_sms(twilio_responses)
     except Exception:
-        twilio_dict = {
-            "twilio_message_id": twilio_response.sid,
-            "to": twilio_response.to,
-            "body": twilio_response.body,
-            "status": twilio_response.status,
-            "error_code": twilio_response.error_code,
-            "error_message": twilio_response.error_message,
-        }
-        logging.info(f"Failed to publisht to kinesis log: {json.dumps(twilio_dict)}")
+        for twilio_response in twilio_responses:
+            twilio_dict = {
+                "twilio_message_id": twilio_response.sid,
+                "to": twilio_response.to,
+                "body": twilio_response.body,
+                "status": twilio_response.status,
+                "error_code": twilio_response.error_code,
+                "error_message": twilio_response.error_message,
+            }
+            logging.info(f"Failed to publisht to kinesis log: {json.dumps(twilio_dict)}")
 
 
 def _send_batch(batch: SMSBatch):
@@ -38,14 +41,17 @@ def _send_batch(batch: SMSBatch):
         logging.info(f"SMS Batch already processed. Skipping. {batch}")
         return
     twilio_responses = []
-    for i, message in enumerate(batch.messages):
-        res = twilio.send_message(batch.phone_number, message.body, message.media_url)
-        _publish_send(res)
-        twilio_responses.append(res)
-
-        # sleep after every  message besides the last one
-        if i < len(batch.messages) - 1:
-            sleep(DELAY_SECONDS_BETWEEN_MESSAGES)
+    try:
+        for i, message in enumerate(batch.messages):
+            res = twilio.send_message(batch.phone_number, message.body, message.media_url)
+            twilio_responses.append(res)
+
+            # sleep after every  message besides the last one
+            if i < len(batch.messages) - 1:
+                sleep(DELAY_SECONDS_BETWEEN_MESSAGES)
+    finally:
+        # the batch's messages are logged together, so they can share a kinesis record
+        _publish_sends(twilio_responses)
 
     idempotency_checker.record_as_processed(
         batch.idempotency_key, IDEMPOTENCY_REALM, IDEMPOTENCY_EXPIRATION_MINUTES
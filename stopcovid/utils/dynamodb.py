@@ -1,11 +1,76 @@
+import base64
+import json
+import zlib
+from decimal import Decimal
+from typing import Dict, Any, Iterable
+
 from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 
+# TypeSerializer and TypeDeserializer are stateless, so we share them.
+SERIALIZER = TypeSerializer()
+DESERIALIZER = TypeDeserializer()
+
+# Items can store everything except a few readable attributes (keys, index keys and attributes
+# used in condition expressions) in one compressed binary attribute. PAYLOAD_FORMAT_ATTRIBUTE
+# records how the payload is encoded, so items in different formats can coexist:
+#   (absent): a plain item, with every value in its own attribute
+#   1: zlib-compressed, compact JSON
+PAYLOAD_ATTRIBUTE = "payload"
+PAYLOAD_FORMAT_ATTRIBUTE = "payload_format"
+COMPRESSED_JSON_FORMAT = 1
+
 
 def serialize(a_dict):
-    serializer = TypeSerializer()
-    return {k: serializer.serialize(v) for k, v in a_dict.items()}
+    return {k: SERIALIZER.serialize(v) for k, v in a_dict.items()}
 
 
 def deserialize(a_dict):
-    deserializer = TypeDeserializer()
-    return {k: deserializer.deserialize(v) for k, v in a_dict.items()}
+    return {k: DESERIALIZER.deserialize(v) for k, v in a_dict.items()}
+
+
+def _json_default(value):
+    # numbers that were read from DynamoDB are Decimals
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def serialize_compressed(a_dict: Dict[str, Any], readable_keys: Iterable[str]) -> Dict[str, Any]:
+    payload = zlib.compress(
+        json.dumps(a_dict, separators=(",", ":"), default=_json_default).encode("utf-8")
+    )
+    item = serialize({key: a_dict[key] for key in readable_keys})
+    item[PAYLOAD_ATTRIBUTE] = {"B": payload}
+    item[PAYLOAD_FORMAT_ATTRIBUTE] = {"N": str(COMPRESSED_JSON_FORMAT)}
+    return item
+
+
+def is_compressed(item: Dict[str, Any]) -> bool:
+    return PAYLOAD_FORMAT_ATTRIBUTE in item
+
+
+def deserialize_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Deserializes an item, or a stream record image, in any of our storage formats."""
+    if not is_compressed(item):
+        return deserialize(item)
+
+    payload_format = int(item[PAYLOAD_FORMAT_ATTRIBUTE]["N"])
+    if payload_format != COMPRESSED_JSON_FORMAT:
+        raise ValueError(f"Unknown payload format {payload_format}")
+    payload = item[PAYLOAD_ATTRIBUTE]["B"]
+    if isinstance(payload, str):
+        # binary attributes in stream records that are delivered to lambdas are base64 encoded
+        payload = base64.b64decode(payload)
+    result = json.loads(zlib.decompress(payload).decode("utf-8"))
+    # Readable attributes take precedence: updates write individual attributes without touching
+    # the payload.
+    result.update(
+        deserialize(
+            {
+                key: value
+                for key, value in item.items()
+                if key not in (PAYLOAD_ATTRIBUTE, PAYLOAD_FORMAT_ATTRIBUTE)
+            }
+        )
+    )
+    return result
@@ -0,0 +1,104 @@
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import boto3
+
+from stopcovid.utils import dynamodb as dynamodb_utils
+from stopcovid.utils.cache import LRUCache
+
+EXPIRATION_ATTRIBUTE = "expiration_ts"
+
+# cached for keys that we know aren't in the table
+_MISSING: Dict[str, Any] = {}
+
+
+class DynamoDBCache:
+    # Items shared by every container in a DynamoDB table keyed by a single string attribute,
+    # optionally cached in memory in front of it. Without a table, items are only cached in
+    # memory.
+    #
+    # With ttl_seconds, items expire with DynamoDB's TTL on EXPIRATION_ATTRIBUTE. That can lag by
+    # hours, so we also check the expiration when we read. With cache_size, each key is read
+    # from the table at most once per container, including keys that aren't there.
+    #
+    # Caches are best effort, so by default read errors are logged and treated as misses. Write
+    # errors are always raised.
+
+    def __init__(
+        self,
+        table_name: Optional[str],
+        key_name: str,
+        ttl_seconds: Optional[float] = None,
+        cache_size: int = 0,
+        errors_are_misses: bool = True,
+        **kwargs,
+    ):
+        self.table_name = table_name
+        self.key_name = key_name
+        self.ttl_seconds = ttl_seconds
+        self.errors_are_misses = errors_are_misses
+        self.dynamodb = boto3.client("dynamodb", **kwargs) if table_name else None
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self.cache.get(key) if self.cache is not None else None
+        if item is None:
+            try:
+                item = self._fetch(key)
+            except Exception:
+                if not self.errors_are_misses:
+                    raise
+                logging.warning(f"Unable to read {key} from {self.table_name}", exc_info=True)
+                return None
+            if self.cache is not None:
+                self.cache.put(key, item or _MISSING)
+        if not item or self._is_expired(item):
+            return None
+        return item
+
+    def put(self, key: str, attributes: Dict[str, Any], if_absent: bool = False):
+        item = {**attributes, self.key_name: key}
+        if self.ttl_seconds is not None:
+            item[EXPIRATION_ATTRIBUTE] = int(time.time() + self.ttl_seconds)
+        if self.cache is not None:
+            self.cache.put(key, item)
+        if self.dynamodb is None:
+            return
+        kwargs = {}
+        if if_absent:
+            kwargs["ConditionExpression"] = f"attribute_not_exists({self.key_name})"
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name, Item=dynamodb_utils.serialize(item), **kwargs
+            )
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            # only raised with if_absent, when the item is already there
+            pass
+
+    def _fetch(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.dynamodb is None:
+            return None
+        response = self.dynamodb.get_item(
+            TableName=self.table_name, Key={self.key_name: {"S": key}}
+        )
+        if "Item" not in response:
+            return None
+        return dynamodb_utils.deserialize(response["Item"])
+
+    def _is_expired(self, item: Dict[str, Any]) -> bool:
+        # DynamoDB can take a while to delete expired items
+        return EXPIRATION_ATTRIBUTE in item and int(item[EXPIRATION_ATTRIBUTE]) <= time.time()
+
+    def ensure_table_exists(self):
+        # useful for testing but will likely be duplicated elsewhere
+        try:
+            self.dynamodb.create_table(
+                TableName=self.table_name,
+                KeySchema=[{"AttributeName": self.key_name, "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": self.key_name, "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+        except Exception:
+            # table already exists, most likely
+            pass
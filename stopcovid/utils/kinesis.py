@@ -1,5 +1,36 @@
+import bisect
+import hashlib
 import json
+import os
+import zlib
 from base64 import b64decode
+from typing import Any, Dict, List, Tuple
+
+from stopcovid.utils.cache import TTLCache
+
+# Many small logical records can be packed into one Kinesis record, which saves PUT payload units
+# and counts once against a shard's records per second limit. An aggregated record's data is
+# AGGREGATION_MAGIC followed by a zlib-compressed JSON list of the logical records' data. Our
+# records are JSON objects, which never start with the magic bytes, so both kinds of record can
+# share a stream.
+#
+# The logical records in an aggregated record share its sequence number and are told apart by
+# their sub-sequence number, their position in the list. An aggregated record is delivered under
+# its first record's partition key, so the others lose their ordering guarantees under a
+# parallelization factor. Only aggregate streams whose consumers don't depend on ordering, like
+# the message log. The dialog command stream is never aggregated.
+AGGREGATION_MAGIC = b"\x00agg"
+MAX_AGGREGATED_RECORDS = 500
+# Kinesis records are limited to 1 MB, before compression
+MAX_AGGREGATED_BYTES = 512 * 1024
+SHARD_MAP_TTL_SECONDS = 300
+
+_SHARD_MAPS = TTLCache(16, SHARD_MAP_TTL_SECONDS)
+
+
+def aggregation_enabled() -> bool:
+    # Consumers have to be able to read aggregated records before anything writes them.
+    return os.getenv("AGGREGATE_KINESIS_RECORDS", "false").lower() == "true"
 
 
 def get_payload_from_kinesis_record(record):
@@ -7,6 +38,108 @@ def get_payload_from_kinesis_record(record):
     return json.loads(payload_bytes.decode("UTF-8"))
 
 
+def get_payloads_from_kinesis_record(record) -> List[Tuple[int, Any]]:
+    # Returns the logical records in a Kinesis record, with their sub-sequence numbers.
+    payload_bytes = b64decode(record["kinesis"]["data"])
+    if not payload_bytes.startswith(AGGREGATION_MAGIC):
+        return [(0, json.loads(payload_bytes.decode("UTF-8")))]
+    magic_length = len(AGGREGATION_MAGIC)
+    data_list = json.loads(zlib.decompress(payload_bytes[magic_length:]))
+    return [(i, json.loads(data)) for i, data in enumerate(data_list)]
+
+
 def get_payloads_from_kinesis_event(kinesis_payload):
     records = kinesis_payload["Records"]
-    return [get_payload_from_kinesis_record(record) for record in records]
+    return [
+        payload for record in records for _, payload in get_payloads_from_kinesis_record(record)
+    ]
+
+
+def hash_key(partition_key: str) -> int:
+    # how Kinesis maps partition keys to shards
+    return int(hashlib.md5(partition_key.encode("utf-8")).hexdigest(), 16)
+
+
+def get_shard_starting_hash_keys(kinesis, stream_name: str) -> List[int]:
+    starting_hash_keys = _SHARD_MAPS.get(stream_name)
+    if starting_hash_keys is None:
+        shards = []
+        kwargs = {"StreamName": stream_name}
+        while True:
+            response = kinesis.list_shards(**kwargs)
+            shards.extend(response["Shards"])
+            if "NextToken" not in response:
+                break
+            kwargs = {"NextToken": response["NextToken"]}
+        # closed shards (left behind by resharding) no longer accept records
+        starting_hash_keys = sorted(
+            int(shard["HashKeyRange"]["StartingHashKey"])
+            for shard in shards
+            if "EndingSequenceNumber" not in shard["SequenceNumberRange"]
+        )
+        _SHARD_MAPS.put(stream_name, starting_hash_keys)
+    return starting_hash_keys
+
+
+def aggregate_records(
+    records: List[Dict[str, Any]],
+    shard_starting_hash_keys: List[int],
+) -> List[Tuple[Dict[str, Any], List[int]]]:
+    """Packs PutRecords entries bound for the same shard into aggregated entries.
+
+    Returns each entry to put, with the indices of the records it contains. Records keep their
+    relative order within a shard. Entries that would contain a single record are left alone.
+    """
+    groups: Dict[int, List[List[int]]] = {}
+    group_sizes: Dict[int, int] = {}
+    for i, record in enumerate(records):
+        shard = bisect.bisect_right(shard_starting_hash_keys, hash_key(record["PartitionKey"]))
+        size = len(record["Data"])
+        current = groups.get(shard)
+        if (
+            current is None
+            or len(current[-1]) == MAX_AGGREGATED_RECORDS
+            or group_sizes[shard] + size > MAX_AGGREGATED_BYTES
+        ):
+            groups.setdefault(shard, []).append([])
+            group_sizes[shard] = 0
+        groups[shard][-1].append(i)
+        group_sizes[shard] += size
+
+    entries = []
+    for shard_groups in groups.values():
+        for indices in shard_groups:
+            if len(indices) == 1:
+                entries.append((records[indices[0]], indices))
+                continue
+            first = records[indices[0]]
+            entries.append(
+                (
+                    {
+                        "Data": AGGREGATION_MAGIC
+                        + zlib.compress(
+                            json.dumps([records[i]["Data"] for i in indices]).encode("utf-8")
+                        ),
+                        "PartitionKey": first["PartitionKey"],
+                        # route the entry to the shard that all of its records belong to
+                        "ExplicitHashKey": str(hash_key(first["PartitionKey"])),
+                    },
+                    indices,
+                )
+            )
+    return entries
+
+
+def put_records(kinesis, stream_name: str, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Puts records, aggregated when aggregation is enabled. Returns a PutRecords result for
+    each record, in order. Every record in an aggregated entry shares that entry's result.
+    """
+    if not aggregation_enabled() or len(records) < 2:
+        return kinesis.put_records(StreamName=stream_name, Records=records)["Records"]
+    entries = aggregate_records(records, get_shard_starting_hash_keys(kinesis, stream_name))
+    response = kinesis.put_records(StreamName=stream_name, Records=[entry for entry, _ in entries])
+    results: List[Dict[str, Any]] = [{}] * len(records)
+    for (_, indices), result in zip(entries, response["Records"]):
+        for i in indices:
+            results[i] = result
+    return results